@@ -0,0 +1,4 @@
+"""
+Benchmarks for searching a large number of repositories, corpus generates a folder of synthetic frontends to search
+and harness measures how long each engine and output takes to search it
+"""
@@ -0,0 +1,192 @@
+"""
+Generates a search path full of synthetic frontends whose templates use components in each of the ways our
+fixtures do, so that we can benchmark searching something closer to the size of everything we search for real
+
+Every template has exactly one usage in it, so the number of usages we expect to find is the number of templates
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+
+from find_usages.utils import get_default_list_of_all_components
+
+default_mix = {
+    "injection": 4,
+    "static-helper": 2,
+    "inline-assigned": 1,
+    "inline-used-immediately": 1,
+    "inline-used-as-argument": 1,
+    "with-form-field": 1,
+    "nunjucks": 2,
+}
+
+# markup around each usage so that templates are closer to the size of real ones
+filler = """
+<div class="govuk-grid-row">
+  <div class="govuk-grid-column-two-thirds">
+    <h1 class="govuk-heading-xl">@messages("page.heading")</h1>
+    <p class="govuk-body">@messages("page.body")</p>
+  </div>
+</div>
+"""
+
+
+def class_name_of(component):
+    return f"{component[0].upper()}{component[1:]}"
+
+
+def twirl(dependencies, body):
+    return f"@this({dependencies})\n\n@()\n{filler}\n{body}\n{filler}"
+
+
+def template_using(component, style):
+    """
+    Returns (file extension, contents) of a template using the component in the given style
+    """
+    class_name = class_name_of(component)
+    if style == "injection":
+        return ".scala.html", twirl(
+            f"{component}: {class_name}", f'@{component}(Params(label="submit"))'
+        )
+    if style == "static-helper":
+        return ".scala.html", twirl("", f'@{component}(\n  Params(label="submit")\n)')
+    if style == "inline-assigned":
+        return ".scala.html", twirl(
+            "",
+            f'@alias = @{{new {class_name}()}}\n\n@alias(Params(label="submit"))',
+        )
+    if style == "inline-used-immediately":
+        return ".scala.html", twirl("", f'new {component}(abc)(Params(label="submit"))')
+    if style == "inline-used-as-argument":
+        return ".scala.html", twirl("", f"new ConsumingComponent(new {class_name}())")
+    if style == "with-form-field":
+        return ".scala.html", twirl(
+            f"{component}: {class_name}",
+            f'@{component}(Params(label="submit").withFormField(form("field")))',
+        )
+    if style == "nunjucks":
+        return ".njk", f'{filler}\n{{{{ {component}({{ text: "submit" }}) }}}}\n'
+    raise ValueError("Unknown style of usage", style)
+
+
+def commit_all(repo_path):
+    subprocess.run(
+        "git init --quiet && git add . && git commit --quiet --message 'Generated'",
+        shell=True,
+        check=True,
+        cwd=repo_path,
+        env={
+            **os.environ,
+            "GIT_AUTHOR_NAME": "benchmarks",
+            "GIT_AUTHOR_EMAIL": "benchmarks@example.com",
+            "GIT_COMMITTER_NAME": "benchmarks",
+            "GIT_COMMITTER_EMAIL": "benchmarks@example.com",
+        },
+    )
+
+
+def generate_corpus(
+    search_path, repos, templates, components=None, mix=None, seed=0, git=True
+):
+    """
+    Writes repos frontends each with templates templates into search_path, mix is a dict of the style of usage to
+    how often relative to the others it should be used, and git makes each frontend a repository with everything
+    committed like a real checkout
+
+    Returns a dict describing the corpus which includes how many templates and usages it has
+    """
+    components = components or get_default_list_of_all_components()
+    mix = mix or default_mix
+    styles, weights = zip(*mix.items())
+    randomly = random.Random(seed)
+
+    for repo in range(repos):
+        repo_path = os.path.join(search_path, f"example-frontend-{repo}")
+        os.makedirs(os.path.join(repo_path, "app", "views"), exist_ok=True)
+
+        for template in range(templates):
+            (style,) = randomly.choices(styles, weights)
+            extension, contents = template_using(randomly.choice(components), style)
+            with open(
+                os.path.join(repo_path, "app", "views", f"page{template}{extension}"),
+                "w",
+            ) as file:
+                file.write(contents)
+
+        if git:
+            commit_all(repo_path)
+
+    return {
+        "repos": repos,
+        "templates": repos * templates,
+        "usages": repos * templates,
+        "components": len(components),
+        "mix": mix,
+        "seed": seed,
+    }
+
+
+def parse_mix(mix):
+    """
+    Parses a comma separated list of style=weight, for example injection=3,nunjucks=1
+    """
+    return {
+        style: int(weight)
+        for style, weight in (part.split("=") for part in mix.split(","))
+    }
+
+
+parser = argparse.ArgumentParser(
+    description="Generate a search path full of synthetic frontends to benchmark searching."
+)
+
+parser.add_argument("search_path", type=str, help="Folder to generate frontends in")
+
+parser.add_argument(
+    "--repos", metavar="N", default=100, type=int, help="Number of frontends"
+)
+
+parser.add_argument(
+    "--templates",
+    metavar="M",
+    default=20,
+    type=int,
+    help="Number of templates in each frontend",
+)
+
+parser.add_argument(
+    "--mix",
+    metavar="STYLE=WEIGHT,...",
+    default=None,
+    type=parse_mix,
+    help=f"How often each style of usage is used relative to the others, defaults to "
+    f"{','.join(f'{style}={weight}' for style, weight in default_mix.items())}",
+)
+
+parser.add_argument("--seed", default=0, type=int, help="Seed for random choices")
+
+parser.add_argument(
+    "--no-git",
+    action="store_true",
+    help="Don't make each frontend a git repository",
+)
+
+
+def main():
+    args = parser.parse_args()
+    corpus = generate_corpus(
+        args.search_path,
+        repos=args.repos,
+        templates=args.templates,
+        mix=args.mix,
+        seed=args.seed,
+        git=not args.no_git,
+    )
+    print(json.dumps(corpus))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+Measures searching a corpus with each engine and output, every measurement is taken in a fresh process so that peak
+memory use and anything cached in memory by one doesn't carry over to the next
+
+Results are output as json, save them as a baseline and pass that in on later runs to compare against it
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.corpus import generate_corpus, parse_mix
+from find_usages.utils import template_extensions
+
+engines = {
+    "ripgrep": dict(engine="ripgrep"),
+    "ripgrep-single-pass": dict(engine="ripgrep", single_pass=True),
+    "python": dict(engine="python"),
+    "python-single-pass": dict(engine="python", single_pass=True),
+}
+
+sinks = ["stdout", "file", "sqlite"]
+
+metrics_where_less_is_better = ["wall_time", "subprocesses", "peak_rss"]
+metrics_where_more_is_better = ["files_per_second", "usages_per_second"]
+
+
+async def measure(search_path, engine, sink, output_path):
+    """
+    Searches search_path and outputs to sink, what happened can be read from find_usages.stats afterwards
+    """
+    from find_usages.core import find_all_usages_for_all_components
+    from find_usages.outputs import output_to_file, output_to_sqlite, output_to_stdout
+    from find_usages.stats import counting_usages
+    from find_usages.utils import get_default_list_of_all_components
+
+    all_usages = counting_usages(
+        find_all_usages_for_all_components(
+            in_search_path=search_path,
+            of_components=get_default_list_of_all_components(),
+            **engines[engine],
+        )
+    )
+
+    if sink == "file":
+        await output_to_file(all_usages, output_path)
+    elif sink == "sqlite":
+        await output_to_sqlite(
+            all_usages, database=output_path, table="usages", batch_size=100
+        )
+    else:
+        await output_to_stdout(all_usages)
+
+
+def measure_in_this_process(search_path, engine, sink, output_path):
+    from find_usages.stats import stats
+    from find_usages.utils import search_errors
+
+    # so that the usages output to stdout don't get mixed up with the results
+    stdout = os.dup(sys.stdout.fileno())
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), sys.stdout.fileno())
+    try:
+        stats.reset()
+        asyncio.run(measure(search_path, engine, sink, output_path))
+        stats.finish()
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout, sys.stdout.fileno())
+
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+    snapshot = stats.as_dict()
+
+    return {
+        "usages": snapshot["usages"],
+        "wall_time": snapshot["seconds"],
+        "subprocesses": snapshot["stages"].get("subprocess", {}).get("count", 0),
+        "peak_rss": peak_rss * 1024,
+        "errors": len(search_errors),
+        "stats": snapshot,
+    }
+
+
+def measure_in_new_process(search_path, engine, sink):
+    with tempfile.TemporaryDirectory() as output_dir:
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.harness",
+                "measure",
+                search_path,
+                engine,
+                sink,
+                os.path.join(output_dir, "output"),
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+    return json.loads(result.stdout)
+
+
+def git_commit():
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    return result.stdout.decode().strip() or None
+
+
+def run_benchmarks(corpus, search_path, engines_to_run, sinks_to_run, repeat=1):
+    """
+    Returns the result of each engine and sink, the best of repeat runs is kept to reduce noise
+    """
+    results = {}
+    for engine in engines_to_run:
+        for sink in sinks_to_run:
+            runs = [
+                measure_in_new_process(search_path, engine, sink) for _ in range(repeat)
+            ]
+            best = min(runs, key=lambda run: run["wall_time"])
+            benchmark = f"{engine}/{sink}"
+            results[benchmark] = {
+                **best,
+                "files_per_second": corpus["templates"] / best["wall_time"],
+                "usages_per_second": best["usages"] / best["wall_time"],
+                "expected_usages": corpus["usages"],
+            }
+            print(f"{benchmark}: {json.dumps(results[benchmark])}", file=sys.stderr)
+
+    return {"commit": git_commit(), "corpus": corpus, "results": results}
+
+
+def compare(baseline, current):
+    """
+    Returns a line for each metric of each benchmark in both, with the change as a percentage where a positive
+    change is an improvement
+    """
+    lines = []
+    for benchmark, result in current["results"].items():
+        if benchmark not in baseline["results"]:
+            continue
+        for metric in metrics_where_less_is_better + metrics_where_more_is_better:
+            before, after = baseline["results"][benchmark][metric], result[metric]
+            if not before:
+                continue
+            change = (after - before) / before * 100
+            if metric in metrics_where_less_is_better:
+                change = -change
+            lines.append(
+                f"{benchmark} {metric}: {before:.2f} -> {after:.2f} ({change:+.1f}%)"
+            )
+    return lines
+
+
+parser = argparse.ArgumentParser(
+    description="Benchmark searching a synthetic corpus of frontends with each engine and output."
+)
+
+parser.add_argument(
+    "--search-path",
+    metavar="DIR",
+    type=str,
+    help="Existing corpus to search rather than generating one, see benchmarks.corpus",
+)
+
+parser.add_argument(
+    "--repos", metavar="N", default=100, type=int, help="Number of frontends"
+)
+
+parser.add_argument(
+    "--templates",
+    metavar="M",
+    default=20,
+    type=int,
+    help="Number of templates in each frontend",
+)
+
+parser.add_argument(
+    "--mix",
+    metavar="STYLE=WEIGHT,...",
+    default=None,
+    type=parse_mix,
+    help="How often each style of usage is used relative to the others",
+)
+
+parser.add_argument(
+    "--engine",
+    choices=list(engines),
+    action="append",
+    help="Engine to benchmark, can be repeated, defaults to all of them",
+)
+
+parser.add_argument(
+    "--sink",
+    choices=sinks,
+    action="append",
+    help="Output to benchmark, can be repeated, defaults to all of them",
+)
+
+parser.add_argument(
+    "--repeat",
+    metavar="N",
+    default=1,
+    type=int,
+    help="Run each benchmark N times and keep the fastest",
+)
+
+parser.add_argument(
+    "--output",
+    metavar="FILE",
+    type=str,
+    help="Save the results as json to this file, for example to use as a baseline later",
+)
+
+parser.add_argument(
+    "--baseline",
+    metavar="FILE",
+    type=str,
+    help="Results saved from an earlier run to compare against",
+)
+
+
+def main():
+    if sys.argv[1:2] == ["measure"]:
+        search_path, engine, sink, output_path = sys.argv[2:]
+        print(
+            json.dumps(measure_in_this_process(search_path, engine, sink, output_path))
+        )
+        return
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as generated:
+        if args.search_path is not None:
+            search_path = args.search_path
+            corpus = {
+                "templates": sum(
+                    1
+                    for _, _, files in os.walk(search_path)
+                    for name in files
+                    if name.endswith(template_extensions)
+                ),
+                "usages": None,
+            }
+        else:
+            search_path = generated
+            corpus = generate_corpus(
+                search_path, repos=args.repos, templates=args.templates, mix=args.mix
+            )
+
+        results = run_benchmarks(
+            corpus,
+            os.path.abspath(search_path),
+            args.engine or list(engines),
+            args.sink or sinks,
+            repeat=args.repeat,
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            for line in compare(json.load(file), results):
+                print(line)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
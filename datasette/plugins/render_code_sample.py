@@ -1,40 +1,59 @@
-import os
-import html
-import json
+import collections
+import hashlib
 
 from datasette import hookimpl
-from jinja2 import Markup, Template
+from markupsafe import Markup
 
+from find_usages.rendering import render_code_sample
 
-with open(
-    os.path.join(os.path.dirname(__file__), "render_code_sample.html.jinja2")
-) as template:
-    code_sample = Template(template.read())
+# keyed by (database, table) as the config is read once for each table rather than for every cell
+configs = {}
 
 
-@hookimpl
-def render_cell(value, column, table, database, datasette):
-    config = datasette.plugin_config(
-        "datasette-render-code-sample", database=database, table=table
-    )
-    if not config:
-        return None
-    if column in config["columns"]:
-        column_json = json.loads(value)
+class RenderedCells:
+    """
+    The most recently rendered cells, keyed by a hash of their value so the values themselves aren't kept around,
+    as the same usages are shown again and again when paging through a table or its facets
+    """
 
-        # TODO maybe capture the complete first line if not an argument and use dedent to remove common whitespace
+    def __init__(self, size=10000):
+        self.size = size
+        self.cells = collections.OrderedDict()
 
-        escaped_code = (
-            "<code>"
-            + html.escape(column_json["code"]).replace("\n", "</code>\n<code>")  # so we can show line numbers
-            + "</code>"
-        )
+    def get(self, value):
+        key = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        if key in self.cells:
+            self.cells.move_to_end(key)
+            return self.cells[key]
+        rendered = Markup(render_code_sample(value))
+        self.cells[key] = rendered
+        if len(self.cells) > self.size:
+            self.cells.popitem(last=False)
+        return rendered
+
+
+rendered_cells = RenderedCells()
 
-        return Markup(
-            code_sample.render(
-                escaped_code=escaped_code,
-                github_url=column_json["github_url"],
-                file_path=column_json["path"],
-                line_number=column_json["line_number"],
+
+def config_of(datasette, database, table):
+    if (database, table) not in configs:
+        configs[(database, table)] = (
+            datasette.plugin_config(
+                "datasette-render-code-sample", database=database, table=table
             )
+            or {}
         )
+    return configs[(database, table)]
+
+
+@hookimpl
+def render_cell(value, column, table, database, datasette):
+    config = config_of(datasette, database, table)
+    if not isinstance(value, str):
+        return None
+    # rendered when the usages were output to sqlite with --render-code-samples
+    if column in config.get("html_columns", []):
+        return Markup(value)
+    if column in config.get("columns", []):
+        return rendered_cells.get(value)
+    return None
@@ -0,0 +1,182 @@
+"""
+Caches the usages found in each repository so that on later runs only the repositories that have changed since
+they were last searched need to be searched again, usages for all the others are replayed from the cache
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import shlex
+import sqlite3
+
+from find_usages.guardrails import skipped
+from find_usages.stats import stats
+from find_usages.usage import Usage
+from find_usages.utils import list_repos, repo_name_of, scheduler, search_errors
+
+default_cache_dir = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "find-usages"
+)
+
+
+def configuration_hash(components, engine="ripgrep", single_pass=False):
+    """
+    Cached usages are only valid for the same components searched for with the same regexp, as the regexp are
+    composed in the package the source of the whole package is included, which means any other change to what we
+    find or how it's output also invalidates the cache, along with the engine and whether it was a single pass as
+    they don't always find exactly the same usages
+    """
+    configuration = hashlib.sha256(
+        "\n".join([engine, str(single_pass), *sorted(components)]).encode()
+    )
+    package = os.path.dirname(__file__)
+    for name in sorted(os.listdir(package)):
+        if name.endswith(".py"):
+            with open(os.path.join(package, name), "rb") as source:
+                configuration.update(source.read())
+    return configuration.hexdigest()
+
+
+async def get_git_repo_tree(repo_path, git_ref=None):
+    """
+    Returns the hash of the tree checked out in the repository or None when it's not a git repository or has
+    uncommitted changes, in which case the tree wouldn't reflect what we're searching
+
+    When searching at git_ref rather than the working tree it's the tree at that ref, uncommitted changes don't matter
+    """
+    command = (
+        f"git rev-parse {shlex.quote(f'{git_ref}^{{tree}}')}"
+        if git_ref is not None
+        else 'git rev-parse "HEAD:./" && git status --porcelain -- .'
+    )
+
+    async with scheduler.slot():
+        process = await asyncio.subprocess.create_subprocess_shell(
+            command,
+            cwd=repo_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+
+        stdout, _ = await process.communicate()
+
+    if process.returncode != 0:
+        return None
+
+    tree, *uncommitted_changes = stdout.decode().strip().split("\n")
+
+    return None if uncommitted_changes else tree
+
+
+def open_cache(cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache = sqlite3.connect(os.path.join(cache_dir, "cache.db"))
+    with cache:
+        cache.execute(
+            "create table if not exists repos (repo text primary key, key text not null)"
+        )
+        cache.execute("create table if not exists usages (repo text, usage text)")
+        cache.execute("create index if not exists usages_repo on usages (repo)")
+    return cache
+
+
+def save_usages(cache, keys, usages):
+    with cache:
+        for repo, key in keys.items():
+            cache.execute("delete from usages where repo = ?", (repo,))
+            cache.execute(
+                "insert or replace into repos (repo, key) values (?, ?)", (repo, key)
+            )
+        cache.executemany(
+            "insert into usages (repo, usage) values (?, ?)",
+            [(usage.repo, usage.to_json()) for usage in usages],
+        )
+
+
+async def find_all_usages_using_cache(
+    search, in_search_path, of_components, cache_dir, in_repos=None, **search_options
+):
+    """
+    Search is called with in_repos set to just the repositories that need searching, the usages it finds are only
+    saved to the cache once it's finished without any errors
+    """
+    repos = list_repos(in_search_path, in_repos)
+
+    trees = await asyncio.gather(
+        *[
+            get_git_repo_tree(
+                os.path.join(in_search_path, repo), search_options.get("git_ref")
+            )
+            for repo in repos
+        ]
+    )
+
+    configuration = configuration_hash(
+        of_components,
+        search_options.get("engine", "ripgrep"),
+        search_options.get("single_pass", False),
+    )
+
+    keys = {
+        repo_name_of(repo): hashlib.sha256(
+            f"{tree}:{configuration}".encode()
+        ).hexdigest()
+        for repo, tree in zip(repos, trees)
+        if tree is not None
+    }
+
+    cache = open_cache(cache_dir)
+
+    cached_keys = dict(cache.execute("select repo, key from repos"))
+
+    unchanged_repos = {
+        repo
+        for repo in repos
+        if repo_name_of(repo) in keys
+        and cached_keys.get(repo_name_of(repo)) == keys[repo_name_of(repo)]
+    }
+
+    for repo in sorted(unchanged_repos):
+        with stats.timed("cache_replay"):
+            usages = [
+                Usage.from_dict(json.loads(usage))
+                for (usage,) in cache.execute(
+                    "select usage from usages where repo = ?", (repo_name_of(repo),)
+                )
+            ]
+        for usage in usages:
+            yield usage
+
+    changed_repos = [repo for repo in repos if repo not in unchanged_repos]
+
+    errors_before_searching = len(search_errors)
+    skipped_before_searching = len(skipped)
+
+    usages_to_cache = []
+
+    async for usage in search(
+        in_search_path, of_components, in_repos=changed_repos, **search_options
+    ):
+        if usage.repo in keys:
+            usages_to_cache.append(usage)
+        yield usage
+
+    # so that anything skipped is searched again next time, which can't be narrowed down to a repository when a
+    # whole pipeline was stopped
+    skipped_in = {record.get("repo") for record in skipped[skipped_before_searching:]}
+
+    if len(search_errors) == errors_before_searching and None not in skipped_in:
+        with stats.timed("cache_save"):
+            save_usages(
+                cache,
+                {
+                    repo_name_of(repo): keys[repo_name_of(repo)]
+                    for repo in changed_repos
+                    if repo_name_of(repo) in keys
+                    and repo_name_of(repo) not in skipped_in
+                },
+                [usage for usage in usages_to_cache if usage.repo not in skipped_in],
+            )
+
+    cache.close()
@@ -0,0 +1,229 @@
+"""
+Records which units of a search, each component in each repository searched with one strategy, have been completely
+written to the output, so a search that's interrupted can be started again with the same checkpoint and carry on from
+where it got to rather than from the beginning
+
+Repositories are searched a batch at a time and a batch's units are only recorded once it's all been written, when
+starting again anything written after the last recorded batch is removed first so no usage is output twice, files
+are truncated back to the size they were and in sqlite the usages of each batch replace any already there for its
+units in one transaction, so the table is never left with part of a batch in it
+"""
+
+import asyncio
+import os
+import sqlite3
+
+from find_usages.outputs import (
+    output_to_file,
+    output_to_sqlite,
+    replace_usages_in_sqlite,
+    sqlite_columns,
+)
+from find_usages.stats import stats
+from find_usages.utils import list_repos, repo_name_of, search_errors
+
+
+def strategy_of(engine="ripgrep", single_pass=False, git_ref=None):
+    """
+    A unit is only complete for the strategy it was searched with, as what's found differs between engines, a single
+    pass can miss a component nested in another, and a git ref is a different version of the repository
+    """
+    return " ".join(
+        [
+            engine,
+            *(["single-pass"] if single_pass else []),
+            *([f"at {git_ref}"] if git_ref is not None else []),
+        ]
+    )
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "create table if not exists units (repo text, component text, strategy text, "
+                "primary key (repo, component, strategy))"
+            )
+            self.connection.execute(
+                "create table if not exists outputs (output text primary key, size integer not null)"
+            )
+
+    def completed(self, strategy):
+        """
+        Returns the (repo, component) of every unit completed with strategy
+        """
+        return set(
+            self.connection.execute(
+                "select repo, component from units where strategy = ?", (strategy,)
+            )
+        )
+
+    def size_of(self, output):
+        row = self.connection.execute(
+            "select size from outputs where output = ?", (output,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, units, strategy, output, size=None):
+        """
+        Records units as (repo, component), along with the size of output after they were written to it when it's a
+        file, in one transaction so they're never out of step
+        """
+        with self.connection:
+            self.connection.executemany(
+                "insert or ignore into units (repo, component, strategy) values (?, ?, ?)",
+                [(repo, component, strategy) for repo, component in units],
+            )
+            if size is not None:
+                self.connection.execute(
+                    "insert or replace into outputs (output, size) values (?, ?)",
+                    (output, size),
+                )
+
+    def close(self):
+        self.connection.close()
+
+
+class FileSink:
+    """
+    Appends each batch to output_file, which starts off truncated to the size it was when the last batch was recorded,
+    or emptied when nothing has been, like it would be when not checkpointing
+    """
+
+    def __init__(self, output_file, format="ndjson"):
+        if format == "parquet":
+            raise ValueError(
+                "Parquet output can't be checkpointed as it can't be appended to",
+                output_file,
+            )
+        self.output_file = output_file
+        self.format = format
+        self.name = os.path.abspath(output_file)
+        # the size once the last recorded batch was written, and once the batch being written was
+        self.recorded_size = 0
+        self.size = 0
+
+    async def restore(self, checkpoint):
+        self.recorded_size = checkpoint.size_of(self.name) or 0
+        self.undo()
+
+    def undo(self):
+        """
+        Removes anything written since the last batch that was recorded
+        """
+        with open(self.output_file, "ab") as file:
+            file.truncate(self.recorded_size)
+        self.size = self.recorded_size
+
+    def recorded(self):
+        self.recorded_size = self.size
+
+    async def write(self, usages, units):
+        await output_to_file(usages, self.output_file, self.format, append=True)
+        self.size = os.path.getsize(self.output_file)
+
+
+class SqliteSink:
+    """
+    Replaces the usages of each batch's units in table all at once, so whatever was written for units that weren't
+    recorded, because of being interrupted or an error, is replaced when they're searched again
+    """
+
+    def __init__(self, database, table="usages", columns=sqlite_columns):
+        self.database = database
+        self.table = table
+        self.columns = columns
+        self.name = os.path.abspath(database)
+        self.size = None
+
+    async def restore(self, checkpoint):
+        async def no_usages():
+            return
+            yield
+
+        # created with the same indexes and full text search as when not checkpointing, which are kept up to date
+        # from then on
+        await output_to_sqlite(
+            no_usages(), self.database, self.table, 1, columns=self.columns
+        )
+
+    def undo(self):
+        pass
+
+    def recorded(self):
+        pass
+
+    async def write(self, usages, units):
+        usages = [usage async for usage in usages]
+        with stats.timed("output"):
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                lambda: replace_usages_in_sqlite(
+                    self.database, self.table, usages, components=units
+                ),
+            )
+
+
+def batches_of_pending_units(repos, components, completed, batch_size):
+    """
+    Yields (repos, components) to search, with repositories that still need the same components searched for
+    batched together in the order they're in
+    """
+    needing = {}
+    for repo in repos:
+        pending = tuple(
+            component
+            for component in components
+            if (repo_name_of(repo), component) not in completed
+        )
+        if pending:
+            needing.setdefault(pending, []).append(repo)
+
+    for pending, repos_needing in needing.items():
+        for start in range(0, len(repos_needing), batch_size):
+            yield repos_needing[start : start + batch_size], list(pending)
+
+
+async def output_with_checkpoint(
+    search,
+    sink,
+    checkpoint,
+    in_search_path,
+    of_components,
+    strategy,
+    in_repos=None,
+    batch_size=10,
+):
+    """
+    Search is called with in_repos and of_components set to a batch of repositories and the components still to be
+    searched for in them, a batch's units are only recorded when it's finished without any errors, otherwise what it
+    wrote is undone so it's searched again next time
+
+    Templates skipped because of a guardrail don't stop a batch being recorded, as they'd be skipped again, they're
+    reported with --skipped as they are when not checkpointing
+    """
+    completed = checkpoint.completed(strategy)
+
+    await sink.restore(checkpoint)
+
+    for repos, components in batches_of_pending_units(
+        list_repos(in_search_path, in_repos), of_components, completed, batch_size
+    ):
+        errors_before_searching = len(search_errors)
+
+        units = [
+            (repo_name_of(repo), component)
+            for repo in repos
+            for component in components
+        ]
+
+        await sink.write(search(in_search_path, components, in_repos=repos), units)
+
+        if len(search_errors) != errors_before_searching:
+            sink.undo()
+            continue
+
+        with stats.timed("checkpoint"):
+            checkpoint.record(units, strategy, sink.name, sink.size)
+        sink.recorded()
@@ -1,10 +1,137 @@
 import argparse
 import asyncio
+import functools
 import os
+import sys
 
+from find_usages.cache import default_cache_dir
+from find_usages.checkpoint import (
+    Checkpoint,
+    FileSink,
+    SqliteSink,
+    output_with_checkpoint,
+    strategy_of,
+)
 from find_usages.core import find_all_usages_for_all_components
-from find_usages.outputs import output_to_stdout, output_to_sqlite, output_to_file
-from find_usages.utils import readlines_without_newlines, default_list_of_all_components
+from find_usages.diff import (
+    default_run_size,
+    diff_usages,
+    output_changes_to_file,
+    output_changes_to_sqlite,
+    output_changes_to_stdout,
+)
+from find_usages.guardrails import guardrails, parse_size, write_skipped
+from find_usages.history import dates_between, parse_every, parse_history
+from find_usages.outputs import (
+    output_format_of,
+    output_formats,
+    output_to_stdout,
+    output_to_sqlite,
+    output_to_file,
+    sqlite_columns,
+    sqlite_rendered_columns,
+    sqlite_snapshot_columns,
+    tee,
+)
+from find_usages.prefilter import find_candidates
+from find_usages.stats import counting_usages, report_progress, stats, write_stats
+from find_usages.shards import list_repos_in_shard, merge_usages, parse_shard
+from find_usages.summary import (
+    output_summary_to_file,
+    output_summary_to_sqlite,
+    output_summary_to_stdout,
+    summarise,
+    summary_counts,
+)
+from find_usages.watch import watch_search_path
+from find_usages.utils import (
+    readlines_without_newlines,
+    default_list_of_all_components,
+    scheduler,
+)
+
+
+def add_output_arguments(parser):
+    parser.add_argument(
+        "--output-file",
+        metavar="FILE",
+        action="append",
+        type=str,
+        help="Write output to this file rather than stdout, can be given more than once along with --output-sqlite "
+        "to write the one search to each of them at the same time",
+    )
+
+    parser.add_argument(
+        "--output-format",
+        choices=output_formats,
+        help="Write to stdout or --output-file as newline delimited json, compressed with gzip or zstd, or to "
+        "--output-file as parquet with the columns that have few distinct values dictionary encoded, zstd needs "
+        "the zstandard package and parquet needs pyarrow, defaults to ndjson, or for each --output-file the "
+        "format its extension is for, .gz, .zst or .parquet",
+    )
+
+    parser.add_argument(
+        "--output-sqlite",
+        metavar="FILE",
+        action="append",
+        type=str,
+        help="Write output to a sqlite database rather than to stdout, will be created if it does not yet exist, "
+        "can be given more than once along with --output-file.",
+    )
+
+    parser.add_argument(
+        "--output-sqlite-table",
+        metavar="TABLE",
+        type=str,
+        help="Table to insert usages into within the output database, defaults to usages, or summary with --summary.",
+    )
+
+    parser.add_argument(
+        "--render-code-samples",
+        action="store_true",
+        help="Render the code sample of each usage for the datasette plugin as it's output to sqlite, into a "
+        "usage_example_html column the plugin serves as it is.",
+    )
+
+    parser.add_argument(
+        "--upsert",
+        action="store_true",
+        help="Update usages already in the output database on the same line of the same template for the same "
+        "component rather than inserting them again.",
+    )
+
+
+def add_component_arguments(parser):
+    parser.add_argument(
+        "--component",
+        metavar="NAME",
+        type=str,
+        help="Limit search to usages of a single component, for example: govukButton",
+    )
+
+    parser.add_argument(
+        "--components",
+        metavar="FILE",
+        default=default_list_of_all_components,
+        type=str,
+        help="Path to newline delimited text file with names of components to search for instead of the default list",
+    )
+
+
+def components_of(args):
+    components = (
+        [args.component]
+        if args.component is not None
+        else readlines_without_newlines(args.components)
+    )
+
+    if len(components) < 1:
+        raise ValueError(
+            "Component list empty, need the name of at least one component",
+        )
+
+    return components
+
 
 parser = argparse.ArgumentParser(
     description="Search a folder full of repositories for usages of components in twirl and nunjucks template and "
@@ -17,52 +144,495 @@ parser.add_argument(
     help="Folder with repositories to search for usages within checkout as immediate sub folders",
 )
 
+add_component_arguments(parser)
+
+add_output_arguments(parser)
+
+parser.add_argument(
+    "--single-pass",
+    action="store_true",
+    help="Search for all components at once with combined regexp so each search strategy only walks the search "
+    "path once, much faster when searching for many components",
+)
+
+parser.add_argument(
+    "--jobs",
+    metavar="N",
+    default=os.cpu_count(),
+    type=int,
+    help="Maximum number of searches to run at the same time, defaults to the number of cores",
+)
+
+parser.add_argument(
+    "--engine",
+    choices=["ripgrep", "python"],
+    default="ripgrep",
+    help="Search with ripgrep and jq pipelines or in process with python, which reads each template once "
+    "and doesn't need any of the external tools",
+)
+
 parser.add_argument(
-    "--component",
-    metavar="NAME",
+    "--git-ref",
+    metavar="REF",
     type=str,
-    help="Limit search to usages of a single component, for example: govukButton",
+    help="Search the templates committed at this ref of each repository, for example HEAD or main, reading them "
+    "straight from git objects so the search path can be full of bare mirrors without working trees, always searches "
+    "in process like the python engine",
+)
+
+parser.add_argument(
+    "--history",
+    metavar="SINCE..UNTIL",
+    type=str,
+    help="Search each repository as it was at the end of every date from SINCE until UNTIL, for example "
+    "2024-01-01..2024-06-30, tagging each usage with the date of the snapshot it was found in, read from git objects "
+    "at --git-ref or HEAD, UNTIL can be left out to mean today",
+)
+
+parser.add_argument(
+    "--every",
+    metavar="N{d,w}",
+    default="1w",
+    type=str,
+    help="How long between each snapshot when searching --history, in days or weeks, defaults to 1w",
+)
+
+parser.add_argument(
+    "--cache-dir",
+    metavar="DIR",
+    default=default_cache_dir,
+    type=str,
+    help="Where to cache the usages found in each repository so that repositories that haven't changed since they "
+    "were last searched don't need to be searched again",
+)
+
+parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="Search every repository and don't use or update the cache",
 )
 
 parser.add_argument(
-    "--components",
+    "--processes",
+    metavar="N",
+    default=1,
+    type=int,
+    help="Split the repositories in the search path between this many worker processes so more than one core can "
+    "be used",
+)
+
+parser.add_argument(
+    "--prefilter",
+    action="store_true",
+    help="Find which templates mention each component by name first so that the regexp for each component are only "
+    "run against the templates that mention it",
+)
+
+parser.add_argument(
+    "--prefilter-index",
+    metavar="FILE",
+    type=str,
+    help="Keep what the templates in each repository mention in this sqlite database so it doesn't need to be found "
+    "again while the repository hasn't changed, implies --prefilter",
+)
+
+parser.add_argument(
+    "--max-filesize",
+    metavar="SIZE",
+    type=parse_size,
+    help="Skip templates bigger than this, in bytes or with a K, M or G suffix, for example 10M",
+)
+
+parser.add_argument(
+    "--file-timeout",
+    metavar="SECONDS",
+    default=30.0,
+    type=float,
+    help="How long the python engine can spend searching one template before searching it again with cheaper "
+    "regexp that only match brackets nested a few deep, defaults to 30",
+)
+
+parser.add_argument(
+    "--pipeline-timeout",
+    metavar="SECONDS",
+    type=float,
+    help="Stop any ripgrep pipeline that's still running after this long, keeping the usages it found until then",
+)
+
+parser.add_argument(
+    "--skipped",
+    metavar="FILE",
+    type=str,
+    help="Write a newline delimited json record of everything skipped or stopped because of --max-filesize, "
+    "--file-timeout or --pipeline-timeout to this file",
+)
+
+parser.add_argument(
+    "--max-examples-per-component",
+    metavar="N",
+    type=int,
+    help="Only find N usages of each component, stopping its searches once it has that many, which is much quicker "
+    "when only a few examples of each are needed, never uses or updates the cache",
+)
+
+parser.add_argument(
+    "--examples-per-repo",
+    action="store_true",
+    help="Find --max-examples-per-component usages of each component in each repository rather than overall",
+)
+
+parser.add_argument(
+    "--summary",
+    nargs="?",
+    const="usages",
+    choices=summary_counts,
+    help="Output how many usages of each component there are in each repository by labels and library rather than "
+    "every usage, or how many templates use it in each way with --summary templates, which is quicker as each "
+    "template is only searched until each way it uses a component is found",
+)
+
+parser.add_argument(
+    "--summary-format",
+    choices=["json", "csv"],
+    default="json",
+    help="Write the summary to stdout or --output-file as newline delimited json or csv, defaults to json",
+)
+
+parser.add_argument(
+    "--stats",
     metavar="FILE",
-    default=default_list_of_all_components,
     type=str,
-    help="Path to newline delimited text file with names of components to search for instead of the default list",
+    help="Write counts and timings for each stage of the search to this file as json once it's finished",
+)
+
+parser.add_argument(
+    "--progress",
+    action="store_true",
+    help="Show how many usages have been found so far and how quickly on stderr",
+)
+
+parser.add_argument(
+    "--shard",
+    metavar="INDEX/COUNT",
+    type=str,
+    help="Only search the repositories in this shard when splitting a search across COUNT machines, for example "
+    "1/4, combine the output of every shard afterwards with find-usages merge",
 )
 
 parser.add_argument(
+    "--checkpoint",
+    metavar="FILE",
+    type=str,
+    help="Record each component in each repository once its usages are all in --output-file or --output-sqlite, "
+    "so that when interrupted running again with the same checkpoint skips them and carries on without "
+    "outputting anything twice",
+)
+
+merge_parser = argparse.ArgumentParser(
+    prog="find-usages merge",
+    description="Merge the output of searches of each shard into one, skipping duplicates and reporting each "
+    "repository at the latest commit any of the shards searched.",
+)
+
+merge_parser.add_argument(
+    "inputs",
+    metavar="INPUT",
+    nargs="+",
+    type=str,
+    help="Newline delimited json or sqlite database output by a search of a shard",
+)
+
+merge_parser.add_argument(
+    "--input-sqlite-table",
+    metavar="TABLE",
+    default="usages",
+    type=str,
+    help="Table to read usages from within any input databases.",
+)
+
+add_output_arguments(merge_parser)
+
+watch_parser = argparse.ArgumentParser(
+    prog="find-usages watch",
+    description="Search a folder full of repositories into a sqlite database then keep it up to date, searching "
+    "templates again as they change and every template of a repository once it has moved to another commit.",
+)
+
+watch_parser.add_argument(
+    "search_path",
+    type=str,
+    help="Folder with repositories to search for usages within checkout as immediate sub folders",
+)
+
+add_component_arguments(watch_parser)
+
+watch_parser.add_argument(
+    "--output-sqlite",
+    metavar="FILE",
+    required=True,
+    type=str,
+    help="Sqlite database to keep up to date, will be created if it does not yet exist.",
+)
+
+watch_parser.add_argument(
+    "--output-sqlite-table",
+    metavar="TABLE",
+    default="usages",
+    type=str,
+    help="Table to keep usages in within the output database, usages already in it for the repositories being "
+    "watched are replaced.",
+)
+
+watch_parser.add_argument(
+    "--single-pass",
+    action="store_true",
+    help="Search for all components at once with combined regexp",
+)
+
+watch_parser.add_argument(
+    "--jobs",
+    metavar="N",
+    default=os.cpu_count(),
+    type=int,
+    help="Maximum number of searches to run at the same time, defaults to the number of cores",
+)
+
+watch_parser.add_argument(
+    "--engine",
+    choices=["ripgrep", "python"],
+    default="ripgrep",
+    help="Search with ripgrep and jq pipelines or in process with python",
+)
+
+watch_parser.add_argument(
+    "--interval",
+    metavar="SECONDS",
+    default=1.0,
+    type=float,
+    help="How often to check whether any repository has moved to another commit, and to look for changed "
+    "templates when polling",
+)
+
+watch_parser.add_argument(
+    "--poll",
+    action="store_true",
+    help="Look for changed templates every interval rather than being told about them by inotify, which is only "
+    "used on linux",
+)
+
+diff_parser = argparse.ArgumentParser(
+    prog="find-usages diff",
+    description="Compare two snapshots of usages and output which usages were added, removed or changed between "
+    "them as newline delimited json, the commit each snapshot was searched at is ignored.",
+)
+
+diff_parser.add_argument(
+    "old",
+    type=str,
+    help="Newline delimited json or sqlite database output by the earlier search",
+)
+
+diff_parser.add_argument(
+    "new",
+    type=str,
+    help="Newline delimited json or sqlite database output by the later search",
+)
+
+diff_parser.add_argument(
+    "--input-sqlite-table",
+    metavar="TABLE",
+    default="usages",
+    type=str,
+    help="Table to read usages from within any input databases.",
+)
+
+diff_parser.add_argument(
     "--output-file",
     metavar="FILE",
     type=str,
     help="Write output to this file rather than stdout",
 )
 
-parser.add_argument(
+diff_parser.add_argument(
     "--output-sqlite",
     metavar="FILE",
     type=str,
     help="Write output to a sqlite database rather than to stdout, will be created if it does not yet exist.",
 )
 
-parser.add_argument(
+diff_parser.add_argument(
     "--output-sqlite-table",
     metavar="TABLE",
-    default="usages",
+    default="changes",
     type=str,
-    help="Table to insert usages into within the output database.",
+    help="Table to insert changes into within the output database.",
+)
+
+diff_parser.add_argument(
+    "--run-size",
+    metavar="N",
+    default=default_run_size,
+    type=int,
+    help="How many usages to sort in memory at a time, the rest are sorted on disk",
 )
 
 
+def outputs_of(args):
+    """
+    Returns an async function taking the usages for each output asked for, or for stdout when there are none
+    """
+    outputs = [
+        functools.partial(
+            output_to_file,
+            output_file=output_file,
+            format=output_format_of(output_file, args.output_format),
+        )
+        for output_file in args.output_file or []
+    ]
+    outputs += [
+        functools.partial(
+            output_to_sqlite,
+            database=database,
+            table=args.output_sqlite_table or "usages",
+            batch_size=1000,
+            upsert=args.upsert,
+            columns={
+                **(
+                    sqlite_snapshot_columns
+                    if getattr(args, "history", None) is not None
+                    else sqlite_columns
+                ),
+                **(sqlite_rendered_columns if args.render_code_samples else {}),
+            },
+        )
+        for database in args.output_sqlite or []
+    ]
+    return outputs or [
+        functools.partial(output_to_stdout, format=args.output_format or "ndjson")
+    ]
+
+
+def only_output_of(args, option):
+    """
+    Returns (output_file, output_sqlite) with at most one of them set, for what can't be written to several outputs
+    """
+    outputs = [*(args.output_file or []), *(args.output_sqlite or [])]
+    if len(outputs) > 1:
+        raise ValueError(f"{option} can only be written to one output", outputs)
+    return (
+        args.output_file[0] if args.output_file else None,
+        args.output_sqlite[0] if args.output_sqlite else None,
+    )
+
+
+async def output(all_usages, args):
+    outputs = outputs_of(args)
+    if len(outputs) == 1:
+        await outputs[0](all_usages)
+    else:
+        await tee(all_usages, *outputs)
+
+
+async def output_summary(args, components, in_repos):
+    if args.git_ref is not None or args.history is not None or args.processes > 1:
+        raise ValueError(
+            "Summary can't be combined with --git-ref, --history or --processes"
+        )
+
+    candidates = None
+    if args.prefilter or args.prefilter_index is not None:
+        with stats.timed("prefilter"):
+            candidates = await find_candidates(
+                args.search_path,
+                components,
+                args.engine,
+                in_repos,
+                index=args.prefilter_index,
+            )
+
+    rows = summarise(
+        args.search_path,
+        components,
+        count=args.summary,
+        single_pass=args.single_pass,
+        in_repos=in_repos,
+        candidates=candidates,
+    )
+
+    output_file, output_sqlite = only_output_of(args, "Summary")
+
+    if output_file is not None:
+        await output_summary_to_file(
+            rows, output_file, args.summary, args.summary_format
+        )
+    elif output_sqlite is not None:
+        await output_summary_to_sqlite(
+            rows,
+            output_sqlite,
+            args.output_sqlite_table or "summary",
+            args.summary,
+        )
+    else:
+        await output_summary_to_stdout(rows, args.summary, args.summary_format)
+
+
+def sink_for(args):
+    output_file, output_sqlite = only_output_of(args, "Checkpoint")
+    if output_file is not None:
+        return FileSink(output_file, output_format_of(output_file, args.output_format))
+    if output_sqlite is not None:
+        return SqliteSink(
+            output_sqlite,
+            args.output_sqlite_table or "usages",
+            {
+                **sqlite_columns,
+                **(sqlite_rendered_columns if args.render_code_samples else {}),
+            },
+        )
+    raise ValueError("Checkpoint needs --output-file or --output-sqlite")
+
+
+async def output_with_checkpoint_file(args, search_options, components, in_repos):
+    if (
+        args.history is not None
+        or args.summary is not None
+        or args.max_examples_per_component is not None
+    ):
+        raise ValueError(
+            "Checkpoint can't be combined with --history, --summary or --max-examples-per-component"
+        )
+
+    sink = sink_for(args)
+
+    def search(in_search_path, of_components, in_repos):
+        return counting_usages(
+            find_all_usages_for_all_components(
+                in_search_path=in_search_path,
+                of_components=of_components,
+                in_repos=in_repos,
+                **search_options,
+            )
+        )
+
+    checkpoint = Checkpoint(args.checkpoint)
+    try:
+        await output_with_checkpoint(
+            search,
+            sink,
+            checkpoint,
+            args.search_path,
+            components,
+            strategy_of(args.engine, args.single_pass, args.git_ref),
+            in_repos=in_repos,
+        )
+    finally:
+        checkpoint.close()
+
+
 async def run():
     args = parser.parse_args()
 
-    components = (
-        [args.component]
-        if args.component is not None
-        else readlines_without_newlines(args.components)
-    )
+    components = components_of(args)
 
     if not os.path.isdir(args.search_path):
         raise ValueError(
@@ -70,31 +640,172 @@ async def run():
             args.search_path,
         )
 
-    if len(components) < 1:
+    if args.jobs < 1:
+        raise ValueError("Jobs must be at least 1", args.jobs)
+
+    if args.processes < 1:
+        raise ValueError("Processes must be at least 1", args.processes)
+
+    if (
+        args.max_examples_per_component is not None
+        and args.max_examples_per_component < 1
+    ):
         raise ValueError(
-            "Component list empty, need the name of at least one component",
+            "Max examples per component must be at least 1",
+            args.max_examples_per_component,
+        )
+
+    snapshot_dates = (
+        dates_between(*parse_history(args.history), parse_every(args.every))
+        if args.history is not None
+        else None
+    )
+
+    scheduler.jobs = args.jobs
+
+    guardrails.max_filesize = args.max_filesize
+    guardrails.file_timeout = args.file_timeout
+    guardrails.pipeline_timeout = args.pipeline_timeout
+
+    stats.reset()
+
+    in_repos = (
+        list_repos_in_shard(args.search_path, *parse_shard(args.shard))
+        if args.shard is not None
+        else None
+    )
+
+    if args.summary is not None and args.checkpoint is None:
+        try:
+            await output_summary(args, components, in_repos)
+        finally:
+            stats.finish()
+            if args.stats is not None:
+                write_stats(args.stats)
+            if args.skipped is not None:
+                write_skipped(args.skipped)
+        return
+
+    search_options = dict(
+        single_pass=args.single_pass,
+        engine=args.engine,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        processes=args.processes,
+        prefilter=args.prefilter or args.prefilter_index is not None,
+        prefilter_index=args.prefilter_index,
+        git_ref=args.git_ref,
+        snapshot_dates=snapshot_dates,
+        max_examples=args.max_examples_per_component,
+        examples_per_repo=args.examples_per_repo,
+    )
+
+    progress = asyncio.ensure_future(report_progress()) if args.progress else None
+
+    try:
+        if args.checkpoint is not None:
+            await output_with_checkpoint_file(
+                args, search_options, components, in_repos
+            )
+        else:
+            all_usages = find_all_usages_for_all_components(
+                in_search_path=args.search_path,
+                of_components=components,
+                in_repos=in_repos,
+                **search_options,
+            )
+            await output(counting_usages(all_usages), args)
+    finally:
+        if progress is not None:
+            progress.cancel()
+        stats.finish()
+        if args.stats is not None:
+            write_stats(args.stats)
+        if args.skipped is not None:
+            write_skipped(args.skipped)
+
+
+async def merge():
+    args = merge_parser.parse_args(sys.argv[2:])
+
+    for path in args.inputs:
+        if not os.path.isfile(path):
+            raise ValueError("Input to merge is not a file", path)
+
+    await output(merge_usages(args.inputs, table=args.input_sqlite_table), args)
+
+
+async def watch():
+    args = watch_parser.parse_args(sys.argv[2:])
+
+    components = components_of(args)
+
+    if not os.path.isdir(args.search_path):
+        raise ValueError(
+            "Search path folder with git repositories checked out as immediate sub folders",
+            args.search_path,
+        )
+
+    if args.jobs < 1:
+        raise ValueError("Jobs must be at least 1", args.jobs)
+
+    scheduler.jobs = args.jobs
+
+    def updated(templates, repos, seconds):
+        print(
+            f"Updated {templates} templates and {repos} repositories in {seconds * 1000:.0f}ms",
+            file=sys.stderr,
+            flush=True,
         )
 
-    all_usages = find_all_usages_for_all_components(
-        in_search_path=args.search_path,
-        of_components=components,
+    await watch_search_path(
+        args.search_path,
+        components,
+        database=args.output_sqlite,
+        table=args.output_sqlite_table,
+        interval=args.interval,
+        poll=args.poll,
+        updated=updated,
+        single_pass=args.single_pass,
+        engine=args.engine,
+    )
+
+
+async def diff():
+    args = diff_parser.parse_args(sys.argv[2:])
+
+    for path in [args.old, args.new]:
+        if not os.path.isfile(path):
+            raise ValueError("Input to diff is not a file", path)
+
+    if args.run_size < 1:
+        raise ValueError("Run size must be at least 1", args.run_size)
+
+    changes = diff_usages(
+        args.old, args.new, table=args.input_sqlite_table, run_size=args.run_size
     )
 
     if args.output_file is not None:
-        await output_to_file(all_usages, args.output_file)
+        await output_changes_to_file(changes, args.output_file)
     elif args.output_sqlite is not None:
-        await output_to_sqlite(
-            all_usages,
-            database=args.output_sqlite,
-            table=args.output_sqlite_table,
-            batch_size=100,
+        await output_changes_to_sqlite(
+            changes, database=args.output_sqlite, table=args.output_sqlite_table
         )
     else:
-        await output_to_stdout(all_usages)
+        await output_changes_to_stdout(changes)
 
 
 def main():
-    asyncio.run(run())
+    if sys.argv[1:2] == ["merge"]:
+        asyncio.run(merge())
+    elif sys.argv[1:2] == ["diff"]:
+        asyncio.run(diff())
+    elif sys.argv[1:2] == ["watch"]:
+        try:
+            asyncio.run(watch())
+        except KeyboardInterrupt:
+            pass
+    else:
+        asyncio.run(run())
 
 
 if __name__ == "__main__":
@@ -4,118 +4,161 @@ Search functions are all async generators
 
 import os
 import json
+import time
 
 from aiostream import stream
 
 from find_usages.ripgrep import (
     search_using_ripgrep,
     output_matches_as_json,
-    output_newline_delimited_lists_of_files_grouped_by_matches,
-    using_jq_select_only_matches,
-    using_ripgrep_with_common_params,
+    paths_to_search,
     search_using_ripgrep_for_usages_via_deprecated_static_helper,
-    match_instantiation_and_assignment,
+    match_alias_including_class_name,
     match_instantiation_and_use_as_argument,
     match_instantiation_and_use_immediately,
-    match_injection,
-    match_usages_not_instantiations,
     search_using_ripgrep_for_usages_via_nunjucks,
+    search_using_ripgrep_for_any_components_assigned_or_injected,
+    search_using_ripgrep_for_any_usages_via_deprecated_static_helper,
 )
 
+from find_usages.guardrails import guardrails
+from find_usages.stats import instrumented, stats
+from find_usages.usage import Usage
 from find_usages.utils import (
     get_git_repo_latest_commit,
     get_git_repo_last_updated_at,
     identify_library,
+    identify_alias,
     identify_language,
-    parse_alias_and_files,
+    identify_component,
+    identify_components_assigned,
+    prefetch_git_repo_metadata,
+    repo_name_of,
+    split_into_matches_per_component,
     run,
+    scheduler,
+    template_extensions,
     terminate_all_subprocesses_on_exception,
 )
 
 
+def run_search(command, **kwargs):
+    """
+    Runs a search pipeline within the time limit set in find_usages.guardrails
+    """
+    return run(command, timeout=guardrails.pipeline_timeout, **kwargs)
+
+
+def within_templates_of_language(within, language):
+    """
+    ripgrep searches every file it's given explicitly whatever the glob, so when searching within candidate files
+    rather than repositories the templates of the other language need to be left out
+    """
+    if within is None:
+        return None
+    return [
+        path
+        for path in within
+        if not path.endswith(template_extensions) or identify_language(path) == language
+    ]
+
+
 async def parse_usage(usage, of_component, in_search_path, labels=None):
-    result = json.loads(usage)
-    repo, *path = result["data"]["path"]["text"].strip("./").split("/")
+    with stats.timed("parse_usage"):
+        result = json.loads(usage)
+    return await create_usage(
+        result["data"]["path"]["text"],
+        result["data"]["line_number"],
+        result["data"]["submatches"][0]["match"]["text"],
+        of_component,
+        in_search_path,
+        labels=labels,
+    )
+
+
+async def create_usage(
+    path_in_search_path, line_start, code, of_component, in_search_path, labels=None
+):
+    repo, *path = path_in_search_path.strip("./").split("/")
     path = "/".join(path)
     repo_path = os.path.join(in_search_path, repo)
     git_commit = await get_git_repo_latest_commit(repo_path)
     repo_last_updated = await get_git_repo_last_updated_at(repo_path)
-    template_language = identify_language(path)
-    library = identify_library(template_language, of_component)
-    code = result["data"]["submatches"][0]["match"]["text"]
-    line_start = result["data"]["line_number"]
-    line_stop = line_start + code.count("\n")
-    if labels is None:
-        labels = []
+    return usage_at_commit(
+        repo_name_of(repo),
+        path,
+        line_start,
+        code,
+        of_component,
+        git_commit,
+        repo_last_updated,
+        labels=labels,
+    )
+
+
+def labels_from_code(code, labels):
+    """
+    Adds to labels any that depend on the code of the usage
+    """
     if ".withFormField" in code:
         # some services may construct this with their own helper and still be using with-form-field so this has
         # the -inline suffix to try and show it's not the complete set, although you should assume that it's
         # never going to be possible to find the complete set of any conditions with this tool because we're just
         # working with regex
         labels.append("using-with-form-field-inline")
-    # TODO template last edited?
-    # TODO library dependency versions?
-    return {
-        "repo": repo,
-        "component": of_component,
-        "library": library,
-        "labels": labels,
-        "template_language": template_language,
-        "line_count": 1 + code.count("\n"),
-        "parenthesis_count": code.count("("),
-        "length": len(code),
-        "repo_last_updated": repo_last_updated,
-        "usage_example": {
-            "github_url": f"https://github.com/hmrc/{repo}/blob/{git_commit}/{path}#L{line_start}-L{line_stop}",
-            "line_number": line_start,
-            "code": code,
-            "path": path,
-        },
-        "code": code,
-        "path": path,
-    }
-
-
-async def find_usages_in_files(of_component, files_to_search, in_search_path):
-    async for usage in run(
-        rf"""xargs --no-run-if-empty {using_ripgrep_with_common_params} --regexp '{match_usages_not_instantiations(of_component)}' --json"""
-        rf""" | {using_jq_select_only_matches}""",
-        working_dir=in_search_path,
-        files_to_search=files_to_search,
-    ):
-        yield usage
+    return labels
 
 
-async def find_usages_via_dependency_injection(in_search_path, of_component):
-    async for alias_and_files in run(
-        search_using_ripgrep(
-            match_injection(of_component),
-            output_newline_delimited_lists_of_files_grouped_by_matches,
-        ),
-        working_dir=in_search_path,
-    ):
-        (alias, files_its_found_in) = parse_alias_and_files(alias_and_files)
-
-        async for usage in find_usages_in_files(
-            alias, files_its_found_in, in_search_path
-        ):
-            yield await parse_usage(
-                usage,
-                of_component,
-                in_search_path,
-                labels=["via-dependency-injection"],
-            )
+def usage_at_commit(
+    repo,
+    path,
+    line_start,
+    code,
+    of_component,
+    git_commit,
+    repo_last_updated,
+    labels=None,
+    snapshot_date=None,
+):
+    """
+    Creates a usage when we already know which commit of the repository it was found in and when that was
+    """
+    started_at = time.monotonic()
+    template_language = identify_language(path)
+    library = identify_library(template_language, of_component)
+    labels = labels_from_code(code, [] if labels is None else labels)
+    # TODO template last edited?
+    # TODO library dependency versions?
+    usage = Usage(
+        repo=repo,
+        component=of_component,
+        library=library,
+        labels=labels,
+        template_language=template_language,
+        repo_last_updated=repo_last_updated,
+        git_commit=git_commit,
+        line_number=line_start,
+        code=code,
+        path=path,
+        snapshot_date=snapshot_date,
+    )
+    stats.record("create_usage", time.monotonic() - started_at)
+    return usage
 
 
+@instrumented("via-inline-instantiation-used-immediately")
 async def find_usages_via_inline_instantiation_where_used_immediately(
-    in_search_path, of_component
+    in_search_path, of_component, within=None
 ):
-    async for usage in run(
+    async for usage in run_search(
         search_using_ripgrep(
             match_instantiation_and_use_immediately(of_component),
             output_matches_as_json,
+            within=within,
         ),
         working_dir=in_search_path,
+        files_to_search=paths_to_search(within),
+        queue=of_component,
     ):
         yield await parse_usage(
             usage,
@@ -125,15 +168,19 @@ async def find_usages_via_inline_instantiation_where_used_immediately(
         )
 
 
+@instrumented("via-inline-instantiation-used-as-argument")
 async def find_usages_via_inline_instantiation_where_used_as_argument(
-    in_search_path, of_component
+    in_search_path, of_component, within=None
 ):
-    async for usage in run(
+    async for usage in run_search(
         search_using_ripgrep(
             match_instantiation_and_use_as_argument(of_component),
             output_matches_as_json,
+            within=within,
         ),
         working_dir=in_search_path,
+        files_to_search=paths_to_search(within),
+        queue=of_component,
     ):
         yield await parse_usage(
             usage,
@@ -143,39 +190,15 @@ async def find_usages_via_inline_instantiation_where_used_as_argument(
         )
 
 
-async def find_usages_via_inline_instantiation_where_assigned_to_variable(
-    in_search_path, of_component
+async def find_usages_via_inline_instantiation(
+    in_search_path, of_component, within=None
 ):
-    async for alias_and_files in run(
-        search_using_ripgrep(
-            match_instantiation_and_assignment(of_component),
-            output_newline_delimited_lists_of_files_grouped_by_matches,
-        ),
-        working_dir=in_search_path,
-    ):
-        (alias, files_its_found_in) = parse_alias_and_files(alias_and_files)
-
-        async for usage in find_usages_in_files(
-            alias, files_its_found_in, in_search_path=in_search_path
-        ):
-            yield await parse_usage(
-                usage,
-                of_component,
-                in_search_path,
-                labels=["via-inline-instantiation", "used-as-variable"],
-            )
-
-
-async def find_usages_via_inline_instantiation(in_search_path, of_component):
     searches = stream.merge(
         find_usages_via_inline_instantiation_where_used_immediately(
-            in_search_path, of_component
+            in_search_path, of_component, within
         ),
         find_usages_via_inline_instantiation_where_used_as_argument(
-            in_search_path, of_component
-        ),
-        find_usages_via_inline_instantiation_where_assigned_to_variable(
-            in_search_path, of_component
+            in_search_path, of_component, within
         ),
     )
 
@@ -184,10 +207,17 @@ async def find_usages_via_inline_instantiation(in_search_path, of_component):
             yield usage
 
 
-async def find_usages_via_deprecated_static_helper(in_search_path, of_component):
-    async for usage in run(
-        search_using_ripgrep_for_usages_via_deprecated_static_helper(of_component),
+@instrumented("via-deprecated-static-helper")
+async def find_usages_via_deprecated_static_helper(
+    in_search_path, of_component, within=None
+):
+    async for usage in run_search(
+        search_using_ripgrep_for_usages_via_deprecated_static_helper(
+            of_component, within=within
+        ),
         working_dir=in_search_path,
+        files_to_search=paths_to_search(within),
+        queue=of_component,
     ):
         yield await parse_usage(
             usage,
@@ -197,21 +227,29 @@ async def find_usages_via_deprecated_static_helper(in_search_path, of_component)
         )
 
 
-async def find_usages_via_nunjucks(in_search_path, of_component):
-    async for usage in run(
-        search_using_ripgrep_for_usages_via_nunjucks(of_component),
+@instrumented("via-nunjucks")
+async def find_usages_via_nunjucks(in_search_path, of_component, within=None):
+    async for usage in run_search(
+        search_using_ripgrep_for_usages_via_nunjucks(of_component, within=within),
         working_dir=in_search_path,
+        files_to_search=paths_to_search(within),
+        queue=of_component,
     ):
         yield await parse_usage(usage, of_component, in_search_path)
 
 
 @terminate_all_subprocesses_on_exception
-async def find_all_usages_for_component(in_search_path, of_component):
+async def find_all_usages_for_component(in_search_path, of_component, within=None):
+    twirl = within_templates_of_language(within, "twirl")
+    nunjucks = within_templates_of_language(within, "nunjucks")
+
     searches = stream.merge(
-        find_usages_via_dependency_injection(in_search_path, of_component),
-        find_usages_via_deprecated_static_helper(in_search_path, of_component),
-        find_usages_via_inline_instantiation(in_search_path, of_component),
-        find_usages_via_nunjucks(in_search_path, of_component),
+        find_usages_via_aliases(
+            in_search_path, [of_component], twirl, queue=of_component
+        ),
+        find_usages_via_deprecated_static_helper(in_search_path, of_component, twirl),
+        find_usages_via_inline_instantiation(in_search_path, of_component, twirl),
+        find_usages_via_nunjucks(in_search_path, of_component, nunjucks),
     )
 
     async with searches.stream() as search_stream:
@@ -219,15 +257,365 @@ async def find_all_usages_for_component(in_search_path, of_component):
             yield usage
 
 
+async def find_usages_of_any_component(
+    command, in_search_path, of_components, labels=None, excluding=None, within=None
+):
+    """
+    Run a search that has been combined for all components in one pass and then attribute each match it finds back
+    to the component it was for
+
+    Matches in files where excluding(path, component) returns True are skipped
+    """
+    async for result in run_search(
+        command, working_dir=in_search_path, files_to_search=paths_to_search(within)
+    ):
+        for path, line_number, code, component in split_into_matches_per_component(
+            json.loads(result), of_components
+        ):
+            if excluding is not None and excluding(path, component):
+                continue
+            yield await create_usage(
+                path,
+                line_number,
+                code,
+                component,
+                in_search_path,
+                labels=None if labels is None else [*labels],
+            )
+
+
+async def find_aliases_of_any_component(
+    in_search_path, of_components, within=None, queue=None
+):
+    """
+    Returns a dict of each template to a list of the (component, alias, labels) injected or assigned in it, both
+    are found in one pass for all of the components
+    """
+    aliases = {}
+    async for result in run_search(
+        search_using_ripgrep(
+            match_alias_including_class_name(*of_components),
+            output_matches_as_json,
+            within=within,
+        ),
+        working_dir=in_search_path,
+        files_to_search=paths_to_search(within),
+        queue=queue,
+    ):
+        result = json.loads(result)
+        path = result["data"]["path"]["text"]
+        for submatch in result["data"]["submatches"]:
+            code = submatch["match"]["text"]
+            component = identify_component(code, of_components)
+            if component is not None:
+                alias, labels = identify_alias(code)
+                aliases.setdefault(path, {})[(component, alias, labels)] = None
+
+    return {path: list(found) for path, found in aliases.items()}
+
+
+@instrumented("via-aliases")
+async def find_usages_via_aliases(
+    in_search_path, of_components, within=None, queue=None
+):
+    """
+    Finds where the components are injected or assigned to an alias, then reads each template that has any once
+    and finds where all of its aliases are used in its contents, rather than running another search for each alias
+    across every template it's in
+    """
+    from find_usages.python_engine import (
+        read_template,
+        usages_of_aliases_within_limits,
+    )
+
+    aliases = await find_aliases_of_any_component(
+        in_search_path, of_components, within, queue
+    )
+
+    for path, aliases_in_template in aliases.items():
+        if queue in scheduler.stopped:
+            return
+
+        try:
+            with stats.timed("read_template"):
+                contents = read_template(os.path.join(in_search_path, path))
+        except FileNotFoundError:
+            # deleted since it was searched
+            continue
+
+        if contents is None:
+            continue
+
+        for (
+            component,
+            line_number,
+            code,
+            labels,
+        ) in usages_of_aliases_within_limits(contents, path, aliases_in_template):
+            yield await create_usage(
+                path,
+                line_number,
+                code,
+                component,
+                in_search_path,
+                labels=[*labels],
+            )
+
+
+async def find_usages_of_any_component_via_deprecated_static_helper(
+    in_search_path, of_components, within=None
+):
+    assigned_or_injected = set()
+    async for result in run_search(
+        search_using_ripgrep_for_any_components_assigned_or_injected(
+            *of_components, within=within
+        ),
+        working_dir=in_search_path,
+        files_to_search=paths_to_search(within),
+    ):
+        result = json.loads(result)
+        for submatch in result["data"]["submatches"]:
+            for component in identify_components_assigned(
+                submatch["match"]["text"], of_components
+            ):
+                assigned_or_injected.add((result["data"]["path"]["text"], component))
+
+    async for usage in find_usages_of_any_component(
+        search_using_ripgrep_for_any_usages_via_deprecated_static_helper(
+            *of_components, within=within
+        ),
+        in_search_path,
+        of_components,
+        labels=["via-deprecated-static-helper"],
+        excluding=lambda path, component: (path, component) in assigned_or_injected,
+        within=within,
+    ):
+        # same as the jq filter used when searching for a single component
+        if not usage.code.startswith("new"):
+            yield usage
+
+
 @terminate_all_subprocesses_on_exception
-async def find_all_usages_for_all_components(in_search_path, of_components):
+@instrumented("single-pass")
+async def find_all_usages_for_all_components_in_single_pass(
+    in_search_path, of_components, within=None
+):
+    """
+    Combines the regexp for every component into one alternation so that each search strategy only needs to walk
+    the search path once rather than once per component
+
+    Results should be the same as find_all_usages_for_all_components apart from in the rare case where one
+    component is nested inside the match of another, then only the outermost will be found
+    """
+    twirl = within_templates_of_language(within, "twirl")
+    nunjucks = within_templates_of_language(within, "nunjucks")
+
     searches = stream.merge(
-        *[
-            find_all_usages_for_component(in_search_path, of_component=component)
-            for component in of_components
-        ]
+        find_usages_via_aliases(in_search_path, of_components, twirl),
+        find_usages_of_any_component_via_deprecated_static_helper(
+            in_search_path, of_components, twirl
+        ),
+        find_usages_of_any_component(
+            search_using_ripgrep(
+                match_instantiation_and_use_immediately(*of_components),
+                output_matches_as_json,
+                within=twirl,
+            ),
+            in_search_path,
+            of_components,
+            labels=["via-inline-instantiation", "used-immediately"],
+            within=twirl,
+        ),
+        find_usages_of_any_component(
+            search_using_ripgrep(
+                match_instantiation_and_use_as_argument(*of_components),
+                output_matches_as_json,
+                within=twirl,
+            ),
+            in_search_path,
+            of_components,
+            labels=["via-inline-instantiation", "used-as-argument"],
+            within=twirl,
+        ),
+        find_usages_of_any_component(
+            search_using_ripgrep_for_usages_via_nunjucks(
+                *of_components, within=nunjucks
+            ),
+            in_search_path,
+            of_components,
+            within=nunjucks,
+        ),
     )
 
     async with searches.stream() as search_stream:
         async for usage in search_stream:
             yield usage
+
+
+@terminate_all_subprocesses_on_exception
+async def find_all_usages_for_all_components(
+    in_search_path,
+    of_components,
+    single_pass=False,
+    engine="ripgrep",
+    in_repos=None,
+    cache_dir=None,
+    processes=1,
+    prefilter=False,
+    prefilter_index=None,
+    git_ref=None,
+    snapshot_dates=None,
+    in_templates=None,
+    max_examples=None,
+    examples_per_repo=False,
+):
+    """
+    Pass in_repos to only search some of the repositories in the search path, cache_dir to only search the
+    repositories that have changed since they were last searched, processes to split the search across that
+    many worker processes, and prefilter to only search each template for the components it mentions, with
+    prefilter_index as the path of a database to keep what each repository mentions between runs
+
+    Pass git_ref to search what's committed at that ref of each repository rather than its working tree, which is
+    read from git objects by find_usages.git_objects so the repositories can be bare mirrors, and snapshot_dates to
+    search each repository as it was at the end of each of those dates with find_usages.history, which is never
+    cached as the cache only keeps the usages at one commit of each repository
+
+    Pass in_templates, a list of paths relative to the search path, to only search those templates, which is how
+    find_usages.watch searches just the templates that have changed
+
+    Pass max_examples to only find that many usages of each component, or of each component in each repository
+    with examples_per_repo, with find_usages.sampling stopping the searches for each component once it has enough,
+    which is never cached as the cache needs every usage in each repository
+    """
+    if in_repos is not None and len(in_repos) == 0:
+        return
+
+    if max_examples is not None:
+        cache_dir = None
+
+    reading_git_objects = git_ref is not None or snapshot_dates is not None
+
+    if cache_dir is None and processes == 1 and not reading_git_objects:
+        # otherwise this happens once we know which repositories are being searched by this process
+        prefetch_git_repo_metadata(in_search_path, in_repos)
+
+    search_options = dict(
+        single_pass=single_pass,
+        engine=engine,
+        prefilter=prefilter,
+        prefilter_index=prefilter_index,
+        git_ref=git_ref,
+        snapshot_dates=snapshot_dates,
+        max_examples=max_examples,
+        examples_per_repo=examples_per_repo,
+    )
+
+    candidates = None
+    if in_templates is not None:
+        # any of the components could be used in any of them
+        candidates = {component: sorted(in_templates) for component in of_components}
+    elif prefilter and cache_dir is None and processes == 1 and not reading_git_objects:
+        from find_usages.prefilter import find_candidates
+
+        with stats.timed("prefilter"):
+            candidates = await find_candidates(
+                in_search_path, of_components, engine, in_repos, index=prefilter_index
+            )
+
+    if cache_dir is not None and snapshot_dates is None:
+        from find_usages.cache import find_all_usages_using_cache
+
+        searches = find_all_usages_using_cache(
+            find_all_usages_for_all_components,
+            in_search_path,
+            of_components,
+            cache_dir,
+            in_repos=in_repos,
+            processes=processes,
+            **search_options,
+        )
+    elif processes > 1:
+        from find_usages.workers import find_all_usages_in_processes
+
+        searches = find_all_usages_in_processes(
+            in_search_path,
+            of_components,
+            processes,
+            in_repos=in_repos,
+            **search_options,
+        )
+    elif snapshot_dates is not None:
+        from find_usages import history
+
+        searches = history.find_all_usages_for_all_components(
+            in_search_path,
+            of_components,
+            snapshot_dates,
+            git_ref=git_ref or "HEAD",
+            single_pass=single_pass,
+            in_repos=in_repos,
+        )
+    elif git_ref is not None:
+        from find_usages import git_objects
+
+        searches = git_objects.find_all_usages_for_all_components(
+            in_search_path,
+            of_components,
+            git_ref=git_ref,
+            single_pass=single_pass,
+            in_repos=in_repos,
+        )
+    elif engine == "python":
+        from find_usages import python_engine
+
+        searches = python_engine.find_all_usages_for_all_components(
+            in_search_path,
+            of_components,
+            single_pass=single_pass,
+            in_repos=in_repos,
+            candidates=candidates,
+        )
+    elif candidates is not None and not candidates:
+        return
+    elif single_pass:
+        searches = find_all_usages_for_all_components_in_single_pass(
+            in_search_path,
+            [
+                component
+                for component in of_components
+                if candidates is None or component in candidates
+            ],
+            (
+                in_repos
+                if candidates is None
+                else sorted(set().union(*candidates.values()))
+            ),
+        )
+    else:
+        searches = stream.merge(
+            *[
+                find_all_usages_for_component(
+                    in_search_path,
+                    of_component=component,
+                    within=in_repos if candidates is None else candidates[component],
+                )
+                for component in of_components
+                if candidates is None or component in candidates
+            ]
+        )
+
+    if max_examples is not None:
+        from find_usages.sampling import sampled
+
+        searches = sampled(
+            searches,
+            in_search_path,
+            of_components,
+            max_examples,
+            per_repo=examples_per_repo,
+            in_repos=in_repos,
+        )
+
+    async with stream.iterate(searches).stream() as search_stream:
+        async for usage in search_stream:
+            yield usage
@@ -0,0 +1,196 @@
+"""
+Compares two snapshots of usages, which can be newline delimited json or sqlite databases, and finds which usages
+were added, removed or changed between them without needing to hold either snapshot in memory
+
+Each snapshot is sorted on disk by the repository, path, component and a hash of the code of each usage, then both
+are read through in that order together so that the same usage is next to itself in each
+"""
+
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+from find_usages.outputs import BufferedLines, json_line_encoder
+from find_usages.shards import identity_of, read_usages
+from find_usages.stats import stats
+
+# big enough that most snapshots are sorted in a few runs, small enough that a run fits easily in memory
+default_run_size = 100000
+
+
+def code_hash(code):
+    """
+    Whitespace is collapsed so that usages reformatted over more or fewer lines are still the same usage
+    """
+    return hashlib.sha256(re.sub(r"\s+", " ", code).strip().encode()).hexdigest()
+
+
+def sort_key_of(usage):
+    return [
+        usage["repo"],
+        usage["path"],
+        usage["component"],
+        code_hash(usage["code"]),
+        usage["usage_example"]["line_number"],
+    ]
+
+
+def write_run(entries, folder):
+    entries.sort(key=lambda entry: entry[0])
+    fd, path = tempfile.mkstemp(dir=folder, suffix=".ndjson")
+    with os.fdopen(fd, "w") as file:
+        for entry in entries:
+            file.write(f"{json.dumps(entry)}\n")
+    return path
+
+
+def read_run(path):
+    with open(path) as file:
+        for line in file:
+            yield json.loads(line)
+
+
+def sorted_usages(path, folder, table="usages", run_size=default_run_size):
+    """
+    Yields (sort key, usage) for every usage in path in order of the sort key, an external merge sort where runs of
+    run_size usages are sorted in memory and written to folder then merged back together as they're read
+    """
+    runs = []
+    entries = []
+    with stats.timed("diff_sort"):
+        for usage in read_usages(path, table):
+            entries.append([sort_key_of(usage), usage])
+            if len(entries) >= run_size:
+                runs.append(write_run(entries, folder))
+                entries = []
+        entries.sort(key=lambda entry: entry[0])
+
+    if not runs:
+        yield from entries
+        return
+
+    runs.append(write_run(entries, folder))
+    yield from heapq.merge(*[read_run(run) for run in runs], key=lambda entry: entry[0])
+
+
+def grouped_by_usage(entries):
+    """
+    Yields (key, usages) where key is the sort key without the line number, usages with the same key are the same
+    code for the same component in the same template, which there can be more than one of
+    """
+    for key, group in itertools.groupby(entries, key=lambda entry: entry[0][:4]):
+        yield key, [usage for _, usage in group]
+
+
+def change(kind, key, old=None, new=None):
+    repo, path, component, _ = key
+    return {
+        "change": kind,
+        "repo": repo,
+        "path": path,
+        "component": component,
+        "old": old,
+        "new": new,
+    }
+
+
+def changes_between(old_group, new_group, key):
+    """
+    Pairs up the same usage in each snapshot in the order they appear in the template, anything left over has
+    been added or removed
+    """
+    for old, new in itertools.zip_longest(old_group, new_group):
+        if new is None:
+            yield change("removed", key, old=old)
+        elif old is None:
+            yield change("added", key, new=new)
+        elif identity_of(old) != identity_of(new):
+            # moved to another line, or labelled differently, the commit and when it was made are ignored
+            yield change("changed", key, old=old, new=new)
+
+
+async def diff_usages(old_path, new_path, table="usages", run_size=default_run_size):
+    """
+    Yields a dict for each usage that's been added, removed or changed from the snapshot in old_path to the one
+    in new_path, with the usage from each snapshot as old and new
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        old_groups = grouped_by_usage(sorted_usages(old_path, folder, table, run_size))
+        new_groups = grouped_by_usage(sorted_usages(new_path, folder, table, run_size))
+
+        old = next(old_groups, None)
+        new = next(new_groups, None)
+        while old is not None or new is not None:
+            if new is None or (old is not None and old[0] < new[0]):
+                key, old_group, new_group = old[0], old[1], []
+                old = next(old_groups, None)
+            elif old is None or new[0] < old[0]:
+                key, old_group, new_group = new[0], [], new[1]
+                new = next(new_groups, None)
+            else:
+                key, old_group, new_group = old[0], old[1], new[1]
+                old = next(old_groups, None)
+                new = next(new_groups, None)
+
+            for each in changes_between(old_group, new_group, key):
+                yield each
+
+
+async def output_changes_as_newline_delimited_json(changes, write):
+    encode = json_line_encoder()
+    async with BufferedLines(write) as lines:
+        async for each in changes:
+            await lines.add(encode(each) + b"\n")
+
+
+async def output_changes_to_stdout(changes):
+    async def write(data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    await output_changes_as_newline_delimited_json(changes, write)
+
+
+async def output_changes_to_file(changes, output_file):
+    from aiofile import async_open
+
+    async with async_open(output_file, "wb") as file:
+        await output_changes_as_newline_delimited_json(changes, file.write)
+
+
+async def output_changes_to_sqlite(changes, database, table, batch_size=1000):
+    """
+    The usage from each snapshot is stored as json text in the old and new columns
+    """
+    connection = sqlite3.connect(database)
+    try:
+        connection.execute(
+            f"""create table if not exists "{table}" """
+            "([change] TEXT, [repo] TEXT, [path] TEXT, [component] TEXT, [old] TEXT, [new] TEXT)"
+        )
+        insert = f"""insert into "{table}" values (?, ?, ?, ?, ?, ?)"""
+        rows = []
+        async for each in changes:
+            rows.append(
+                [
+                    each["change"],
+                    each["repo"],
+                    each["path"],
+                    each["component"],
+                    None if each["old"] is None else json.dumps(each["old"]),
+                    None if each["new"] is None else json.dumps(each["new"]),
+                ]
+            )
+            if len(rows) >= batch_size:
+                connection.executemany(insert, rows)
+                rows = []
+        connection.executemany(insert, rows)
+        connection.commit()
+    finally:
+        connection.close()
@@ -0,0 +1,214 @@
+"""
+Searches the templates committed at a ref of each repository straight from its git objects rather than from a
+checked out working tree, so that bare mirrors can be searched without checking any of them out
+
+Templates are listed with git ls-tree and their contents read through one git cat-file --batch per repository that
+is kept running while the repository is searched, then searched in process with the python engine's strategies as
+ripgrep can only search files
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from aiostream import stream
+
+from find_usages.core import usage_at_commit
+from find_usages.python_engine import find_usages_in_template_within_limits
+from find_usages.stats import instrumented, stats
+from find_usages.utils import (
+    git_scheduler,
+    list_repos,
+    repo_name_of,
+    scheduler,
+    template_extensions,
+)
+
+
+async def git(repo_path, *args):
+    """
+    Returns what git output or None when it failed
+    """
+    async with git_scheduler.slot():
+        process = await asyncio.create_subprocess_exec(
+            "git",
+            *args,
+            cwd=repo_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+
+        stdout, _ = await process.communicate()
+
+    return stdout if process.returncode == 0 else None
+
+
+async def resolve_ref(repo_path, ref):
+    """
+    Returns (commit, committed at) for the commit ref points to, in the same format as we report for working trees
+    """
+    with stats.timed("git_resolve_ref"):
+        stdout = await git(
+            repo_path, "log", "-1", "--date=short", "--pretty=format:%H%n%cd", ref, "--"
+        )
+
+    if not stdout:
+        return None
+
+    commit, _, committed_at = stdout.decode().strip().partition("\n")
+
+    return commit, committed_at
+
+
+def is_template(path):
+    return path.endswith(template_extensions) and not any(
+        part.startswith(".") for part in path.split("/")
+    )
+
+
+async def templates_at(repo_path, commit):
+    """
+    Returns (blob, path) of every template in the tree of commit, like ripgrep this skips any that are hidden
+    """
+    with stats.timed("list_files"):
+        stdout = await git(repo_path, "ls-tree", "-r", "-z", "--full-tree", commit)
+
+    if stdout is None:
+        return []
+
+    templates = []
+    for entry in stdout.decode(errors="surrogateescape").split("\0"):
+        if not entry:
+            continue
+        info, path = entry.split("\t", 1)
+        _, kind, blob = info.split(" ")
+        # submodules are listed as commits
+        if kind == "blob" and is_template(path):
+            templates.append((blob, path))
+
+    return templates
+
+
+class CatFile:
+    """
+    A git cat-file --batch running in a repository, blobs are asked for all at once and read back in the same
+    order so that there's no waiting on git between one blob and the next
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.process = None
+
+    async def __aenter__(self):
+        self.process = await asyncio.create_subprocess_exec(
+            "git",
+            "cat-file",
+            "--batch",
+            cwd=self.repo_path,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        stats.running_subprocesses += 1
+        self.started_at = time.monotonic()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        stats.running_subprocesses -= 1
+        if self.process.returncode is None:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        stats.record("subprocess", time.monotonic() - self.started_at)
+
+    async def ask_for(self, blobs):
+        for blob in blobs:
+            self.process.stdin.write(f"{blob}\n".encode())
+            await self.process.stdin.drain()
+
+    async def contents_of(self, blobs):
+        """
+        Yields the contents of each blob in order, or None for any that are missing
+        """
+        asking = asyncio.ensure_future(self.ask_for(blobs))
+        try:
+            for _ in blobs:
+                header = await self.process.stdout.readline()
+                if not header:
+                    raise EOFError("git cat-file exited early", self.repo_path)
+                if header.rstrip().endswith(b" missing"):
+                    yield None
+                    continue
+                size = int(header.split(b" ")[2])
+                contents = await self.process.stdout.readexactly(size + 1)
+                stats.bytes_read += size
+                yield contents[:-1]
+            await asyncio.gather(asking)
+        finally:
+            asking.cancel()
+
+
+async def find_usages_in_repo_at_ref(
+    in_search_path, repo, of_components, git_ref, single_pass
+):
+    repo_path = os.path.join(in_search_path, repo)
+
+    metadata = await resolve_ref(repo_path, git_ref)
+    if metadata is None:
+        logging.warning(f"Could not resolve {git_ref} in {repo_path}")
+        return
+    git_commit, repo_last_updated = metadata
+
+    templates = await templates_at(repo_path, git_commit)
+    if not templates:
+        return
+
+    blobs, paths = zip(*templates)
+    paths = iter(paths)
+
+    async with scheduler.slot(), CatFile(repo_path) as cat_file:
+        async for contents in cat_file.contents_of(blobs):
+            path = next(paths)
+            # binary files are skipped like ripgrep would
+            if contents is None or b"\0" in contents:
+                continue
+            found = find_usages_in_template_within_limits(
+                contents, os.path.join(repo, path), of_components, single_pass
+            )
+            for component, line_number, code, labels in found:
+                yield usage_at_commit(
+                    repo_name_of(repo),
+                    path,
+                    line_number,
+                    code,
+                    component,
+                    git_commit,
+                    repo_last_updated,
+                    labels=labels,
+                )
+
+
+@instrumented("git-objects")
+async def find_all_usages_for_all_components(
+    in_search_path, of_components, git_ref="HEAD", single_pass=False, in_repos=None
+):
+    """
+    Every repository in the search path, bare or not, is searched at git_ref, usages are reported at the commit
+    it points to rather than whatever is checked out
+    """
+    searches = stream.merge(
+        *[
+            find_usages_in_repo_at_ref(
+                in_search_path, repo, of_components, git_ref, single_pass
+            )
+            for repo in list_repos(in_search_path, in_repos)
+        ]
+    )
+
+    async with searches.stream() as search_stream:
+        async for usage in search_stream:
+            yield usage
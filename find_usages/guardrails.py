@@ -0,0 +1,74 @@
+"""
+Limits on how long any one search can take and how big a template it will search, match_any_params recurses to
+match nested brackets so one huge generated template or some unbalanced brackets can take a very long time to
+search, and everything merged together with that search waits on it
+
+Anything skipped because of a limit is recorded in skipped so it can be reported afterwards, the python engine
+searches a template that runs out of time again with cheaper patterns that can't backtrack catastrophically
+"""
+
+import json
+import re
+
+from find_usages.stats import stats
+from find_usages.utils import repo_name_of
+
+
+class Guardrails:
+    def __init__(self, max_filesize=None, file_timeout=None, pipeline_timeout=None):
+        """
+        max_filesize is in bytes, file_timeout is the seconds the python engine can spend on one template and
+        pipeline_timeout the seconds a ripgrep pipeline can run for, None for no limit
+        """
+        self.max_filesize = max_filesize
+        self.file_timeout = file_timeout
+        self.pipeline_timeout = pipeline_timeout
+
+    def as_dict(self):
+        return {
+            "max_filesize": self.max_filesize,
+            "file_timeout": self.file_timeout,
+            "pipeline_timeout": self.pipeline_timeout,
+        }
+
+
+guardrails = Guardrails()
+
+skipped = []
+
+
+def skip(reason, path_in_search_path=None, **details):
+    """
+    Records that something wasn't searched, or wasn't searched completely, because of a limit, the path is relative
+    to the search path so which repository it's in can be worked out from it
+    """
+    record = {"reason": reason}
+    if path_in_search_path is not None:
+        repo, _, path = path_in_search_path.strip("./").partition("/")
+        record["repo"] = repo_name_of(repo)
+        record["path"] = path
+    record.update(details)
+    skipped.append(record)
+    stats.record(f"skipped_{reason}", 0.0)
+    return record
+
+
+def write_skipped(path):
+    with open(path, "w") as file:
+        for record in skipped:
+            file.write(f"{json.dumps(record)}\n")
+
+
+def parse_size(size):
+    """
+    Parses a number of bytes with an optional K, M or G suffix like ripgrep's --max-filesize, for example 10M
+    """
+    match = re.fullmatch(r"(\d+)([KMG]?)", size.strip().upper())
+    if match is None:
+        raise ValueError(
+            "Size must be a number of bytes, optionally with K, M or G on the end", size
+        )
+    return (
+        int(match.group(1))
+        * {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}[match.group(2)]
+    )
@@ -0,0 +1,200 @@
+"""
+Searches snapshots of each repository taken every so often over a range of dates, so that how the use of each
+component has grown or shrunk over time comes out of one search rather than a checkout and search per date
+
+Snapshots are read from git objects like find_usages.git_objects does, and as most templates don't change from one
+snapshot to the next the matches found in each blob are remembered, so a template is only searched again once it
+has changed
+"""
+
+import datetime
+import os
+import re
+
+from aiostream import stream
+
+from find_usages.core import usage_at_commit
+from find_usages.git_objects import CatFile, git, templates_at
+from find_usages.python_engine import find_usages_in_template_within_limits
+from find_usages.stats import instrumented, stats
+from find_usages.utils import identify_language, list_repos, repo_name_of, scheduler
+
+
+def parse_history(history):
+    """
+    Parses SINCE..UNTIL where each is a date like 2024-01-31, UNTIL can be left out to mean today
+    """
+    since, separator, until = history.partition("..")
+    if not separator:
+        raise ValueError(
+            "History must be SINCE..UNTIL, for example 2024-01-01..2024-06-30", history
+        )
+    since = datetime.date.fromisoformat(since)
+    until = datetime.date.fromisoformat(until) if until else datetime.date.today()
+    if until < since:
+        raise ValueError("History must end after it starts", history)
+    return since, until
+
+
+def parse_every(every):
+    """
+    Parses how long between snapshots as a number of days or weeks, for example 3d or 1w
+    """
+    match = re.fullmatch(r"(\d+)([dw])", every)
+    if match is None or int(match.group(1)) < 1:
+        raise ValueError(
+            "Every must be a number of days or weeks, for example 3d or 1w", every
+        )
+    days = int(match.group(1)) * (7 if match.group(2) == "w" else 1)
+    return datetime.timedelta(days=days)
+
+
+def dates_between(since, until, every):
+    """
+    Returns each date from since until until as strings like 2024-01-31, the last is always until itself
+    """
+    dates = []
+    date = since
+    while date < until:
+        dates.append(date.isoformat())
+        date += every
+    dates.append(until.isoformat())
+    return dates
+
+
+async def commits_of(repo_path, git_ref):
+    """
+    Returns (committed at as a timestamp, commit, committed at as a date) of every commit on the first parent line
+    of git_ref, newest first
+    """
+    with stats.timed("git_log"):
+        stdout = await git(
+            repo_path,
+            "log",
+            "--first-parent",
+            "--date=short",
+            "--pretty=format:%ct %H %cd",
+            git_ref,
+            "--",
+        )
+
+    if stdout is None:
+        return []
+
+    commits = []
+    for line in stdout.decode().split("\n"):
+        if line:
+            timestamp, commit, committed_at = line.split(" ")
+            commits.append((int(timestamp), commit, committed_at))
+    return commits
+
+
+def commit_at(commits, date):
+    """
+    Returns the commit that was the latest by the end of date, in utc, or None when there weren't any commits yet
+    """
+    end_of_date = datetime.datetime.combine(
+        datetime.date.fromisoformat(date) + datetime.timedelta(days=1),
+        datetime.time(),
+        datetime.timezone.utc,
+    ).timestamp()
+    for timestamp, commit, committed_at in commits:
+        if timestamp < end_of_date:
+            return commit, committed_at
+    return None
+
+
+def memo_key(blob, path):
+    # the same blob is searched differently depending on which template language its path says it is
+    return blob, identify_language(path)
+
+
+async def find_usages_in_history_of_repo(
+    in_search_path, repo, of_components, dates, git_ref, single_pass, memo
+):
+    repo_path = os.path.join(in_search_path, repo)
+
+    commits = await commits_of(repo_path, git_ref)
+    if not commits:
+        return
+
+    async with scheduler.slot(), CatFile(repo_path) as cat_file:
+        for date in dates:
+            at = commit_at(commits, date)
+            if at is None:
+                continue
+            git_commit, repo_last_updated = at
+
+            templates = await templates_at(repo_path, git_commit)
+
+            unseen = {}
+            for blob, path in templates:
+                if memo_key(blob, path) not in memo:
+                    unseen.setdefault(memo_key(blob, path), (blob, path))
+
+            stats.record(
+                "history_blobs_reused", 0.0, count=len(templates) - len(unseen)
+            )
+
+            pending = iter(unseen.items())
+            async for contents in cat_file.contents_of(
+                [blob for blob, _ in unseen.values()]
+            ):
+                key, (_, path) = next(pending)
+                # binary files are skipped like ripgrep would
+                memo[key] = (
+                    []
+                    if contents is None or b"\0" in contents
+                    else find_usages_in_template_within_limits(
+                        contents, os.path.join(repo, path), of_components, single_pass
+                    )
+                )
+
+            for blob, path in templates:
+                for component, line_number, code, labels in memo[memo_key(blob, path)]:
+                    yield usage_at_commit(
+                        repo_name_of(repo),
+                        path,
+                        line_number,
+                        code,
+                        component,
+                        git_commit,
+                        repo_last_updated,
+                        labels=[*labels],
+                        snapshot_date=date,
+                    )
+
+
+@instrumented("history")
+async def find_all_usages_for_all_components(
+    in_search_path,
+    of_components,
+    snapshot_dates,
+    git_ref="HEAD",
+    single_pass=False,
+    in_repos=None,
+):
+    """
+    Every repository is searched at the latest commit of git_ref by the end of each of the snapshot dates, each
+    usage is tagged with the date of the snapshot it was found in
+    """
+    memo = {}
+
+    searches = stream.merge(
+        *[
+            find_usages_in_history_of_repo(
+                in_search_path,
+                repo,
+                of_components,
+                snapshot_dates,
+                git_ref,
+                single_pass,
+                memo,
+            )
+            for repo in list_repos(in_search_path, in_repos)
+        ]
+    )
+
+    async with searches.stream() as search_stream:
+        async for usage in search_stream:
+            yield usage
@@ -4,10 +4,22 @@ which the methods in this module can consume and loop through to output in
 different formats.
 """
 
+import asyncio
+import contextlib
 import json
+import queue
+import sqlite3
+import sys
+import threading
+import zlib
 
 from aiostream import stream
 
+from find_usages.rendering import render_code_sample
+from find_usages.stats import stats
+from find_usages.usage import EncodedUsage
+from find_usages.utils import import_extra
+
 separators_with_no_spaces_to_match_jq_compact_format = (",", ":")
 
 
@@ -17,29 +29,579 @@ def as_json_line(usage):
     )
 
 
-async def output_to_stdout(all_usages):
-    async for usage in all_usages:
-        print(as_json_line(usage))
+def json_line_encoder():
+    """
+    Returns a function that serialises a usage to the same bytes as as_json_line, using orjson when it's installed
+    as it's much quicker, its output is only used when it's the same as json.dumps, which escapes every character
+    outside printable ascii where orjson leaves them as they are
+    """
+    try:
+        import orjson
+    except ImportError:
+        return lambda usage: as_json_line(usage).encode()
 
+    def encode(usage):
+        line = orjson.dumps(usage)
+        if line.isascii() and b"\x7f" not in line:
+            return line
+        return as_json_line(usage).encode()
 
-async def output_to_file(all_usages, output_file):
-    from aiofile import async_open
+    return encode
+
+
+class BufferedLines:
+    """
+    Collects lines to write them out together, flushing once there's more than flush_size bytes or every
+    flush_interval seconds so output still streams when usages are only being found slowly
+
+    write is an async function taking the bytes to write
+    """
+
+    def __init__(self, write, flush_size=1024 * 1024, flush_interval=1.0):
+        self.write = write
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.lines = []
+        self.size = 0
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        self.flushing = asyncio.ensure_future(self.flush_every_interval())
+        return self
+
+    async def __aexit__(self, *exception):
+        # only once any flush that's already writing has finished, otherwise what it took would never be written
+        async with self.lock:
+            self.flushing.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.flushing
+        await self.flush()
+
+    async def add(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        if self.size >= self.flush_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.lines:
+                return
+            lines, self.lines, self.size = self.lines, [], 0
+            with stats.timed("output_flush"):
+                await self.write(b"".join(lines))
 
-    async with async_open(output_file, "w") as file:
+    async def flush_every_interval(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+async def output_newline_delimited_json(all_usages, write):
+    """
+    Usages that are still the json line a worker process output them as are written as they are
+    """
+    encode = json_line_encoder()
+    async with BufferedLines(write) as lines:
         async for usage in all_usages:
-            await file.write(f"{as_json_line(usage)}\n")
+            with stats.timed("output"):
+                if isinstance(usage, EncodedUsage):
+                    await lines.add(usage.json_line + b"\n")
+                else:
+                    await lines.add(encode(usage.to_dict()) + b"\n")
+
+
+output_formats = ["ndjson", "ndjson.gz", "ndjson.zst", "parquet"]
+
+
+def compressor_for(format):
+    """
+    Returns an object with compress and flush methods like zlib's for the compressed newline delimited json formats,
+    or None when it isn't compressed, zstandard is only needed when using it
+    """
+    if format == "ndjson.gz":
+        # the gzip format rather than a bare zlib stream so gunzip and zcat can read it
+        return zlib.compressobj(wbits=31)
+    if format == "ndjson.zst":
+        zstandard = import_extra("zstandard", "zstd")
+
+        return zstandard.ZstdCompressor().compressobj()
+    return None
+
+
+async def output_newline_delimited_json_in_format(all_usages, write, format):
+    compressor = compressor_for(format)
+    if compressor is None:
+        await output_newline_delimited_json(all_usages, write)
+        return
+
+    async def write_compressed(data):
+        with stats.timed("output_compress"):
+            data = compressor.compress(data)
+        if data:
+            await write(data)
 
+    await output_newline_delimited_json(all_usages, write_compressed)
+    await write(compressor.flush())
 
-async def output_to_sqlite(all_usages, database, table, batch_size):
+
+async def output_to_stdout(all_usages, format="ndjson"):
+    if format == "parquet":
+        raise ValueError("Parquet can only be output to a file", format)
+
+    sys.stdout.flush()
+
+    async def write(data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    await output_newline_delimited_json_in_format(all_usages, write, format)
+
+
+async def output_to_file(all_usages, output_file, format="ndjson", append=False):
+    """
+    Pass append=True to add to the end of the file rather than replacing it, which parquet can't be, gzip and zstd
+    both allow one compressed stream to follow another in the same file
+    """
+    if format == "parquet":
+        if append:
+            raise ValueError("Parquet can't be appended to", output_file)
+        await output_to_parquet(all_usages, output_file)
+        return
+
+    from aiofile import async_open
+
+    async with async_open(output_file, "ab" if append else "wb") as file:
+        await output_newline_delimited_json_in_format(all_usages, file.write, format)
+
+
+def parquet_schema(snapshots=False):
+    """
+    The same fields as each usage is output with as json, the columns with only a few distinct values are
+    dictionary encoded so each value is only stored once in each row group
     """
+    pyarrow = import_extra("pyarrow", "parquet")
+
+    words = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+
+    return pyarrow.schema(
+        [
+            ("repo", words),
+            ("component", words),
+            ("library", words),
+            ("labels", pyarrow.list_(words)),
+            ("template_language", words),
+            ("line_count", pyarrow.int64()),
+            ("parenthesis_count", pyarrow.int64()),
+            ("length", pyarrow.int64()),
+            ("repo_last_updated", pyarrow.string()),
+            (
+                "usage_example",
+                pyarrow.struct(
+                    [
+                        ("github_url", pyarrow.string()),
+                        ("line_number", pyarrow.int64()),
+                        ("code", pyarrow.string()),
+                        ("path", pyarrow.string()),
+                    ]
+                ),
+            ),
+            ("code", pyarrow.string()),
+            ("path", pyarrow.string()),
+            *([("snapshot_date", words)] if snapshots else []),
+        ]
+    )
+
+
+async def output_to_parquet(all_usages, output_file, row_group_size=50000):
+    """
+    Usages are written a row group at a time so only that many are ever held in memory, they're converted and
+    written from another thread so searches carry on in the meantime, pyarrow is only needed when using it
+    """
+    pyarrow = import_extra("pyarrow", "parquet")
+    parquet = import_extra("pyarrow.parquet", "parquet")
+
+    writer = None
+    loop = asyncio.get_running_loop()
+
+    def write(usages):
+        nonlocal writer
+        rows = [usage.to_dict() for usage in usages]
+        if writer is None:
+            # usages are all from snapshots or none of them are
+            writer = parquet.ParquetWriter(
+                output_file,
+                parquet_schema(snapshots="snapshot_date" in rows[0]),
+                compression="zstd",
+            )
+        writer.write_table(pyarrow.Table.from_pylist(rows, schema=writer.schema))
+
+    try:
+        chunked_usages = stream.chunks(all_usages, row_group_size)
+        async with chunked_usages.stream() as usages_stream:
+            async for usages in usages_stream:
+                with stats.timed("output"):
+                    await loop.run_in_executor(None, write, usages)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        # still a valid file when nothing was found
+        parquet.write_table(parquet_schema().empty_table(), output_file)
+
+
+# the same schema sqlite-utils infers from a usage, lists and dicts are stored as json text like it does too
+sqlite_columns = {
+    "repo": "TEXT",
+    "component": "TEXT",
+    "library": "TEXT",
+    "labels": "TEXT",
+    "template_language": "TEXT",
+    "line_count": "INTEGER",
+    "parenthesis_count": "INTEGER",
+    "length": "INTEGER",
+    "repo_last_updated": "TEXT",
+    "usage_example": "TEXT",
+    "code": "TEXT",
+    "path": "TEXT",
+}
+
+# usages found by find_usages.history are also tagged with the date of the snapshot they were found in
+sqlite_snapshot_columns = {**sqlite_columns, "snapshot_date": "TEXT"}
+
+sqlite_json_columns = {"labels", "usage_example"}
+
+# the code sample of each usage already rendered as html, so the datasette plugin can serve it without rendering it
+sqlite_rendered_columns = {"usage_example_html": "TEXT"}
+
+# for the facets in datasette
+sqlite_indexed_columns = ["component", "repo", "library", "labels"]
+
+sqlite_upsert_key = [
+    "repo",
+    "path",
+    "json_extract(usage_example, '$.line_number')",
+    "component",
+]
+
+
+def sqlite_row(usage, columns=sqlite_columns):
+    usage = usage.to_dict()
+    if "usage_example_html" in columns:
+        usage["usage_example_html"] = render_code_sample(usage["usage_example"])
+    return [
+        (
+            json.dumps(usage[column])
+            if column in sqlite_json_columns
+            else usage.get(column)
+        )
+        for column in columns
+    ]
+
+
+def sqlite_insert_statement(table, columns=sqlite_columns, upsert_key=None):
+    """
+    Pass upsert_key to update the existing row with the same key rather than inserting another
+    """
+    names = ", ".join(f"[{column}]" for column in columns)
+    placeholders = ", ".join("?" for _ in columns)
+    statement = f"""insert into "{table}" ({names}) values ({placeholders})"""
+    if upsert_key is not None:
+        updates = ", ".join(f"[{column}] = excluded.[{column}]" for column in columns)
+        statement += f" on conflict ({', '.join(upsert_key)}) do update set {updates}"
+    return statement
+
+
+class SqliteWriter(threading.Thread):
+    """
+    Writes usages into sqlite from its own thread so that searches carry on while rows are being inserted, batches
+    of usages are put on a bounded queue so if the writer falls behind then the searches wait rather than usages
+    piling up in memory, put None once there are no more
+
+    Indexes, and full text search of the code, are only created once all the usages are in as it's quicker than
+    keeping them up to date while inserting
+    """
+
+    def __init__(
+        self,
+        database,
+        table,
+        upsert=False,
+        transaction_size=50000,
+        columns=sqlite_columns,
+    ):
+        super().__init__(daemon=True)
+        self.database = database
+        self.table = table
+        self.upsert = upsert
+        self.columns = columns
+        # the same usage can be found in more than one snapshot
+        self.upsert_key = (
+            [*sqlite_upsert_key, "snapshot_date"]
+            if "snapshot_date" in columns
+            else sqlite_upsert_key
+        )
+        self.transaction_size = transaction_size
+        self.queue = queue.Queue(maxsize=16)
+        self.received_all_usages = False
+        self.error = None
+
+    def run(self):
+        try:
+            self.write()
+        except BaseException as e:
+            self.error = e
+            # so nothing is left waiting to put more usages on the queue
+            while not self.received_all_usages:
+                self.received_all_usages = self.queue.get() is None
+
+    def write(self):
+        connection = sqlite3.connect(self.database)
+        try:
+            connection.execute("pragma journal_mode = wal")
+            connection.execute("pragma synchronous = normal")
+            self.create_table(connection)
+
+            insert = self.insert_statement()
+            rows_in_transaction = 0
+            while True:
+                usages = self.queue.get()
+                if usages is None:
+                    self.received_all_usages = True
+                    break
+                with stats.timed("sqlite_insert"):
+                    connection.executemany(
+                        insert, [sqlite_row(u, self.columns) for u in usages]
+                    )
+                rows_in_transaction += len(usages)
+                if rows_in_transaction >= self.transaction_size:
+                    connection.commit()
+                    rows_in_transaction = 0
+            connection.commit()
+
+            with stats.timed("sqlite_index"):
+                self.create_indexes(connection)
+                connection.commit()
+        finally:
+            connection.close()
+
+    def create_table(self, connection):
+        connection.execute(
+            f"""create table if not exists "{self.table}" ("""
+            + ", ".join(f"[{column}] {type}" for column, type in self.columns.items())
+            + ")"
+        )
+        if self.upsert:
+            connection.execute(
+                f"""create unique index if not exists "{self.table}_upsert_key" """
+                f"""on "{self.table}" ({", ".join(self.upsert_key)})"""
+            )
+
+    def insert_statement(self):
+        return sqlite_insert_statement(
+            self.table, self.columns, self.upsert_key if self.upsert else None
+        )
+
+    def create_indexes(self, connection):
+        for column in [
+            *sqlite_indexed_columns,
+            *(["snapshot_date"] if "snapshot_date" in self.columns else []),
+        ]:
+            connection.execute(
+                f"""create index if not exists "idx_{self.table}_{column}" """
+                f"""on "{self.table}" ([{column}])"""
+            )
+        # the same as sqlite-utils enable-fts would create, which datasette knows how to search
+        connection.execute(
+            f"""create virtual table if not exists "{self.table}_fts" """
+            f"""using fts5 ([code], content=[{self.table}])"""
+        )
+        connection.execute(
+            f"""insert into "{self.table}_fts" ("{self.table}_fts") values ('rebuild')"""
+        )
+
+
+def columns_of(connection, table):
+    return [row[1] for row in connection.execute(f"""pragma table_info("{table}")""")]
+
+
+def replace_usages_in_sqlite(
+    database, table, usages, repos=(), templates=(), components=(), folders=()
+):
+    """
+    Deletes the usages of each of repos, each of templates given as (repo, path), each of components given as
+    (repo, component), and every template within each of folders given as (repo, path ending with a separator), and
+    inserts usages in their place all in one transaction, the full text search of the code is kept up to date when
+    there is one
+    """
+    connection = sqlite3.connect(database)
+    try:
+        with connection:
+            has_fts = (
+                connection.execute(
+                    "select 1 from sqlite_master where name = ?", (f"{table}_fts",)
+                ).fetchone()
+                is not None
+            )
+
+            deleting = [("repo = ?", (repo,)) for repo in repos] + [
+                ("repo = ? and path = ?", template) for template in templates
+            ]
+            deleting += [
+                ("repo = ? and component = ?", component) for component in components
+            ]
+            deleting += [
+                ("repo = ? and substr(path, 1, ?) = ?", (repo, len(folder), folder))
+                for repo, folder in folders
+            ]
+            for where, parameters in deleting:
+                if has_fts:
+                    # rows have to be deleted from an external content fts table by what was indexed
+                    connection.executemany(
+                        f"""insert into "{table}_fts" ("{table}_fts", rowid, [code]) values ('delete', ?, ?)""",
+                        connection.execute(
+                            f"""select rowid, [code] from "{table}" where {where}""",
+                            parameters,
+                        ).fetchall(),
+                    )
+                connection.execute(
+                    f"""delete from "{table}" where {where}""", parameters
+                )
+
+            columns = {
+                **sqlite_columns,
+                # kept up to date when the usages were output with them
+                **{
+                    column: kind
+                    for column, kind in sqlite_rendered_columns.items()
+                    if column in columns_of(connection, table)
+                },
+            }
+            insert = sqlite_insert_statement(table, columns)
+            for usage in usages:
+                row = connection.execute(insert, sqlite_row(usage, columns))
+                if has_fts:
+                    connection.execute(
+                        f"""insert into "{table}_fts" (rowid, [code]) values (?, ?)""",
+                        (row.lastrowid, usage.code),
+                    )
+    finally:
+        connection.close()
+
+
+async def put(onto_queue, item):
+    try:
+        onto_queue.put_nowait(item)
+    except queue.Full:
+        await asyncio.get_running_loop().run_in_executor(None, onto_queue.put, item)
+
+
+async def output_to_sqlite(
+    all_usages, database, table, batch_size, upsert=False, columns=sqlite_columns
+):
+    """
+    Pass upsert=True to update usages already in the table that are on the same line of the same template for the
+    same component rather than inserting them again, so you can search again into the same database, and
+    columns=sqlite_snapshot_columns when outputting usages found in the history of each repository
+
     If you need more flexibility you can output to stdout or file and pipe
     that into the sqlite-utils cli directly instead.
     """
-    from sqlite_utils import Database
+    writer = SqliteWriter(database, table, upsert=upsert, columns=columns)
+    writer.start()
+
+    try:
+        chunked_usages = stream.chunks(all_usages, batch_size)
+        async with chunked_usages.stream() as usages_stream:
+            async for usages in usages_stream:
+                if writer.error is not None:
+                    break
+                with stats.timed("output"):
+                    await put(writer.queue, usages)
+    finally:
+        await put(writer.queue, None)
+        await asyncio.get_running_loop().run_in_executor(None, writer.join)
+
+    if writer.error is not None:
+        raise writer.error
+
+
+def output_format_of(output_file, format=None):
+    """
+    The format given, otherwise the one the extension of output_file is for, so that each of several output files
+    can be written in its own format
+    """
+    if format is not None:
+        return format
+    if output_file.endswith(".parquet"):
+        return "parquet"
+    if output_file.endswith(".gz"):
+        return "ndjson.gz"
+    if output_file.endswith(".zst"):
+        return "ndjson.zst"
+    return "ndjson"
+
+
+async def put_unless_finished(onto_queue, item, output):
+    """
+    Returns whether item was put on the queue, which it won't be once output has finished reading from it, so a
+    failed output never leaves the others waiting on its full queue
+    """
+    try:
+        onto_queue.put_nowait(item)
+        return True
+    except asyncio.QueueFull:
+        pass
+
+    with stats.timed("output_tee_wait"):
+        putting = asyncio.ensure_future(onto_queue.put(item))
+        await asyncio.wait([putting, output], return_when=asyncio.FIRST_COMPLETED)
+    if not putting.done():
+        putting.cancel()
+        return False
+    return True
+
+
+async def tee(all_usages, *outputs, buffer_size=1000):
+    """
+    Outputs the one stream of usages to each of outputs at the same time, each an async function taking the usages
+    like the output_to_ functions with their other arguments given, so one search can be written to a file and to
+    sqlite without running it twice
+
+    Each output reads from its own queue of at most buffer_size usages, so an output that falls behind makes the
+    search wait rather than usages piling up in memory for it, how long is spent waiting is in output_tee_wait, if
+    any output fails the search is stopped and the others are given the usages so far before the error is raised
+    """
+    queues = [asyncio.Queue(maxsize=buffer_size) for _ in outputs]
+
+    async def usages_from(usages_queue):
+        while True:
+            usage = await usages_queue.get()
+            if usage is None:
+                return
+            yield usage
+
+    writing = [
+        asyncio.ensure_future(output(usages_from(usages_queue)))
+        for output, usages_queue in zip(outputs, queues)
+    ]
 
-    db = Database(database, recreate=False)
+    try:
+        async with stream.iterate(all_usages).stream() as usages_stream:
+            async for usage in usages_stream:
+                if any(
+                    output.done() and output.exception() is not None
+                    for output in writing
+                ):
+                    break
+                for usages_queue, output in zip(queues, writing):
+                    await put_unless_finished(usages_queue, usage, output)
+    finally:
+        for usages_queue, output in zip(queues, writing):
+            await put_unless_finished(usages_queue, None, output)
+        results = await asyncio.gather(*writing, return_exceptions=True)
 
-    chunked_usages = stream.chunks(all_usages, batch_size)
-    async with chunked_usages.stream() as usages_stream:
-        async for usages in usages_stream:
-            db[table].insert_all(usages, batch_size=batch_size)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
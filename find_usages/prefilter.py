@@ -0,0 +1,182 @@
+"""
+Finds which templates mention each component by name before running any of the search strategies, the regexp they
+use are expensive to run and most templates only use a handful of components, so the strategies only need to search
+the templates that are candidates for the components they're looking for
+
+Every search strategy needs the name of the component, or its class name, to appear somewhere in a template for
+it to find a usage there, so searching only the candidates finds the same usages as searching everything
+"""
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+
+from find_usages.python_engine import compiled, read_template, templates_in
+from find_usages.ripgrep import match_name
+from find_usages.utils import list_repos, run, template_extensions
+
+
+def names_of(components):
+    """
+    Returns a dict of every name a component could be mentioned by, the name of the component itself or its class
+    name, to the component, longest first
+    """
+    names = {
+        f"{case(component[0])}{component[1:]}": component
+        for component in components
+        for case in [str.lower, str.upper]
+    }
+    return {name: names[name] for name in sorted(names, key=len, reverse=True)}
+
+
+def names_within(names):
+    """
+    Returns a dict of each name to every name found inside it, including itself, only the longest of any names
+    that match at the same place is found so a mention of one name can also be a mention of those within it
+    """
+    return {name: [other for other in names if other in name] for name in names}
+
+
+async def find_candidates_in_repo_using_ripgrep(in_search_path, repo, of_components):
+    """
+    Fixed strings let ripgrep search for all of the names at once with a multi literal matcher rather than a regexp
+    engine, it exits with 1 when nothing is found which isn't an error here
+    """
+    names = names_of(of_components)
+    within = names_within(names)
+    globs = " ".join(f"--glob '**/*{extension}'" for extension in template_extensions)
+    regexps = " ".join(f"--regexp '{name}'" for name in names)
+
+    mentions = set()
+    async for mention in run(
+        f"rg --fixed-strings --only-matching --no-line-number --with-filename {globs} {regexps} ./{repo}"
+        f" || [ $? -eq 1 ]",
+        working_dir=in_search_path,
+        check=True,
+    ):
+        path, name = mention.decode().rstrip("\n").rsplit(":", 1)
+        for mentioned in within[name]:
+            mentions.add((names[mentioned], path[len("./") :]))
+
+    return mentions
+
+
+async def find_candidates_in_repo_using_python(in_search_path, repo, of_components):
+    names = names_of(of_components)
+    within = names_within(names)
+    regexp = compiled(match_name(*names))
+
+    mentions = set()
+    async for path in templates_in(in_search_path, [repo]):
+        try:
+            contents = read_template(os.path.join(in_search_path, path))
+        except FileNotFoundError:
+            continue
+        if contents is None:
+            continue
+        for name in {match.group().decode() for match in regexp.finditer(contents)}:
+            for mentioned in within[name]:
+                mentions.add((names[mentioned], path))
+
+    return mentions
+
+
+def open_index(index):
+    database = sqlite3.connect(index)
+    with database:
+        database.execute(
+            "create table if not exists repos (repo text primary key, key text not null)"
+        )
+        database.execute(
+            "create table if not exists candidates (repo text, component text, path text)"
+        )
+        database.execute(
+            "create index if not exists candidates_repo on candidates (repo)"
+        )
+    return database
+
+
+async def find_candidates(
+    in_search_path, of_components, engine="ripgrep", in_repos=None, index=None
+):
+    """
+    Returns a dict of each component to a sorted list of the templates it's mentioned in, relative to the search
+    path, components that aren't mentioned anywhere are left out
+
+    Pass index as the path of a sqlite database to keep the candidates found in each repository between runs, they're
+    reused while the repository has the same tree checked out and is searched for the same components
+    """
+    from find_usages.cache import get_git_repo_tree
+
+    find_candidates_in_repo = (
+        find_candidates_in_repo_using_python
+        if engine == "python"
+        else find_candidates_in_repo_using_ripgrep
+    )
+
+    repos = list_repos(in_search_path, in_repos)
+
+    keys = {}
+    indexed = set()
+    if index is not None:
+        components = hashlib.sha256("\n".join(sorted(of_components)).encode())
+        trees = await asyncio.gather(
+            *[get_git_repo_tree(os.path.join(in_search_path, repo)) for repo in repos]
+        )
+        keys = {
+            repo: f"{tree}:{components.hexdigest()}"
+            for repo, tree in zip(repos, trees)
+            if tree is not None
+        }
+        database = open_index(index)
+        indexed_keys = dict(database.execute("select repo, key from repos"))
+        indexed = {repo for repo in keys if indexed_keys.get(repo) == keys[repo]}
+
+    repos_to_search = [repo for repo in repos if repo not in indexed]
+
+    # every search is left to finish before any error is raised, so none are left running, or waiting for a slot in
+    # the scheduler, once the caller has given up
+    found_in_each_repo = await asyncio.gather(
+        *[
+            find_candidates_in_repo(in_search_path, repo, of_components)
+            for repo in repos_to_search
+        ],
+        return_exceptions=True,
+    )
+    for found in found_in_each_repo:
+        if isinstance(found, BaseException):
+            raise found
+
+    mentions = set()
+    for found in found_in_each_repo:
+        mentions.update(found)
+
+    if index is not None:
+        for repo in sorted(indexed):
+            mentions.update(
+                database.execute(
+                    "select component, path from candidates where repo = ?", (repo,)
+                )
+            )
+
+        with database:
+            for repo, found in zip(repos_to_search, found_in_each_repo):
+                if repo not in keys:
+                    continue
+                database.execute("delete from candidates where repo = ?", (repo,))
+                database.execute(
+                    "insert or replace into repos (repo, key) values (?, ?)",
+                    (repo, keys[repo]),
+                )
+                database.executemany(
+                    "insert into candidates (repo, component, path) values (?, ?, ?)",
+                    [(repo, component, path) for component, path in found],
+                )
+
+        database.close()
+
+    candidates = {}
+    for component, path in sorted(mentions):
+        candidates.setdefault(component, []).append(path)
+    return candidates
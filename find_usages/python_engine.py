@@ -0,0 +1,458 @@
+"""
+Search functions that find the same usages as the ripgrep pipelines in core but do it in process, each template
+is read once and every search strategy runs against its contents using the same regexp composed in ripgrep.py
+"""
+
+import asyncio
+import contextlib
+import functools
+import mmap
+import os
+import time
+
+import regex
+
+from find_usages.core import create_usage
+from find_usages.ripgrep import (
+    match_alias_including_class_name,
+    match_any_params,
+    match_instantiation_and_use_as_argument,
+    match_instantiation_and_use_immediately,
+    match_name,
+    match_optional_package,
+    match_usages_not_instantiations,
+    without_recursion,
+)
+from find_usages.guardrails import guardrails, skip
+from find_usages.stats import instrumented, stats
+from find_usages.utils import (
+    first_match_of_each_group,
+    identify_alias,
+    identify_component,
+    identify_components_assigned,
+    identify_language,
+    template_extensions,
+)
+
+# smaller files are cheaper to read into memory than to map
+read_files_larger_than_this_using_mmap = 1024 * 1024
+
+
+@functools.lru_cache(maxsize=None)
+def compiled(regexp):
+    """
+    Patterns are compiled as bytes so that like ripgrep with --no-pcre2-unicode they only match ascii word
+    characters, they're cached so each pattern is compiled once however many files it's run against
+    """
+    return regex.compile(regexp.encode())
+
+
+class Limits:
+    """
+    Limits for the template being searched, templates are searched without awaiting anything in between so only one
+    is ever being searched at a time
+    """
+
+    def __init__(self):
+        self.deadline = None
+        self.fallback = False
+
+    @contextlib.contextmanager
+    def searching(self, seconds, fallback=False):
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+        self.fallback = fallback
+        try:
+            yield
+        finally:
+            self.deadline = None
+            self.fallback = False
+
+    def time_left(self):
+        if self.deadline is None:
+            return None
+        # no time left at all would mean no limit
+        return max(self.deadline - time.monotonic(), 0.001)
+
+
+limits = Limits()
+
+
+def matches_in(contents, regexp):
+    """
+    Yields (first line, last line, code) for every match of regexp in contents, raises TimeoutError when the
+    template being searched runs out of time
+    """
+    if limits.fallback:
+        regexp = without_recursion(regexp)
+    line_number = 1
+    counted_up_to = 0
+    for match in compiled(regexp).finditer(contents, timeout=limits.time_left()):
+        line_number += contents[counted_up_to : match.start()].count(b"\n")
+        counted_up_to = match.start()
+        code = match.group().decode(errors="replace")
+        yield line_number, line_number + code.rstrip("\n").count("\n"), code
+
+
+def matches_of_components(contents, regexp, components):
+    """
+    Yields (component, first line, last line, code) for every match of regexp in contents
+    """
+    for first_line, last_line, code in matches_in(contents, regexp):
+        component = identify_component(code, components)
+        if component is not None:
+            yield component, first_line, last_line, code
+
+
+def matches_per_component(contents, regexp, components):
+    """
+    Yields (component, line number, code) for the same matches ripgrep would have output for each component
+    """
+    return first_match_of_each_group(
+        matches_of_components(contents, regexp, components)
+    )
+
+
+def matches_of_alias(contents, alias):
+    return first_match_of_each_group(
+        (alias, first_line, last_line, code)
+        for first_line, last_line, code in matches_in(
+            contents, match_usages_not_instantiations(alias)
+        )
+    )
+
+
+def aliases_in(contents, components):
+    """
+    Returns a list of each distinct (component, alias, labels) injected or assigned in contents, both are found in
+    one pass over the contents for all of the components
+    """
+    aliases = {}
+    for component, _, _, code in matches_of_components(
+        contents, match_alias_including_class_name(*components), components
+    ):
+        alias, labels = identify_alias(code)
+        aliases[(component, alias, labels)] = None
+    return list(aliases)
+
+
+def usages_of_aliases(contents, aliases):
+    """
+    Yields (component, line number, code, labels) for every use of each of the (component, alias, labels) in
+    contents, each alias is searched for separately so that the use of one alias within the parameters of another
+    is still found, and only once however many components it's an alias of
+    """
+    matches = {}
+    for component, alias, labels in aliases:
+        if alias not in matches:
+            matches[alias] = list(matches_of_alias(contents, alias))
+        for _, line_number, code in matches[alias]:
+            yield component, line_number, code, labels
+
+
+def labelled(matches, labels):
+    for component, line_number, code in matches:
+        yield component, line_number, code, labels
+
+
+def usages_via_deprecated_static_helper(contents, components):
+    assigned_or_injected = {
+        component
+        for regexp in [
+            rf"{match_name(*components)}\s+=",
+            rf"{match_name(*components)} *:",
+        ]
+        for _, _, code in matches_in(contents, regexp)
+        for component in identify_components_assigned(code, components)
+    }
+
+    for component, line_number, code in matches_per_component(
+        contents,
+        rf"(new)? *{match_optional_package}{match_name(*components)}({match_any_params(2)})",
+        components,
+    ):
+        if component not in assigned_or_injected and not code.startswith("new"):
+            yield component, line_number, code, ["via-deprecated-static-helper"]
+
+
+def twirl_strategies(contents, components):
+    """
+    Returns a generator of (component, line number, code, labels) for each search strategy run against a twirl
+    template, every usage a strategy finds has the same labels, and it only searches as far as it's read
+    """
+    aliases = aliases_in(contents, components)
+
+    return [
+        *[
+            usages_of_aliases(
+                contents, [alias for alias in aliases if alias[2] == labels]
+            )
+            for labels in dict.fromkeys(labels for _, _, labels in aliases)
+        ],
+        labelled(
+            matches_per_component(
+                contents,
+                match_instantiation_and_use_immediately(*components),
+                components,
+            ),
+            ["via-inline-instantiation", "used-immediately"],
+        ),
+        labelled(
+            matches_per_component(
+                contents,
+                match_instantiation_and_use_as_argument(*components),
+                components,
+            ),
+            ["via-inline-instantiation", "used-as-argument"],
+        ),
+        usages_via_deprecated_static_helper(contents, components),
+    ]
+
+
+def nunjucks_strategies(contents, components):
+    return [
+        labelled(
+            matches_per_component(
+                contents,
+                rf"{match_name(*components)}({match_any_params()})",
+                components,
+            ),
+            [],
+        )
+    ]
+
+
+def strategies_for_template(contents, path, components):
+    if identify_language(path) == "nunjucks":
+        return nunjucks_strategies(contents, components)
+    return twirl_strategies(contents, components)
+
+
+def groups_of(components, single_pass=False):
+    """
+    When single_pass is True the regexp for all components are combined and run once, otherwise they're run for
+    each component separately like the ripgrep pipelines do
+    """
+    if single_pass:
+        return [tuple(components)]
+    return [(component,) for component in components]
+
+
+def find_usages_in_template_for_each(contents, path, components, single_pass=False):
+    """
+    Yields (component, line number, code, labels) for all the usages of the components in a template, see
+    groups_of for single_pass
+    """
+    for group in groups_of(components, single_pass):
+        for strategy in strategies_for_template(contents, path, group):
+            for component, line_number, code, labels in strategy:
+                yield component, line_number, code, [*labels]
+
+
+def ways_used_in_template_for_each(contents, path, components, single_pass=False):
+    """
+    Yields (component, labels) once for each way each of the components is used in a template, which is cheaper
+    than finding every usage as each strategy stops searching the template once it's found all of the components,
+    the labels don't include any that depend on the code of each usage
+    """
+    for group in groups_of(components, single_pass):
+        for strategy in strategies_for_template(contents, path, group):
+            found = set()
+            for component, _, _, labels in strategy:
+                if component not in found:
+                    found.add(component)
+                    yield component, (*labels,)
+                if len(found) == len(group):
+                    break
+
+
+def search_within_limits(search, contents, path):
+    """
+    Returns a list of what search(contents) yields within the limits set in find_usages.guardrails, templates that
+    take too long are searched again with patterns that can't backtrack catastrophically but only match brackets
+    nested a few deep, and anything skipped is recorded as such
+    """
+    if guardrails.max_filesize is not None and len(contents) > guardrails.max_filesize:
+        skip("too_big", path, size=len(contents))
+        return []
+
+    def search_with(fallback=False):
+        with limits.searching(guardrails.file_timeout, fallback):
+            return list(search(contents))
+
+    try:
+        return search_with()
+    except TimeoutError:
+        pass
+
+    try:
+        found = search_with(fallback=True)
+        skip("timeout", path, seconds=guardrails.file_timeout, fallback="searched")
+        return found
+    except TimeoutError:
+        skip("timeout", path, seconds=guardrails.file_timeout, fallback="timed out")
+        return []
+
+
+def find_usages_in_template_within_limits(
+    contents, path, components, single_pass=False
+):
+    """
+    Returns a list of what find_usages_in_template_for_each yields, see search_within_limits
+    """
+    return search_within_limits(
+        lambda contents: find_usages_in_template_for_each(
+            contents, path, components, single_pass
+        ),
+        contents,
+        path,
+    )
+
+
+def ways_used_in_template_within_limits(contents, path, components, single_pass=False):
+    """
+    Returns a list of what ways_used_in_template_for_each yields, see search_within_limits
+    """
+    return search_within_limits(
+        lambda contents: ways_used_in_template_for_each(
+            contents, path, components, single_pass
+        ),
+        contents,
+        path,
+    )
+
+
+def usages_of_aliases_within_limits(contents, path, aliases):
+    """
+    Returns a list of what usages_of_aliases yields, see search_within_limits
+    """
+    return search_within_limits(
+        lambda contents: usages_of_aliases(contents, aliases), contents, path
+    )
+
+
+def read_template(path):
+    """
+    Returns None for binary files, which ripgrep would skip
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size > read_files_larger_than_this_using_mmap:
+            contents = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            contents = file.read()
+    return None if contents.find(b"\0") != -1 else contents
+
+
+async def list_files_not_ignored_by_git(repo_path):
+    process = await asyncio.create_subprocess_exec(
+        "git",
+        "ls-files",
+        "-z",
+        "--cached",
+        "--others",
+        "--exclude-standard",
+        cwd=repo_path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+
+    stdout, _ = await process.communicate()
+
+    if process.returncode != 0:
+        return None
+
+    return [path for path in stdout.decode().split("\0") if path]
+
+
+def list_files_not_hidden(repo_path):
+    for folder, sub_folders, files in os.walk(repo_path):
+        sub_folders[:] = [name for name in sub_folders if not name.startswith(".")]
+        for name in files:
+            if not name.startswith("."):
+                yield os.path.relpath(os.path.join(folder, name), repo_path)
+
+
+async def templates_in(search_path, in_repos=None):
+    """
+    Yields the path of every template relative to the search path, like ripgrep this skips files that are hidden
+    or ignored by git, asking git for each repository's files rather than parsing .gitignore ourselves
+    """
+    for entry in sorted(os.scandir(search_path), key=lambda entry: entry.name):
+        if entry.name.startswith("."):
+            continue
+        if in_repos is not None and entry.name not in in_repos:
+            continue
+        if entry.is_file() and entry.name.endswith(template_extensions):
+            yield entry.name
+        if not entry.is_dir():
+            continue
+
+        with stats.timed("list_files"):
+            files = await list_files_not_ignored_by_git(entry.path)
+        if files is None:
+            files = list_files_not_hidden(entry.path)
+
+        for path in files:
+            if path.endswith(template_extensions) and not any(
+                part.startswith(".") for part in path.split("/")
+            ):
+                yield os.path.join(entry.name, path)
+
+
+async def templates_and_components_to_search_for(
+    in_search_path, of_components, in_repos=None, candidates=None
+):
+    """
+    Yields (path, components) for every template, unless given candidates from find_usages.prefilter then only the
+    templates that mention one of the components are searched and only for those it mentions
+    """
+    if candidates is None:
+        async for path in templates_in(in_search_path, in_repos):
+            yield path, of_components
+        return
+
+    mentioned_in = {}
+    for component in of_components:
+        for path in candidates.get(component, []):
+            mentioned_in.setdefault(path, []).append(component)
+
+    for path in sorted(mentioned_in):
+        yield path, mentioned_in[path]
+
+
+@instrumented("python-engine")
+async def find_all_usages_for_all_components(
+    in_search_path, of_components, single_pass=False, in_repos=None, candidates=None
+):
+    """
+    When single_pass is True the regexp for all components are combined and run once against each template,
+    otherwise they're run for each component separately like the ripgrep pipelines do
+    """
+    async for path, components in templates_and_components_to_search_for(
+        in_search_path, of_components, in_repos, candidates
+    ):
+        try:
+            with stats.timed("read_template"):
+                contents = read_template(os.path.join(in_search_path, path))
+        except FileNotFoundError:
+            # listed by git but deleted from the checkout
+            continue
+
+        if contents is None:
+            continue
+
+        for (
+            component,
+            line_number,
+            code,
+            labels,
+        ) in find_usages_in_template_within_limits(
+            contents, path, components, single_pass
+        ):
+            yield await create_usage(
+                path,
+                line_number,
+                code,
+                component,
+                in_search_path,
+                labels=labels,
+            )
@@ -0,0 +1,42 @@
+"""
+Renders the code sample of a usage as html for the datasette plugin in datasette/plugins, either as each cell is
+shown or once when the usages are output to sqlite so the plugin can serve it as it is
+"""
+
+import html
+import json
+
+code_sample = """<dl class="render-code-sample">
+    <dt>
+        <pre style="counter-reset: line {counter};">{escaped_code}</pre>
+    </dt>
+    <dd>
+        <a class="render-code-sample_github-permalink" title="View on GitHub" href="{github_url}">
+            <span class="render-code-sample_visually-hidden">permalink to source code</span>
+            <span aria-hidden="true">{file_path}#L{line_number}</span>
+        </a>
+    </dd>
+</dl>"""
+
+
+def escaped_code_lines(code):
+    # each line is its own element so we can show line numbers
+    return "\n".join(f"<code>{html.escape(line)}</code>" for line in code.split("\n"))
+
+
+def render_code_sample(usage_example):
+    """
+    Takes the usage_example of a usage, as a dict or the json text it's stored as in sqlite
+    """
+    if isinstance(usage_example, str):
+        usage_example = json.loads(usage_example)
+
+    # TODO maybe capture the complete first line if not an argument and use dedent to remove common whitespace
+
+    return code_sample.format(
+        counter=usage_example["line_number"] - 1,
+        escaped_code=escaped_code_lines(usage_example["code"]),
+        github_url=html.escape(usage_example["github_url"]),
+        file_path=html.escape(usage_example["path"]),
+        line_number=usage_example["line_number"],
+    )
@@ -2,6 +2,9 @@
 Module abstracts all ripgrep commands and regexp composed by core search functions
 """
 
+import shlex
+
+from find_usages.guardrails import guardrails
 
 using_jq_select_only_matches = r"""jq --compact-output 'select(.type == "match")'"""
 
@@ -12,43 +15,100 @@ using_ripgrep_with_common_params = (
 )
 
 
-def search_using_ripgrep(regexp, output):
+def search_using_ripgrep(regexp, output, within=None):
     """
     Wrapper so we can say compose things as "search for X output as Y" rather than "output as Y things that match X"
     """
-    return output(regexp)
+    return output(regexp, within=within)
 
 
-def output_matches_as_json(regexp):
+def ripgrep_with_common_params():
+    """
+    Templates bigger than the limit in find_usages.guardrails are skipped
+    """
+    if guardrails.max_filesize is None:
+        return using_ripgrep_with_common_params
     return (
-        rf"""{using_ripgrep_with_common_params} --regexp '{regexp}' --glob '**/*.scala.html' --json ."""
-        rf""" | {using_jq_select_only_matches}"""
+        f"{using_ripgrep_with_common_params} --max-filesize {guardrails.max_filesize}"
     )
 
 
-def output_newline_delimited_lists_of_files_grouped_by_matches(
-    regexp, field_separator=":"
-):
+def ripgrep(within=None):
+    """
+    Searches are run from the search path, either across everything in it or only within the given paths, which can
+    be repositories or candidate files, there can be too many of those to pass as arguments so xargs reads them
+    from stdin and passes them on to ripgrep in batches
+    """
+    if within is None:
+        return ripgrep_with_common_params()
+    return f"xargs --no-run-if-empty {ripgrep_with_common_params()}"
+
+
+def search_paths(within=None):
+    """
+    Goes at the end of the ripgrep command, when searching within paths they're appended by xargs
+    """
+    return "." if within is None else ""
+
+
+def paths_to_search(within=None):
+    """
+    Lines to write to stdin of a search within paths, which should then be passed as files_to_search to run
+    """
+    if within is None:
+        return None
+    return [shlex.quote(f"./{path}") for path in within]
+
+
+def output_matches_as_json(regexp, within=None):
     return (
-        rf"""{using_ripgrep_with_common_params} --regexp '{regexp}' --glob '**/*.scala.html' ."""
-        rf""" | datamash --field-separator '{field_separator}' --sort --group 2 collapse 1"""
+        rf"""{ripgrep(within)} --regexp '{regexp}' --glob '**/*.scala.html' --json {search_paths(within)}"""
+        rf""" | {using_jq_select_only_matches}"""
     )
 
 
-def search_using_ripgrep_for_usages_via_deprecated_static_helper(component):
+def search_using_ripgrep_for_usages_via_deprecated_static_helper(
+    component, within=None
+):
     match_assigned_inline = rf"{component}\s+="
     match_assigned_via_injection = rf"{component} *:"
 
     return (
-        rf"""{using_ripgrep_with_common_params} --regexp '{match_assigned_inline}' --regexp '{match_assigned_via_injection}' --files-without-match --glob "**/*.scala.html" ."""
-        rf""" | xargs --no-run-if-empty {using_ripgrep_with_common_params} '(new)? *{match_optional_package}{component}({match_any_params(2)})' --json"""
+        rf"""{ripgrep(within)} --regexp '{match_assigned_inline}' --regexp '{match_assigned_via_injection}' --files-without-match --glob "**/*.scala.html" {search_paths(within)}"""
+        rf""" | xargs --no-run-if-empty {ripgrep_with_common_params()} '(new)? *{match_optional_package}{component}({match_any_params(2)})' --json"""
         rf""" | {using_jq_select_only_matches_that_are_not_being_instantiated_inline}"""
     )
 
 
-def search_using_ripgrep_for_usages_via_nunjucks(of_component):
+def search_using_ripgrep_for_any_components_assigned_or_injected(
+    *components, within=None
+):
+    """
+    Combined version of the first step of search_using_ripgrep_for_usages_via_deprecated_static_helper, rather than
+    listing the files without a match it outputs every match so we can tell which components each file assigns
+    """
+    return (
+        rf"""{ripgrep(within)} --regexp '{match_name(*components)}\s+=' --regexp '{match_name(*components)} *:' --glob "**/*.scala.html" --json {search_paths(within)}"""
+        rf""" | {using_jq_select_only_matches}"""
+    )
+
+
+def search_using_ripgrep_for_any_usages_via_deprecated_static_helper(
+    *components, within=None
+):
+    """
+    Combined version of the second step of search_using_ripgrep_for_usages_via_deprecated_static_helper, searches all
+    files so matches in files that assign or inject the component need to be filtered out afterwards
+    """
+    return (
+        rf"""{ripgrep(within)} '(new)? *{match_optional_package}{match_name(*components)}({match_any_params(2)})' --glob "**/*.scala.html" --json {search_paths(within)}"""
+        rf""" | {using_jq_select_only_matches}"""
+    )
+
+
+def search_using_ripgrep_for_usages_via_nunjucks(*components, within=None):
     return (
-        rf"""{using_ripgrep_with_common_params} --regexp '{of_component}({match_any_params()})' --glob "**/*.njk" --json ."""
+        rf"""{ripgrep(within)} --regexp '{match_name(*components)}({match_any_params()})' --glob "**/*.njk" --json {search_paths(within)}"""
         rf""" | {using_jq_select_only_matches}"""
     )
 
@@ -65,25 +125,86 @@ def match_any_params(group=1):
     return rf"\((?:[^)(]*(?{group})?)*+\)"
 
 
-def match_class_name(component):
-    return rf"""[{component[0].lower()}{component[0].upper()}]{component[1:]}"""
+def match_params_without_recursion(depth=3):
+    """
+    Cheaper to match than match_any_params as it can't backtrack catastrophically, but only matches parameters with
+    brackets nested up to depth deep
+    """
+    params = r"\([^)(]*+\)"
+    for _ in range(depth - 1):
+        params = rf"\((?:[^)(]++|{params})*+\)"
+    return params
+
+
+def without_recursion(regexp):
+    """
+    Fallback for regexp composed with match_any_params for when it takes too long
+    """
+    for group in [1, 2]:
+        regexp = regexp.replace(
+            match_any_params(group), match_params_without_recursion()
+        )
+    return regexp
+
+
+def match_name(*components):
+    """
+    Given more than one component the names are combined into a single alternation so one search can look for all
+    of them at once, it's non-capturing so that the group indexes used by match_any_params stay the same
+    """
+    if len(components) == 1:
+        return components[0]
+    return rf"""(?:{"|".join(components)})"""
+
+
+def match_class_name(*components):
+    return match_name(
+        *[
+            rf"""[{component[0].lower()}{component[0].upper()}]{component[1:]}"""
+            for component in components
+        ]
+    )
+
+
+def match_injection(*components):
+    return rf"""\w+(?=\s*:\s*{match_optional_package}{match_class_name(*components)}[,\s\)])"""
+
 
+def match_injection_including_class_name(*components):
+    """
+    Same as match_injection but the class name is kept in the match so that we can tell which component the alias
+    was injected for when searching for more than one component at once
+    """
+    return rf"""\w+\s*:\s*{match_optional_package}{match_class_name(*components)}(?=[,\s\)])"""
 
-def match_injection(component):
-    return rf"""\w+(?=\s*:\s*{match_optional_package}{match_class_name(component)}[,\s\)])"""
 
+def match_instantiation_and_use_immediately(*components):
+    return rf"""new\s*{match_optional_package}{match_class_name(*components)}({match_any_params()})({match_any_params(2)})"""
 
-def match_instantiation_and_use_immediately(component):
-    return rf"""new\s*{match_optional_package}{match_class_name(component)}({match_any_params()})({match_any_params(2)})"""
 
+def match_instantiation_and_use_as_argument(*components):
+    return rf"""(?<=[^@][\({{,])\s*new\s*{match_optional_package}{match_class_name(*components)}({match_any_params()})(?=[^\(])"""
 
-def match_instantiation_and_use_as_argument(component):
-    return rf"""(?<=[^@][\({{,])\s*new\s*{match_optional_package}{match_class_name(component)}({match_any_params()})(?=[^\(])"""
 
+def match_instantiation_and_assignment(*components):
+    return rf"""(?<=@)\w+(?=\s+=\s+@{{\s*new\s+{match_optional_package}{match_class_name(*components)}({match_any_params()})[^/(])"""
 
-def match_instantiation_and_assignment(component):
-    return rf"""(?<=@)\w+(?=\s+=\s+@{{\s*new\s+{match_optional_package}{match_class_name(component)}({match_any_params()})[^/(])"""
+
+def match_instantiation_and_assignment_including_class_name(*components):
+    """
+    Same as match_instantiation_and_assignment but the class name is kept in the match so that we can tell which
+    component the alias was assigned for when searching for more than one component at once
+    """
+    return rf"""(?<=@)\w+\s+=\s+@{{\s*new\s+{match_optional_package}{match_class_name(*components)}(?=({match_any_params()})[^/(])"""
+
+
+def match_alias_including_class_name(*components):
+    """
+    Matches both injections and assignments so every alias can be found in one pass, the injection comes first as it
+    has no groups of its own so the group index match_any_params uses within the assignment stays the same
+    """
+    return rf"""{match_injection_including_class_name(*components)}|{match_instantiation_and_assignment_including_class_name(*components)}"""
 
 
-def match_usages_not_instantiations(component):
-    return rf"""(?<!\w)(?<!new )(?<!new  ){component}({match_any_params()})"""
+def match_usages_not_instantiations(*components):
+    return rf"""(?<!\w)(?<!new )(?<!new  ){match_name(*components)}({match_any_params()})"""
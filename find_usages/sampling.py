@@ -0,0 +1,93 @@
+"""
+Keeps only a few examples of each component rather than every usage, for when a handful is all that's needed like
+the examples shown in datasette
+
+Once a component has enough examples its searches still waiting in the scheduler are stopped from starting and any
+that are running are killed, and once every component has enough everything still running is killed, so a search
+for examples finishes long before a search for every usage would
+"""
+
+from aiostream import stream
+
+from find_usages.utils import (
+    list_repos,
+    repo_name_of,
+    scheduler,
+    stop_searches_in_queue,
+    terminate_all_subprocesses,
+)
+
+
+class Examples:
+    """
+    Counts the examples kept of each component, or of each component in each of repos when given the names of the
+    repositories being searched
+    """
+
+    def __init__(self, max_per_component, repos=None):
+        self.max_per_component = max_per_component
+        self.repos = repos
+        self.kept = {}
+        self.enough = set()
+
+    def key_of(self, usage):
+        return usage.component if self.repos is None else (usage.component, usage.repo)
+
+    def keep(self, usage):
+        """
+        Returns whether usage should be kept as an example, counting it if it is
+        """
+        key = self.key_of(usage)
+        if self.kept.get(key, 0) >= self.max_per_component:
+            return False
+
+        self.kept[key] = self.kept.get(key, 0) + 1
+        if self.has_enough(usage.component):
+            self.enough.add(usage.component)
+        return True
+
+    def has_enough(self, component):
+        if self.repos is None:
+            return self.kept.get(component, 0) >= self.max_per_component
+        return all(
+            self.kept.get((component, repo), 0) >= self.max_per_component
+            for repo in self.repos
+        )
+
+
+async def sampled(
+    usages, in_search_path, of_components, max_examples, per_repo=False, in_repos=None
+):
+    """
+    Yields at most max_examples usages of each component, or of each component in each repository when per_repo,
+    searches for each component are stopped as soon as it has enough, which only the searches run for each component
+    separately can be, otherwise they run until every component has enough
+    """
+    examples = Examples(
+        max_examples,
+        (
+            [repo_name_of(repo) for repo in list_repos(in_search_path, in_repos)]
+            if per_repo
+            else None
+        ),
+    )
+
+    stopped = []
+    try:
+        async with stream.iterate(usages).stream() as usages_stream:
+            async for usage in usages_stream:
+                if not examples.keep(usage):
+                    continue
+
+                if usage.component in examples.enough:
+                    stop_searches_in_queue(usage.component)
+                    stopped.append(usage.component)
+
+                yield usage
+
+                if examples.enough.issuperset(of_components):
+                    terminate_all_subprocesses()
+                    return
+    finally:
+        for component in stopped:
+            scheduler.resume(component)
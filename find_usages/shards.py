@@ -0,0 +1,187 @@
+"""
+Splits a search across several machines, each one searches just the repositories in its shard and the outputs of
+all the shards are merged back together afterwards
+
+Repositories are assigned to shards by a hash of their name so that every machine agrees on which shard a
+repository is in without needing to see the same listing of the search path, or even to have checked out the
+repositories that aren't in its own shard
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import sqlite3
+
+from find_usages.usage import Usage, github_url_commit
+from find_usages.utils import import_extra, list_repos
+
+
+def parse_shard(shard):
+    """
+    Parses INDEX/COUNT, where INDEX counts from 1 up to COUNT, into a tuple of (index, count)
+    """
+    try:
+        index, count = [int(part) for part in shard.split("/")]
+    except ValueError:
+        raise ValueError("Shard must be given as INDEX/COUNT, for example 1/4", shard)
+
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError("Shard index must be between 1 and the count", shard)
+
+    return index, count
+
+
+def in_shard(repo, index, count):
+    return int(hashlib.sha256(repo.encode()).hexdigest(), 16) % count == index - 1
+
+
+def list_repos_in_shard(in_search_path, index, count):
+    return [repo for repo in list_repos(in_search_path) if in_shard(repo, index, count)]
+
+
+def format_of(path):
+    """
+    Works out what a file of usages is from how it starts, so whatever it's called it can be read
+    """
+    with open(path, "rb") as file:
+        start = file.read(16)
+    if start == b"SQLite format 3\0":
+        return "sqlite"
+    if start.startswith(b"PAR1"):
+        return "parquet"
+    if start.startswith(b"\x1f\x8b"):
+        return "ndjson.gz"
+    if start.startswith(b"\x28\xb5\x2f\xfd"):
+        return "ndjson.zst"
+    return "ndjson"
+
+
+def read_usages_from_sqlite(path, table):
+    """
+    sqlite-utils stores the lists and dicts in each usage as json text so they're parsed back into what was output
+    """
+    database = sqlite3.connect(path)
+    database.row_factory = sqlite3.Row
+    try:
+        for row in database.execute(f'select * from "{table}"'):
+            usage = dict(row)
+            for column in ["labels", "usage_example"]:
+                if isinstance(usage.get(column), str):
+                    usage[column] = json.loads(usage[column])
+            # rendered from the usage when it was output, not part of it
+            usage.pop("usage_example_html", None)
+            yield usage
+    finally:
+        database.close()
+
+
+def open_newline_delimited_json(path, format="ndjson"):
+    if format == "ndjson.gz":
+        return gzip.open(path, "rt")
+    if format == "ndjson.zst":
+        zstandard = import_extra("zstandard", "zstd")
+
+        # files appended to a batch at a time with --checkpoint are one frame after another
+        return io.TextIOWrapper(
+            zstandard.ZstdDecompressor().stream_reader(
+                open(path, "rb"), closefd=True, read_across_frames=True
+            )
+        )
+    return open(path)
+
+
+def read_usages_from_newline_delimited_json(path, format="ndjson"):
+    with open_newline_delimited_json(path, format) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_usages_from_parquet(path):
+    """
+    Read a row group at a time so only that many usages are ever held in memory
+    """
+    parquet = import_extra("pyarrow.parquet", "parquet")
+
+    parquet_file = parquet.ParquetFile(path)
+    for row_group in range(parquet_file.num_row_groups):
+        for usage in parquet_file.read_row_group(row_group).to_pylist():
+            if usage.get("snapshot_date") is None:
+                usage.pop("snapshot_date", None)
+            yield usage
+
+
+def read_usages(path, table="usages"):
+    """
+    Reads usages output as any of the formats in find_usages.outputs, or into sqlite
+    """
+    format = format_of(path)
+    if format == "sqlite":
+        return read_usages_from_sqlite(path, table)
+    if format == "parquet":
+        return read_usages_from_parquet(path)
+    return read_usages_from_newline_delimited_json(path, format)
+
+
+def git_repo_metadata_of(usage):
+    match = github_url_commit.search(usage["usage_example"]["github_url"])
+    return match.group(1) if match else None, usage["repo_last_updated"]
+
+
+def recency_of(metadata):
+    """
+    Sorts git metadata by when the repository was last updated, which is None when it couldn't be read, so that
+    counts as older than any date
+    """
+    _, repo_last_updated = metadata
+    return repo_last_updated is not None, repo_last_updated or ""
+
+
+def identity_of(usage):
+    """
+    Usages of the same repository found by different shards are the same usage if they only differ in which commit
+    was checked out, so the git metadata is left out when comparing them
+    """
+    usage_example = usage["usage_example"]
+    usage = {
+        **usage,
+        "repo_last_updated": None,
+        "usage_example": {
+            **usage_example,
+            "github_url": github_url_commit.sub(
+                "/blob/:commit/", usage_example["github_url"]
+            ),
+        },
+    }
+    return hashlib.sha256(json.dumps(usage, sort_keys=True).encode()).digest()
+
+
+async def merge_usages(paths, table="usages"):
+    """
+    Streams the usages from the output of each shard, which can be newline delimited json or a sqlite database,
+    skipping any that have already been seen
+
+    The inputs are read twice, first to find the latest commit any shard searched each repository at and then to
+    output only the usages found at that commit, so a repository searched by more than one shard, say because it
+    was searched again after being updated, is reported as it was at one commit, usages found at older commits are
+    left out rather than linked to lines that might not be there at the latest one
+    """
+    git_repo_metadata = {}
+    for path in paths:
+        for usage in read_usages(path, table):
+            metadata = git_repo_metadata_of(usage)
+            latest = git_repo_metadata.get(usage["repo"])
+            if latest is None or recency_of(metadata) > recency_of(latest):
+                git_repo_metadata[usage["repo"]] = metadata
+
+    seen = set()
+    for path in paths:
+        for usage in read_usages(path, table):
+            if git_repo_metadata_of(usage) != git_repo_metadata[usage["repo"]]:
+                continue
+            identity = identity_of(usage)
+            if identity in seen:
+                continue
+            seen.add(identity)
+            yield Usage.from_dict(usage)
@@ -0,0 +1,169 @@
+"""
+Counts and times each stage of a search so that when a run is slow we can tell where the time went, whether that's
+the subprocesses running the searches, waiting for a slot in the scheduler to run them, git or outputting usages
+
+Everything is recorded into the stats object in this module, call as_dict on it or add a listener to be called with
+that dict as the search progresses and once it's finished
+"""
+
+import asyncio
+import contextlib
+import copy
+import functools
+import inspect
+import json
+import sys
+import time
+
+
+def new_counter():
+    return {"count": 0, "seconds": 0.0}
+
+
+class Stats:
+    def __init__(self):
+        self.listeners = []
+        self.reset()
+
+    def reset(self):
+        """
+        Starts counting again from zero, listeners are kept
+        """
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.stages = {}
+        self.strategies = {}
+        self.bytes_read = 0
+        self.usages = 0
+        self.running_subprocesses = 0
+
+    def record(self, stage, seconds, count=1):
+        counter = self.stages.setdefault(stage, new_counter())
+        counter["count"] += count
+        counter["seconds"] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - started_at)
+
+    def record_strategy(self, strategy, component, seconds, usages):
+        """
+        Strategies run at the same time as each other so their seconds add up to more than the time taken overall
+        """
+        counter = self.strategies.setdefault(strategy, {}).setdefault(
+            component, {"seconds": 0.0, "usages": 0}
+        )
+        counter["seconds"] += seconds
+        counter["usages"] += usages
+
+    def merge(self, snapshot):
+        """
+        Adds what another process recorded, given as its as_dict, to what's been recorded here, other than its usages
+        which are counted as they're output here
+        """
+        for stage, counter in snapshot["stages"].items():
+            self.record(stage, counter["seconds"], counter["count"])
+        for strategy, components in snapshot["strategies"].items():
+            for component, counter in components.items():
+                self.record_strategy(
+                    strategy, component, counter["seconds"], counter["usages"]
+                )
+        self.bytes_read += snapshot["bytes_read"]
+
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def as_dict(self):
+        elapsed = self.elapsed()
+        return {
+            "seconds": elapsed,
+            "usages": self.usages,
+            "usages_per_second": self.usages / elapsed if elapsed else 0.0,
+            "bytes_read": self.bytes_read,
+            "running_subprocesses": self.running_subprocesses,
+            "stages": copy.deepcopy(self.stages),
+            "strategies": copy.deepcopy(self.strategies),
+        }
+
+    def notify(self):
+        snapshot = self.as_dict()
+        for listener in self.listeners:
+            listener(snapshot)
+
+    def finish(self):
+        self.finished_at = time.monotonic()
+        self.notify()
+
+
+stats = Stats()
+
+
+async def counting_usages(all_usages):
+    async for usage in all_usages:
+        stats.usages += 1
+        yield usage
+
+
+def instrumented(strategy):
+    """
+    Decorates a search strategy, an async generator of usages for of_component, or of_components in which case
+    they're recorded together as all unless there's only one of them, to record how long it ran for and how many
+    usages it found
+    """
+
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        async def decorated(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs).arguments
+            component = arguments.get("of_component")
+            if component is None:
+                of_components = arguments.get("of_components", ())
+                component = of_components[0] if len(of_components) == 1 else "all"
+            started_at = time.monotonic()
+            usages = 0
+            try:
+                async for usage in function(*args, **kwargs):
+                    usages += 1
+                    yield usage
+            finally:
+                stats.record_strategy(
+                    strategy, component, time.monotonic() - started_at, usages
+                )
+
+        return decorated
+
+    return decorator
+
+
+def write_stats(path):
+    with open(path, "w") as file:
+        json.dump(stats.as_dict(), file, indent=2)
+
+
+def format_progress(snapshot):
+    subprocesses = snapshot["stages"].get("subprocess", new_counter())
+    return (
+        f"{snapshot['seconds']:.0f}s, {snapshot['usages']} usages"
+        f" ({snapshot['usages_per_second']:.1f}/s),"
+        f" {subprocesses['count']} subprocesses finished,"
+        f" {snapshot['running_subprocesses']} running"
+    )
+
+
+async def report_progress(every=1.0, to=sys.stderr):
+    """
+    Writes a progress line every so often until cancelled, each one overwrites the last
+    """
+    try:
+        while True:
+            await asyncio.sleep(every)
+            stats.notify()
+            print(f"\r{format_progress(stats.as_dict())}", end="", file=to, flush=True)
+    finally:
+        print(file=to, flush=True)
@@ -0,0 +1,168 @@
+"""
+Counts how much each component is used in each repository, by the labels of how it's used and which library it's
+from, without creating a usage for every match, so there's no looking up which commit each repository is at and no
+holding on to or outputting the code of every usage when all that's wanted is how much each component is used
+
+Templates are searched in process with the python engine's strategies whichever engine is asked for, when counting
+templates rather than usages each strategy stops searching a template as soon as it's found every component
+"""
+
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+
+from find_usages.core import labels_from_code
+from find_usages.outputs import BufferedLines, json_line_encoder
+from find_usages.python_engine import (
+    find_usages_in_template_within_limits,
+    read_template,
+    templates_and_components_to_search_for,
+    ways_used_in_template_within_limits,
+)
+from find_usages.stats import stats
+from find_usages.utils import identify_language, identify_library, repo_name_of
+
+# what can be counted, every usage or every template that uses each component in each way
+summary_counts = ["usages", "templates"]
+
+
+def summary_columns(count="usages"):
+    return {
+        "repo": "TEXT",
+        "component": "TEXT",
+        "library": "TEXT",
+        "labels": "TEXT",
+        count: "INTEGER",
+    }
+
+
+def ways_used_in(contents, path, components, count, single_pass):
+    """
+    Yields (component, labels) for each usage, or once for each way each component is used when counting templates
+    """
+    if count == "templates":
+        yield from ways_used_in_template_within_limits(
+            contents, path, components, single_pass
+        )
+        return
+
+    for component, _, code, labels in find_usages_in_template_within_limits(
+        contents, path, components, single_pass
+    ):
+        yield component, (*labels_from_code(code, labels),)
+
+
+async def summarise(
+    in_search_path,
+    of_components,
+    count="usages",
+    single_pass=False,
+    in_repos=None,
+    candidates=None,
+):
+    """
+    Yields a dict for each repository, component, library and labels that's used with how many usages, or how many
+    templates when count is templates, pass candidates from find_usages.prefilter to only search the templates that
+    mention each component
+    """
+    counts = {}
+
+    async for path, components in templates_and_components_to_search_for(
+        in_search_path, of_components, in_repos, candidates
+    ):
+        try:
+            with stats.timed("read_template"):
+                contents = read_template(os.path.join(in_search_path, path))
+        except FileNotFoundError:
+            # listed by git but deleted from the checkout
+            continue
+
+        if contents is None:
+            continue
+
+        repo = repo_name_of(path.split("/", 1)[0])
+        language = identify_language(path)
+        with stats.timed("summarise"):
+            for component, labels in ways_used_in(
+                contents, path, components, count, single_pass
+            ):
+                key = (repo, component, identify_library(language, component), labels)
+                counts[key] = counts.get(key, 0) + 1
+
+    for (repo, component, library, labels), n in sorted(counts.items()):
+        yield {
+            "repo": repo,
+            "component": component,
+            "library": library,
+            "labels": [*labels],
+            count: n,
+        }
+
+
+async def output_summary_as_newline_delimited_json(rows, write):
+    encode = json_line_encoder()
+    async with BufferedLines(write) as lines:
+        async for row in rows:
+            await lines.add(encode(row) + b"\n")
+
+
+async def output_summary_as_csv(rows, write, count="usages"):
+    """
+    Labels are written as json text like they are in sqlite
+    """
+    text = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames=list(summary_columns(count)))
+    writer.writeheader()
+    async for row in rows:
+        writer.writerow({**row, "labels": json.dumps(row["labels"])})
+    await write(text.getvalue().encode())
+
+
+async def output_summary_to_stdout(rows, count="usages", format="json"):
+    async def write(data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    if format == "csv":
+        await output_summary_as_csv(rows, write, count)
+    else:
+        await output_summary_as_newline_delimited_json(rows, write)
+
+
+async def output_summary_to_file(rows, output_file, count="usages", format="json"):
+    from aiofile import async_open
+
+    async with async_open(output_file, "wb") as file:
+        if format == "csv":
+            await output_summary_as_csv(rows, file.write, count)
+        else:
+            await output_summary_as_newline_delimited_json(rows, file.write)
+
+
+async def output_summary_to_sqlite(rows, database, table="summary", count="usages"):
+    """
+    Rows already in the table are replaced, as a summary is only ever of everything searched
+    """
+    columns = summary_columns(count)
+    connection = sqlite3.connect(database)
+    try:
+        connection.execute(f"""drop table if exists "{table}" """)
+        connection.execute(
+            f"""create table "{table}" ({", ".join(f"[{name}] {kind}" for name, kind in columns.items())})"""
+        )
+        connection.executemany(
+            f"""insert into "{table}" values ({", ".join("?" for _ in columns)})""",
+            [
+                [
+                    json.dumps(row[name]) if name == "labels" else row[name]
+                    for name in columns
+                ]
+                async for row in rows
+            ],
+        )
+        connection.commit()
+    finally:
+        connection.close()
@@ -0,0 +1,186 @@
+"""
+Usages are kept as Usage records while they're being found and only turned into the dicts we output at the end,
+which saves a lot of memory when they're collected together, as most of their strings are shared with other usages
+and the fields that are derived from the others aren't stored at all
+"""
+
+import json
+import re
+import sys
+
+github_url_commit = re.compile(r"/blob/([^/]*)/")
+
+# labels are shared by every usage found the same way so each combination is only kept once
+shared_labels = {}
+
+
+def intern_labels(labels):
+    labels = tuple(sys.intern(label) for label in labels)
+    return shared_labels.setdefault(labels, labels)
+
+
+class Usage:
+    __slots__ = (
+        "repo",
+        "component",
+        "library",
+        "labels",
+        "template_language",
+        "repo_last_updated",
+        "git_commit",
+        "line_number",
+        "code",
+        "path",
+        "snapshot_date",
+    )
+
+    def __init__(
+        self,
+        repo,
+        component,
+        library,
+        labels,
+        template_language,
+        repo_last_updated,
+        git_commit,
+        line_number,
+        code,
+        path,
+        snapshot_date=None,
+    ):
+        self.repo = sys.intern(repo)
+        self.component = sys.intern(component)
+        self.library = sys.intern(library)
+        self.labels = intern_labels(labels)
+        self.template_language = sys.intern(template_language)
+        self.repo_last_updated = (
+            repo_last_updated
+            if repo_last_updated is None
+            else sys.intern(repo_last_updated)
+        )
+        self.git_commit = git_commit if git_commit is None else sys.intern(git_commit)
+        self.line_number = line_number
+        self.code = code
+        self.path = sys.intern(path)
+        self.snapshot_date = (
+            snapshot_date if snapshot_date is None else sys.intern(snapshot_date)
+        )
+
+    @property
+    def line_count(self):
+        return 1 + self.code.count("\n")
+
+    @property
+    def parenthesis_count(self):
+        return self.code.count("(")
+
+    @property
+    def length(self):
+        return len(self.code)
+
+    @property
+    def github_url(self):
+        line_stop = self.line_number + self.code.count("\n")
+        return (
+            f"https://github.com/hmrc/{self.repo}/blob/{self.git_commit}/{self.path}"
+            f"#L{self.line_number}-L{line_stop}"
+        )
+
+    def to_dict(self):
+        """
+        Returns the usage as we output it, usages found in the history of a repository also have the date of the
+        snapshot they were found in
+        """
+        usage = {
+            "repo": self.repo,
+            "component": self.component,
+            "library": self.library,
+            "labels": list(self.labels),
+            "template_language": self.template_language,
+            "line_count": self.line_count,
+            "parenthesis_count": self.parenthesis_count,
+            "length": self.length,
+            "repo_last_updated": self.repo_last_updated,
+            "usage_example": {
+                "github_url": self.github_url,
+                "line_number": self.line_number,
+                "code": self.code,
+                "path": self.path,
+            },
+            "code": self.code,
+            "path": self.path,
+        }
+        if self.snapshot_date is not None:
+            usage["snapshot_date"] = self.snapshot_date
+        return usage
+
+    def to_json(self):
+        from find_usages.outputs import as_json_line
+
+        return as_json_line(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, usage):
+        """
+        The opposite of to_dict, for usages that have been output and read back in
+        """
+        commit = github_url_commit.search(usage["usage_example"]["github_url"])
+        return cls(
+            repo=usage["repo"],
+            component=usage["component"],
+            library=usage["library"],
+            labels=usage["labels"],
+            template_language=usage["template_language"],
+            repo_last_updated=usage["repo_last_updated"],
+            git_commit=commit.group(1) if commit else None,
+            line_number=usage["usage_example"]["line_number"],
+            code=usage["code"],
+            path=usage["path"],
+            snapshot_date=usage.get("snapshot_date"),
+        )
+
+    def fields(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, Usage):
+            return NotImplemented
+        return self.fields() == other.fields()
+
+    def __hash__(self):
+        return hash(self.fields())
+
+    def __repr__(self):
+        return f"Usage({self.to_json()})"
+
+
+class EncodedUsage:
+    """
+    A usage as the json line another process output it as, which the newline delimited json outputs write as it is
+    rather than decoding and encoding it again, it's only decoded into a Usage when one of its fields is needed
+    """
+
+    __slots__ = ("json_line", "decoded")
+
+    def __init__(self, json_line):
+        self.json_line = json_line
+        self.decoded = None
+
+    def usage(self):
+        if self.decoded is None:
+            self.decoded = Usage.from_dict(json.loads(self.json_line))
+        return self.decoded
+
+    def __getattr__(self, name):
+        return getattr(self.usage(), name)
+
+    def __eq__(self, other):
+        if isinstance(other, EncodedUsage):
+            other = other.usage()
+        return self.usage() == other
+
+    def __hash__(self):
+        return hash(self.usage())
+
+    def __repr__(self):
+        return f"EncodedUsage({self.json_line.decode()})"
@@ -1,7 +1,18 @@
 import asyncio
+import contextlib
+import datetime
+import importlib
 import logging
 import os
+import re
 import signal
+import subprocess
+import sys
+import time
+import zlib
+from collections import OrderedDict, deque
+
+from find_usages.stats import stats
 
 default_list_of_all_components = os.path.join(
     os.path.dirname(__file__), "resources", "components.csv"
@@ -16,44 +27,224 @@ def readlines_without_newlines(path):
         return [line.strip() for line in file]
 
 
+def import_extra(module, extra):
+    """
+    Imports a module that's only installed with one of the package's extras, saying which extra to install when it
+    isn't there rather than just that the module is missing
+    """
+    try:
+        return importlib.import_module(module)
+    except ImportError as error:
+        raise ImportError(
+            f"{module} isn't installed, install find_usages with the {extra} extra to use this,"
+            f" e.g. poetry install --extras {extra}",
+            name=module,
+        ) from error
+
+
 def get_default_list_of_all_components():
     return readlines_without_newlines(default_list_of_all_components)
 
 
-git_repo_latest_commit_cache = {}
+def list_repos(in_search_path, in_repos=None):
+    """
+    Repositories are checked out as immediate sub folders of the search path, in_repos limits it to just those
+    """
+    return sorted(
+        entry.name
+        for entry in os.scandir(in_search_path)
+        if entry.is_dir()
+        and not entry.name.startswith(".")
+        and (in_repos is None or entry.name in in_repos)
+    )
 
 
-async def get_git_repo_latest_commit(path):
-    if path not in git_repo_latest_commit_cache:
-        process = await asyncio.subprocess.create_subprocess_shell(
-            "git rev-parse HEAD",
-            cwd=path,
-            stdout=asyncio.subprocess.PIPE,
-        )
+def repo_name_of(folder):
+    """
+    Mirrors are usually cloned into a folder named after the repository with .git on the end
+    """
+    return folder[: -len(".git")] if folder.endswith(".git") else folder
 
-        stdout, _ = await process.communicate()
 
-        git_repo_latest_commit_cache[path] = stdout.decode().strip()
+def find_git_dir(path):
+    """
+    Returns the git dir of the repository path is within and the common dir that refs and objects are shared in,
+    which is only different for worktrees, or None when path isn't within a repository
+    """
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, ".git")
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+            break
+        if os.path.isfile(dot_git):
+            with open(dot_git) as file:
+                git_dir = os.path.join(path, file.read().strip()[len("gitdir: ") :])
+            break
+        if os.path.dirname(path) == path:
+            return None
+        path = os.path.dirname(path)
 
-    return git_repo_latest_commit_cache[path]
+    common_dir = git_dir
+    if os.path.isfile(os.path.join(git_dir, "commondir")):
+        with open(os.path.join(git_dir, "commondir")) as file:
+            common_dir = os.path.join(git_dir, file.read().strip())
 
+    return git_dir, common_dir
 
-git_repo_last_updated_at_cache = {}
 
+def read_git_ref(git_dir, common_dir, ref):
+    for folder in [git_dir, common_dir]:
+        if os.path.isfile(os.path.join(folder, ref)):
+            with open(os.path.join(folder, ref)) as file:
+                return file.read().strip()
 
-async def get_git_repo_last_updated_at(repo):
-    if repo not in git_repo_last_updated_at_cache:
-        process = await asyncio.subprocess.create_subprocess_shell(
-            rf'git log -1 --date=short --pretty="format:%cd"',
-            cwd=repo,
-            stdout=asyncio.subprocess.PIPE,
-        )
+    if os.path.isfile(os.path.join(common_dir, "packed-refs")):
+        with open(os.path.join(common_dir, "packed-refs")) as file:
+            for line in file:
+                if line.rstrip("\n").endswith(f" {ref}"):
+                    return line.split(" ")[0]
+
+    return None
+
+
+def read_git_commit_date(common_dir, commit):
+    """
+    Only works for commits stored as loose objects, returns the date in the same format and timezone as
+    git log --date=short would
+    """
+    path = os.path.join(common_dir, "objects", commit[:2], commit[2:])
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, "rb") as file:
+        header, _ = zlib.decompress(file.read()).split(b"\n\n", 1)
+
+    for line in header.decode(errors="replace").split("\n"):
+        if line.startswith("committer "):
+            timestamp, timezone_offset = line.rsplit(" ", 2)[1:]
+            sign = -1 if timezone_offset.startswith("-") else 1
+            offset = datetime.timedelta(
+                hours=int(timezone_offset[1:3]), minutes=int(timezone_offset[3:5])
+            )
+            timezone = datetime.timezone(sign * offset)
+            return datetime.datetime.fromtimestamp(int(timestamp), timezone).strftime(
+                "%Y-%m-%d"
+            )
+
+    return None
+
+
+def read_git_head(git_dir, common_dir):
+    with open(os.path.join(git_dir, "HEAD")) as file:
+        head = file.read().strip()
+
+    if head.startswith("ref: "):
+        return read_git_ref(git_dir, common_dir, head[len("ref: ") :])
+    return head
+
+
+def read_git_head_commit(path):
+    """
+    Returns the commit checked out in the repository path is within, or None when it can't be read from the git dir
+    """
+    try:
+        git_dirs = find_git_dir(path)
+        return None if git_dirs is None else read_git_head(*git_dirs)
+    except OSError:
+        return None
+
+
+def read_git_repo_metadata_from_git_dir(path):
+    """
+    Reads the latest commit and when it was made straight from the files in the git dir, which saves starting a
+    process per repository, returns None when that's not possible such as when the commit has been packed
+    """
+    try:
+        git_dirs = find_git_dir(path)
+        if git_dirs is None:
+            return None
+        _, common_dir = git_dirs
 
-        stdout, _ = await process.communicate()
+        commit = read_git_head(*git_dirs)
+        if commit is None:
+            return None
 
-        git_repo_last_updated_at_cache[repo] = stdout.decode().strip()
+        last_updated_at = read_git_commit_date(common_dir, commit)
+        if last_updated_at is None:
+            return None
 
-    return git_repo_last_updated_at_cache[repo]
+        return commit, last_updated_at
+    except (OSError, ValueError, zlib.error) as e:
+        logging.debug(f"Could not read git metadata from git dir: {path} {e}")
+        return None
+
+
+async def read_git_repo_metadata(path):
+    with stats.timed("git_metadata_from_git_dir"):
+        metadata = read_git_repo_metadata_from_git_dir(path)
+    if metadata is not None:
+        return metadata
+
+    async with git_scheduler.slot():
+        with stats.timed("git_metadata_from_git_log"):
+            process = await asyncio.subprocess.create_subprocess_shell(
+                rf'git log -1 --date=short --pretty="format:%H%n%cd"',
+                cwd=path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+
+            stdout, _ = await process.communicate()
+
+    commit, _, last_updated_at = stdout.decode().strip().partition("\n")
+
+    return commit, last_updated_at
+
+
+git_repo_metadata_cache = {}
+
+
+def get_git_repo_metadata(path):
+    """
+    Returns a future for (latest commit, last updated at) of the repository, every caller for the same repository
+    shares the same future so git is only asked once however many usages are found in it at the same time
+    """
+    metadata = git_repo_metadata_cache.get(path)
+
+    # a future left unfinished by an event loop that's since been closed will never finish
+    if metadata is None or (
+        not metadata.done() and metadata.get_loop() is not asyncio.get_running_loop()
+    ):
+        metadata = asyncio.ensure_future(read_git_repo_metadata(path))
+        git_repo_metadata_cache[path] = metadata
+
+    return metadata
+
+
+def forget_git_repo_metadata(path):
+    """
+    So the metadata is read again after the repository has moved to another commit
+    """
+    git_repo_metadata_cache.pop(path, None)
+
+
+def prefetch_git_repo_metadata(in_search_path, in_repos=None):
+    """
+    Starts getting the metadata for every repository in the search path so it's ready by the time we find usages
+    """
+    for repo in list_repos(in_search_path, in_repos):
+        get_git_repo_metadata(os.path.join(in_search_path, repo))
+
+
+async def get_git_repo_latest_commit(path):
+    commit, _ = await get_git_repo_metadata(path)
+    return commit
+
+
+async def get_git_repo_last_updated_at(repo):
+    _, last_updated_at = await get_git_repo_metadata(repo)
+    return last_updated_at
 
 
 # ugly and brittle way of identifying which library a component came from
@@ -77,13 +268,81 @@ def identify_library(template_language, component):
     return libraries[template_language][component[0]]
 
 
+template_extensions = (".scala.html", ".njk")
+
+
 def identify_language(path):
     return "nunjucks" if os.path.splitext(path)[1] == ".njk" else "twirl"
 
 
-def parse_alias_and_files(search_result):
-    [alias, files_it_has_been_found_in] = search_result.decode().split(":")
-    return alias, files_it_has_been_found_in.strip().split(",")
+def identify_component(code, components):
+    """
+    Works out which component a match was for from the last name before any parameters, which is where all our
+    regexp put the component name, for example "new uk.gov.hmrc.govukfrontend.views.html.components.GovukButton()"
+    """
+    name = re.findall(r"\w+", code.split("(", 1)[0])[-1]
+    name = name[0].lower() + name[1:]
+    return name if name in components else None
+
+
+def identify_components_assigned(code, components):
+    """
+    Works out which components a match of where they're assigned or injected was for, which is every component the
+    name ends with, as that's what searching for each component on its own matches, for example "hmrcHeader ="
+    would also be a match for a component called header
+    """
+    name = re.findall(r"\w+", code)[0]
+    return [component for component in components if name.endswith(component)]
+
+
+def first_match_of_each_group(matches):
+    """
+    When matches are on the same or adjacent lines ripgrep groups them into one json result and we only use the
+    first, this does the same grouping for matches found some other way so we report the same usages
+
+    Takes (key, first line, last line, match) in the order they were found, where matches are grouped separately
+    for each key, and yields (key, first line, match) for the first match of each group
+    """
+    last_line_of_previous_match = {}
+    for key, first_line, last_line, match in matches:
+        if first_line > last_line_of_previous_match.get(key, -1) + 1:
+            yield key, first_line, match
+        last_line_of_previous_match[key] = last_line
+
+
+def split_into_matches_per_component(search_result, components):
+    """
+    Regroups results from a combined search by component so we report the same matches we would have if we had
+    searched for each component separately
+
+    Yields (path, line number, code, component) for the first match of each group
+    """
+    data = search_result["data"]
+    lines = data["lines"]["text"].encode()
+
+    def matches():
+        for submatch in data["submatches"]:
+            code = submatch["match"]["text"]
+            component = identify_component(code, components)
+            if component is None:
+                continue
+            first_line = data["line_number"] + lines[: submatch["start"]].count(b"\n")
+            last_line = first_line + code.rstrip("\n").count("\n")
+            yield component, first_line, last_line, code
+
+    for component, line_number, code in first_match_of_each_group(matches()):
+        yield data["path"]["text"], line_number, code, component
+
+
+def identify_alias(code):
+    """
+    Works out the alias from a match of match_alias_including_class_name, and from what follows it whether it was
+    injected or assigned, returns (alias, labels) with the labels its usages are given
+    """
+    alias = re.match(r"\w+", code).group()
+    if code[len(alias) :].lstrip().startswith(":"):
+        return alias, ("via-dependency-injection",)
+    return alias, ("via-inline-instantiation", "used-as-variable")
 
 
 async def write_into(stdin, lines=None):
@@ -94,10 +353,16 @@ async def write_into(stdin, lines=None):
 
 subprocesses = []
 
+# the same subprocesses by the scheduler queue they were started in, which for most searches is the component
+subprocesses_in_queue = {}
 
-def terminate_all_subprocesses():
-    logging.info(f"Subprocesses to try terminating: {len(subprocesses)}")
-    for proc in subprocesses:
+
+def terminate_subprocesses(processes):
+    logging.info(f"Subprocesses to try terminating: {len(processes)}")
+    for proc in processes:
+        if proc.returncode is not None:
+            # its process group could belong to something else by now
+            continue
         try:
             os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
             logging.debug(f"Process terminated: {proc}")
@@ -105,6 +370,56 @@ def terminate_all_subprocesses():
             logging.debug(f"Process already terminated: {proc}")
 
 
+def terminate_all_subprocesses():
+    terminate_subprocesses(subprocesses)
+
+
+def terminate_subprocesses_in_queue(queue):
+    terminate_subprocesses(subprocesses_in_queue.get(queue, []))
+
+
+# so anything that needs a complete set of results can tell if a search failed part way through
+search_errors = []
+
+
+class SearchFailed(Exception):
+    """
+    Recorded in search_errors when a command run for a search fails, along with what it wrote to stderr
+    """
+
+    def __init__(self, command, returncode, stderr):
+        super().__init__(command, returncode, stderr)
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+def forget_searches():
+    """
+    Clears the subprocesses and errors kept for the searches run so far, so something that searches again and again
+    like find_usages.watch can start each search afresh rather than them piling up for as long as it runs
+    """
+    subprocesses.clear()
+    subprocesses_in_queue.clear()
+    search_errors.clear()
+
+
+# ripgrep exits with 1 when it doesn't find anything, and xargs with 123 when any ripgrep it ran did
+exit_codes_for_nothing_found = {0, 1, 123}
+
+
+def failed(returncode, stderr):
+    """
+    Whether a command run for a search failed, the shell only reports the exit code of the last command in a
+    pipeline, so a ripgrep that couldn't be run or that fails part way through is only known about from what's
+    written to stderr, a command that was killed on purpose, for a timeout or because its queue was stopped, is
+    never a failure
+    """
+    if returncode < 0:
+        return False
+    return returncode not in exit_codes_for_nothing_found or len(stderr) > 0
+
+
 def terminate_all_subprocesses_on_exception(function):
     def decorated(*args, **kwargs):
         async def inner():
@@ -113,6 +428,7 @@ def terminate_all_subprocesses_on_exception(function):
                     yield v
             except Exception as e:
                 logging.exception(e)
+                search_errors.append(e)
                 terminate_all_subprocesses()
 
         return inner()
@@ -120,25 +436,213 @@ def terminate_all_subprocesses_on_exception(function):
     return decorated
 
 
-async def run(command, working_dir=None, files_to_search=None):
-    search_process = await asyncio.create_subprocess_shell(
-        command,
-        stdin=asyncio.subprocess.PIPE if files_to_search is not None else None,
-        stdout=asyncio.subprocess.PIPE,
-        limit=1024 * 256,
-        cwd=working_dir,
-        preexec_fn=os.setsid,
-    )
+class QueueStopped(Exception):
+    """
+    Raised when waiting for a slot in a queue that's been stopped
+    """
+
+
+class Scheduler:
+    """
+    Limits how many subprocesses can run at once, when all the slots are taken processes wait in a queue and as
+    slots free up they are handed out to each queue in turn so that one component with lots of searches to run
+    can't hold up all the others
+
+    A queue can be stopped once nothing more from it is needed, then anything waiting in it or asking for a slot in
+    it later gets QueueStopped rather than a slot
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.running = 0
+        self.queues = OrderedDict()
+        self.stopped = set()
+
+    def stop(self, queue):
+        self.stopped.add(queue)
+        for waiting in self.queues.pop(queue, deque()):
+            if not waiting.done():
+                waiting.set_exception(QueueStopped(queue))
+
+    def resume(self, queue):
+        self.stopped.discard(queue)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, queue=None):
+        if queue in self.stopped:
+            raise QueueStopped(queue)
+        if self.running < self.jobs and not self.queues:
+            self.running += 1
+        else:
+            waiting = asyncio.get_running_loop().create_future()
+            self.queues.setdefault(queue, deque()).append(waiting)
+            try:
+                await waiting
+            except asyncio.CancelledError:
+                if (
+                    waiting.done()
+                    and not waiting.cancelled()
+                    and waiting.exception() is None
+                ):
+                    # slot was handed to us just as we were cancelled so pass it on
+                    self.release()
+                elif waiting in self.queues.get(queue, ()):
+                    # otherwise the queue was stopped just as we were cancelled, and we never had a slot
+                    self.queues[queue].remove(waiting)
+                    if not self.queues[queue]:
+                        del self.queues[queue]
+                raise
+
+        try:
+            yield
+        finally:
+            self.release()
+
+    def release(self):
+        while self.queues:
+            queue, waiting = next(iter(self.queues.items()))
+            next_in_line = waiting.popleft()
+            if waiting:
+                self.queues.move_to_end(queue)
+            else:
+                del self.queues[queue]
+            if not next_in_line.done():
+                next_in_line.set_result(None)
+                return
+        self.running -= 1
+
 
-    subprocesses.append(search_process)
+scheduler = Scheduler(jobs=os.cpu_count())
 
-    if files_to_search is not None:
-        await write_into(search_process.stdin, files_to_search)
 
+def stop_searches_in_queue(queue):
+    """
+    Stops the searches in queue that are still waiting for a slot from starting and kills any that are running,
+    resume the queue in the scheduler before searching it again
+    """
+    scheduler.stop(queue)
+    terminate_subprocesses_in_queue(queue)
+
+
+# git is run separately from searches so that it's never stuck waiting for a search to finish, which could itself
+# be waiting on git
+git_scheduler = Scheduler(jobs=os.cpu_count())
+
+
+# ripgrep gives up on a template when pcre2 hits one of its limits, say because of unbalanced brackets
+ripgrep_pcre2_error = re.compile(r"^rg: (.*): PCRE2: error matching: (.*)$")
+
+
+async def forward_errors(stderr):
+    """
+    Errors are passed on to our own stderr, apart from templates ripgrep gave up on which are recorded in
+    find_usages.guardrails instead, returns the lines that were passed on
+    """
+    from find_usages.guardrails import skip
+
+    forwarded = []
     while True:
-        search_result = await search_process.stdout.readline()
-        if not search_result:
-            break
-        yield search_result
+        line = await stderr.readline()
+        if not line:
+            return forwarded
+        error = ripgrep_pcre2_error.match(line.decode(errors="replace").rstrip("\n"))
+        if error is not None:
+            skip("pcre2_limit", error.group(1), error=error.group(2))
+        else:
+            forwarded.append(line.decode(errors="replace"))
+            sys.stderr.buffer.write(line)
+            sys.stderr.flush()
+
+
+async def run(
+    command,
+    working_dir=None,
+    files_to_search=None,
+    queue=None,
+    check=False,
+    timeout=None,
+):
+    """
+    Processes are started through the scheduler so the output of this should be consumed promptly, holding on to
+    it while waiting for another run to start can use up all the slots
+
+    Pass check=True to raise an error if the command fails, otherwise a failure that isn't just nothing being found
+    is recorded in search_errors as SearchFailed, so the cache and checkpoints don't record an empty result as
+    complete
 
-    await search_process.wait()
+    Pass timeout to stop the command after that many seconds, what it output until then is still used and that it
+    was stopped is recorded in find_usages.guardrails
+
+    Nothing is output when the queue is stopped before the command gets a slot, and the command is killed when the
+    queue is stopped with stop_searches_in_queue while it's running
+    """
+    queued_at = time.monotonic()
+    try:
+        async with scheduler.slot(queue):
+            stats.record("queue_wait", time.monotonic() - queued_at)
+
+            started_at = time.monotonic()
+            stats.running_subprocesses += 1
+            try:
+                search_process = await asyncio.create_subprocess_shell(
+                    command,
+                    stdin=(
+                        asyncio.subprocess.PIPE if files_to_search is not None else None
+                    ),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    limit=1024 * 256,
+                    cwd=working_dir,
+                    preexec_fn=os.setsid,
+                )
+
+                subprocesses.append(search_process)
+                subprocesses_in_queue.setdefault(queue, []).append(search_process)
+
+                forwarding_errors = asyncio.ensure_future(
+                    forward_errors(search_process.stderr)
+                )
+
+                if files_to_search is not None:
+                    await write_into(search_process.stdin, files_to_search)
+
+                deadline = None if timeout is None else started_at + timeout
+                while True:
+                    try:
+                        search_result = await asyncio.wait_for(
+                            search_process.stdout.readline(),
+                            None if deadline is None else deadline - time.monotonic(),
+                        )
+                    except asyncio.TimeoutError:
+                        from find_usages.guardrails import skip
+
+                        # the whole pipeline was started in its own process group
+                        with contextlib.suppress(ProcessLookupError):
+                            os.killpg(search_process.pid, signal.SIGKILL)
+                        skip("pipeline_timeout", command=command, seconds=timeout)
+                        break
+                    if not search_result:
+                        break
+                    stats.bytes_read += len(search_result)
+                    yield search_result
+
+                await search_process.wait()
+                errors = await forwarding_errors
+            finally:
+                stats.running_subprocesses -= 1
+                stats.record("subprocess", time.monotonic() - started_at)
+
+            if check and search_process.returncode != 0:
+                raise subprocess.CalledProcessError(
+                    search_process.returncode, command, stderr="".join(errors)
+                )
+            if failed(search_process.returncode, errors):
+                logging.error(
+                    f"Search failed with exit code {search_process.returncode}: {command}"
+                )
+                search_errors.append(
+                    SearchFailed(command, search_process.returncode, "".join(errors))
+                )
+    except QueueStopped:
+        # nothing more is needed from this queue
+        return
@@ -0,0 +1,432 @@
+"""
+Keeps a sqlite database of usages up to date as templates change, after searching everything once only the templates
+that have changed since are searched again and their rows replaced, or every template of a repository once it has
+moved to another commit, as all its usages link to the commit
+
+Changes are noticed with inotify on linux, which is used through ctypes so it doesn't need anything installed, and
+by walking the search path every so often anywhere else or when there are too many folders to watch
+
+Changed templates are searched in process with the python engine whichever engine is asked for, starting the
+pipelines for every component to search one template would take far longer than searching it
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import sqlite3
+import struct
+import sys
+import time
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.outputs import output_to_sqlite, replace_usages_in_sqlite
+from find_usages.utils import (
+    forget_git_repo_metadata,
+    forget_searches,
+    list_repos,
+    read_git_head_commit,
+    repo_name_of,
+    template_extensions,
+)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+watched_events = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+inotify_event = struct.Struct("iIII")
+
+
+def is_template(path):
+    return path.endswith(template_extensions) and not any(
+        part.startswith(".") for part in path.split(os.sep)
+    )
+
+
+def templates_under(search_path, folder=""):
+    """
+    Yields the path of every template in folder relative to the search path, without going into hidden folders
+    """
+    for root, sub_folders, files in os.walk(os.path.join(search_path, folder)):
+        sub_folders[:] = [name for name in sub_folders if not name.startswith(".")]
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), search_path)
+            if is_template(path):
+                yield path
+
+
+class PollingWatcher:
+    """
+    Notices changes by comparing when each template was last modified and how big it is every interval
+    """
+
+    def __init__(self, search_path):
+        self.search_path = search_path
+        self.seen = self.look()
+
+    def look(self):
+        seen = {}
+        for path in templates_under(self.search_path):
+            try:
+                stat = os.stat(os.path.join(self.search_path, path))
+            except FileNotFoundError:
+                continue
+            seen[path] = (stat.st_mtime_ns, stat.st_size)
+        return seen
+
+    async def changes(self, interval):
+        """
+        Yields the set of templates that have changed every interval, which is often empty
+        """
+        while True:
+            await asyncio.sleep(interval)
+            now = await asyncio.get_running_loop().run_in_executor(None, self.look)
+            changed = {
+                path
+                for path in self.seen.keys() | now.keys()
+                if self.seen.get(path) != now.get(path)
+            }
+            self.seen = now
+            yield changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Watches every folder in the search path apart from hidden ones, raises OSError when inotify isn't available or
+    there are more folders than the system allows to be watched, in which case it's best to poll instead
+    """
+
+    def __init__(self, search_path):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on linux")
+
+        self.search_path = search_path
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+
+        try:
+            self.watch("")
+        except OSError:
+            self.close()
+            raise
+
+    def watch(self, folder):
+        """
+        Watches folder and every folder within it, returns the templates already in them
+        """
+        templates = []
+        for root, sub_folders, files in os.walk(os.path.join(self.search_path, folder)):
+            sub_folders[:] = [name for name in sub_folders if not name.startswith(".")]
+            watch_descriptor = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(root), watched_events
+            )
+            if watch_descriptor < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed", root)
+            relative_root = os.path.relpath(root, self.search_path)
+            self.folders[watch_descriptor] = (
+                "" if relative_root == os.curdir else relative_root
+            )
+            templates.extend(
+                path
+                for path in (
+                    os.path.join(self.folders[watch_descriptor], name) for name in files
+                )
+                if is_template(path)
+            )
+        return templates
+
+    def unwatch(self, folder):
+        """
+        Stops watching folder and every folder within it, which once moved would otherwise go on being reported
+        under the path it was moved from
+        """
+        within = os.path.join(folder, "")
+        for watch_descriptor, watched in list(self.folders.items()):
+            if watched == folder or watched.startswith(within):
+                del self.folders[watch_descriptor]
+                self.libc.inotify_rm_watch(self.fd, watch_descriptor)
+
+    def read_events(self):
+        """
+        Returns the templates changed by the events waiting to be read, along with each folder that was deleted or
+        moved away ending with a separator, or None when events were dropped because there were too many, then
+        anything could have changed
+        """
+        changed = set()
+        while True:
+            try:
+                events = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(events):
+                watch_descriptor, mask, _, length = inotify_event.unpack_from(
+                    events, offset
+                )
+                start = offset + inotify_event.size
+                name = os.fsdecode(events[start : start + length].rstrip(b"\0"))
+                offset = start + length
+
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_IGNORED:
+                    self.folders.pop(watch_descriptor, None)
+                    continue
+                if watch_descriptor not in self.folders:
+                    continue
+
+                path = os.path.join(self.folders[watch_descriptor], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        # there are no events for the templates that were in it when it's moved away
+                        self.unwatch(path)
+                        changed.add(os.path.join(path, ""))
+                    elif mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith("."):
+                        # anything written into it before it was watched would otherwise be missed
+                        changed.update(self.watch(path))
+                elif is_template(path):
+                    changed.add(path)
+
+    async def changes(self, interval, settle=0.05):
+        """
+        Yields the set of templates that have changed as soon as they do, waiting settle seconds to collect
+        together changes made at about the same time, or an empty set every interval when nothing's changed
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            readable = loop.create_future()
+            loop.add_reader(
+                self.fd, lambda: readable.done() or readable.set_result(None)
+            )
+            try:
+                await asyncio.wait_for(readable, timeout=interval)
+                await asyncio.sleep(settle)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                loop.remove_reader(self.fd)
+
+            changed = self.read_events()
+            yield (
+                set(templates_under(self.search_path)) if changed is None else changed
+            )
+
+    def close(self):
+        os.close(self.fd)
+
+
+def table_exists(database, table):
+    connection = sqlite3.connect(database)
+    try:
+        return (
+            connection.execute(
+                "select 1 from sqlite_master where type = 'table' and name = ?",
+                (table,),
+            ).fetchone()
+            is not None
+        )
+    finally:
+        connection.close()
+
+
+def watcher_for(search_path, poll=False):
+    if not poll:
+        try:
+            return InotifyWatcher(search_path)
+        except OSError as e:
+            print(f"Polling for changes as inotify can't be used: {e}", file=sys.stderr)
+    return PollingWatcher(search_path)
+
+
+def heads_of(search_path):
+    return {
+        repo: read_git_head_commit(os.path.join(search_path, repo))
+        for repo in list_repos(search_path)
+    }
+
+
+def repo_and_path_of(template):
+    repo, _, path = template.partition(os.sep)
+    return repo, path
+
+
+async def not_ignored_by_git(search_path, templates):
+    """
+    Templates given explicitly to a search are searched even when git ignores them, which a search of the whole
+    repository wouldn't have, so those are left out
+    """
+    in_repos = {}
+    for template in templates:
+        repo, path = repo_and_path_of(template)
+        in_repos.setdefault(repo, []).append(path)
+
+    not_ignored = []
+    for repo, paths in in_repos.items():
+        process = await asyncio.create_subprocess_exec(
+            "git",
+            "check-ignore",
+            "-z",
+            "--stdin",
+            cwd=os.path.join(search_path, repo),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        stdout, _ = await process.communicate("\0".join(paths).encode())
+        # exits with 1 when none of them are ignored, and something else when it's not a git repository
+        ignored = set(stdout.decode().split("\0")) if process.returncode == 0 else set()
+        not_ignored.extend(
+            os.path.join(repo, path) for path in paths if path not in ignored
+        )
+
+    return not_ignored
+
+
+async def update(
+    search_path, of_components, database, table, changed, moved, search_options
+):
+    """
+    Searches the templates that have changed, and the repositories that have moved to another commit, again and
+    replaces their rows, changed folders ending with a separator were deleted or moved away so the rows of every
+    template that was in them are removed
+
+    Nothing is kept of the searches before, which have all finished by now
+    """
+    forget_searches()
+
+    for repo in moved:
+        forget_git_repo_metadata(os.path.join(search_path, repo))
+
+    folders = sorted(
+        folder
+        for folder in changed
+        if folder.endswith(os.sep) and repo_and_path_of(folder)[0] not in moved
+    )
+    changed = sorted(
+        template
+        for template in changed
+        if not template.endswith(os.sep) and repo_and_path_of(template)[0] not in moved
+    )
+
+    to_search = await not_ignored_by_git(
+        search_path,
+        [
+            template
+            for template in changed
+            if os.path.isfile(os.path.join(search_path, template))
+        ],
+    )
+
+    usages = []
+    if moved:
+        usages += [
+            usage
+            async for usage in find_all_usages_for_all_components(
+                search_path, of_components, in_repos=sorted(moved), **search_options
+            )
+        ]
+    if to_search:
+        usages += [
+            usage
+            async for usage in find_all_usages_for_all_components(
+                search_path,
+                of_components,
+                in_repos=sorted(
+                    {repo_and_path_of(template)[0] for template in to_search}
+                ),
+                in_templates=to_search,
+                **{**search_options, "engine": "python"},
+            )
+        ]
+
+    replace_usages_in_sqlite(
+        database,
+        table,
+        usages,
+        repos=[repo_name_of(repo) for repo in moved],
+        templates=[
+            (repo_name_of(repo), path)
+            for repo, path in (repo_and_path_of(template) for template in changed)
+        ],
+        folders=[
+            (repo_name_of(repo), path)
+            for repo, path in (repo_and_path_of(folder) for folder in folders)
+        ],
+    )
+
+
+async def watch_search_path(
+    search_path,
+    of_components,
+    database,
+    table="usages",
+    interval=1.0,
+    poll=False,
+    updated=None,
+    **search_options,
+):
+    """
+    Searches everything into the table then keeps it up to date until cancelled, updated is called with how many
+    templates and repositories were searched again after each update
+
+    Search options are passed on to find_all_usages_for_all_components
+    """
+    # nothing that changes while searching everything will be missed, it'll just be searched again
+    watcher = watcher_for(search_path, poll)
+    try:
+        heads = heads_of(search_path)
+
+        if table_exists(database, table):
+            # otherwise usages in templates deleted since the last time would be kept
+            replace_usages_in_sqlite(
+                database, table, [], repos=[repo_name_of(repo) for repo in heads]
+            )
+
+        await output_to_sqlite(
+            find_all_usages_for_all_components(
+                search_path, of_components, **search_options
+            ),
+            database=database,
+            table=table,
+            batch_size=1000,
+        )
+
+        async for changed in watcher.changes(interval):
+            now = heads_of(search_path)
+            moved = {repo for repo in now if now[repo] != heads.get(repo)}
+            heads = now
+
+            if not changed and not moved:
+                continue
+
+            started_at = time.monotonic()
+            await update(
+                search_path,
+                of_components,
+                database,
+                table,
+                changed,
+                moved,
+                search_options,
+            )
+            if updated is not None:
+                updated(len(changed), len(moved), time.monotonic() - started_at)
+    finally:
+        watcher.close()
@@ -0,0 +1,149 @@
+"""
+Spreads a search across several worker processes so that more than one core can be used to parse and output
+usages, the repositories in the search path are split between the workers and each one runs the usual search for
+its share and streams the usages it finds back as newline delimited json, which is passed on as it is, followed by
+the templates it skipped and its stats
+
+Workers are started by running this module, with the options as json in the first argument and the repositories
+to search on stdin
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+from aiostream import stream
+
+from find_usages.guardrails import guardrails, skipped
+from find_usages.stats import stats
+from find_usages.usage import EncodedUsage
+from find_usages.utils import (
+    forward_errors,
+    list_repos,
+    scheduler,
+    search_errors,
+    subprocesses,
+    terminate_subprocesses,
+    write_into,
+)
+
+
+def split_into_shards(repos, count):
+    return [shard for shard in (repos[index::count] for index in range(count)) if shard]
+
+
+async def find_usages_in_worker(in_search_path, of_components, repos, options):
+    """
+    Workers are started directly rather than through the scheduler, which only limits the searches run in this
+    process, so each one would otherwise hold a slot for as long as it runs and no more than --jobs workers could
+    ever run at once, the searches in each worker are limited by its own scheduler instead
+    """
+    options = {
+        "in_search_path": os.path.abspath(in_search_path),
+        "of_components": of_components,
+        **options,
+    }
+
+    worker = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "find_usages.workers",
+        json.dumps(options),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=1024 * 256,
+        # so the package can be found even when it's not installed
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        preexec_fn=os.setsid,
+    )
+    subprocesses.append(worker)
+
+    forwarding_errors = asyncio.ensure_future(forward_errors(worker.stderr))
+    await write_into(worker.stdin, repos)
+
+    finished = False
+    try:
+        while True:
+            line = await worker.stdout.readline()
+            if not line:
+                finished = True
+                break
+            # every usage starts with its repo
+            if line.startswith(b'{"skipped"'):
+                skipped.append(json.loads(line)["skipped"])
+            elif line.startswith(b'{"stats"'):
+                stats.merge(json.loads(line)["stats"])
+            else:
+                yield EncodedUsage(line.rstrip(b"\n"))
+    finally:
+        if not finished:
+            # the usages it's still to find aren't wanted
+            terminate_subprocesses([worker])
+        await worker.wait()
+        errors = await forwarding_errors
+
+    if worker.returncode != 0:
+        raise subprocess.CalledProcessError(
+            worker.returncode,
+            f"find_usages.workers {json.dumps(options)}",
+            "".join(errors),
+        )
+
+
+async def find_all_usages_in_processes(
+    in_search_path, of_components, processes, in_repos=None, **search_options
+):
+    """
+    Search options are passed on to find_all_usages_for_all_components in each worker, which is also told how many
+    jobs it can run so that together the workers run about as many as a single process would have, and the limits
+    set in find_usages.guardrails
+    """
+    shards = split_into_shards(list_repos(in_search_path, in_repos), processes)
+
+    options = {
+        **search_options,
+        "jobs": max(1, scheduler.jobs // max(1, len(shards))),
+        "guardrails": guardrails.as_dict(),
+    }
+
+    searches = stream.merge(
+        *[
+            find_usages_in_worker(in_search_path, of_components, repos, options)
+            for repos in shards
+        ]
+    )
+
+    async with searches.stream() as search_stream:
+        async for usage in search_stream:
+            yield usage
+
+
+async def work(options):
+    from find_usages.core import find_all_usages_for_all_components
+    from find_usages.outputs import output_to_stdout
+
+    scheduler.jobs = options.pop("jobs")
+    for name, value in options.pop("guardrails").items():
+        setattr(guardrails, name, value)
+
+    await output_to_stdout(
+        find_all_usages_for_all_components(
+            in_repos=[line.strip() for line in sys.stdin if line.strip()], **options
+        )
+    )
+
+    # passed back along with the usages, which never have a skipped or stats field
+    for record in skipped:
+        sys.stdout.write(f"{json.dumps({'skipped': record})}\n")
+    sys.stdout.write(f"{json.dumps({'stats': stats.as_dict()})}\n")
+    sys.stdout.flush()
+
+    if search_errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(work(json.loads(sys.argv[1])))
@@ -6,7 +6,6 @@ mkShell {
         python39Packages.poetry
         ripgrep
         jq
-        datamash
         findutils
     ];
     shellHook = ''
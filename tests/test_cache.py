@@ -0,0 +1,85 @@
+import json
+import os
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.cache import open_cache
+from find_usages.stats import stats
+from find_usages.utils import SearchFailed, search_errors
+from tests.test_core import components, fixtures_path
+
+
+async def search_with_cache(cache_dir, engine="python", single_pass=False):
+    stats.reset()
+    return sorted(
+        [
+            usage
+            async for usage in find_all_usages_for_all_components(
+                in_search_path=os.path.join(fixtures_path, "via_all_methods"),
+                of_components=components,
+                engine=engine,
+                single_pass=single_pass,
+                cache_dir=cache_dir,
+            )
+        ],
+        key=lambda usage: usage.to_json(),
+    )
+
+
+@pytest.mark.asyncio
+async def test_usages_are_replayed_from_cache_when_repos_have_not_changed(tmp_path):
+    first_search = await search_with_cache(tmp_path)
+
+    second_search = await search_with_cache(tmp_path)
+
+    assert first_search == second_search
+    # nothing was searched so the cache must have been used for every repo
+    assert "python-engine" not in stats.strategies
+    assert stats.stages["cache_replay"]["count"] == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine, single_pass", [("ripgrep", False), ("python", True)])
+async def test_repos_are_searched_again_with_another_engine_or_single_pass(
+    tmp_path, engine, single_pass
+):
+    await search_with_cache(tmp_path)
+
+    await search_with_cache(tmp_path, engine, single_pass)
+
+    assert "cache_replay" not in stats.stages
+
+
+@pytest.mark.asyncio
+async def test_repos_are_searched_again_when_their_cache_key_changes(tmp_path):
+    first_search = await search_with_cache(tmp_path)
+
+    with open_cache(tmp_path) as cache:
+        cache.execute("update repos set key = 'changed'")
+        cache.execute("delete from usages")
+
+    second_search = await search_with_cache(tmp_path)
+
+    assert first_search == second_search
+
+
+@pytest.mark.asyncio
+async def test_nothing_is_cached_when_ripgrep_fails(tmp_path, monkeypatch):
+    expected = await search_with_cache(tmp_path / "expected", engine="ripgrep")
+
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    (bin / "rg").write_text("#!/bin/sh\necho 'rg: broken' >&2\nexit 2\n")
+    (bin / "rg").chmod(0o755)
+
+    errors_before = len(search_errors)
+    with monkeypatch.context() as patched:
+        patched.setenv("PATH", f"{bin}:{os.environ['PATH']}")
+        assert await search_with_cache(tmp_path / "cache", engine="ripgrep") == []
+
+    failures = search_errors[errors_before:]
+    del search_errors[errors_before:]
+
+    assert failures and all(isinstance(e, SearchFailed) for e in failures)
+    assert await search_with_cache(tmp_path / "cache", engine="ripgrep") == expected
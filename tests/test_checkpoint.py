@@ -0,0 +1,270 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from find_usages.checkpoint import (
+    Checkpoint,
+    FileSink,
+    SqliteSink,
+    output_with_checkpoint,
+    strategy_of,
+)
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.utils import search_errors
+
+components = ["govukButton", "govukInput"]
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def search_path(tmp_path):
+    for repo in ["example-frontend-1", "example-frontend-2", "example-frontend-3"]:
+        views = tmp_path / "repos" / repo / "app" / "views"
+        views.mkdir(parents=True)
+        (views / "page.scala.html").write_text(
+            "@this(button: GovukButton, input: GovukInput)\n"
+            '@button(Button(content = Text("submit")))\n'
+            '@input(Input(id = "name"))\n'
+        )
+    return str(tmp_path / "repos")
+
+
+def searching(searched, interrupt_at=None):
+    """
+    Records the repositories each batch searches, raising once interrupt_at usages have been found in all
+    """
+    found = 0
+
+    async def search(in_search_path, of_components, in_repos):
+        nonlocal found
+        searched.append((sorted(in_repos), sorted(of_components)))
+        async for usage in find_all_usages_for_all_components(
+            in_search_path, of_components, engine="python", in_repos=in_repos
+        ):
+            if found == interrupt_at:
+                raise Interrupted()
+            found += 1
+            yield usage
+
+    return search
+
+
+async def search_with_checkpoint(search_path, sink, path, search, batch_size=1):
+    checkpoint = Checkpoint(path)
+    try:
+        await output_with_checkpoint(
+            search,
+            sink,
+            checkpoint,
+            search_path,
+            components,
+            strategy_of("python"),
+            batch_size=batch_size,
+        )
+    finally:
+        checkpoint.close()
+
+
+def read_lines(path):
+    with open(path) as file:
+        return sorted(
+            (usage["repo"], usage["component"]) for usage in map(json.loads, file)
+        )
+
+
+@pytest.mark.asyncio
+async def test_interrupted_search_carries_on_without_duplicates_in_file(
+    search_path, tmp_path
+):
+    output_file = str(tmp_path / "usages.ndjson")
+    checkpoint = str(tmp_path / "checkpoint.db")
+
+    with pytest.raises(Interrupted):
+        await search_with_checkpoint(
+            search_path,
+            FileSink(output_file),
+            checkpoint,
+            searching([], interrupt_at=3),
+        )
+
+    searched = []
+    await search_with_checkpoint(
+        search_path, FileSink(output_file), checkpoint, searching(searched)
+    )
+
+    # the first repository was recorded before the interruption, the second had been partly written
+    assert searched == [
+        (["example-frontend-2"], components),
+        (["example-frontend-3"], components),
+    ]
+    assert read_lines(output_file) == sorted(
+        (f"example-frontend-{repo}", component)
+        for repo in [1, 2, 3]
+        for component in components
+    )
+
+
+@pytest.mark.asyncio
+async def test_interrupted_search_carries_on_without_duplicates_in_sqlite(
+    search_path, tmp_path
+):
+    database = str(tmp_path / "usages.db")
+    checkpoint = str(tmp_path / "checkpoint.db")
+
+    with pytest.raises(Interrupted):
+        await search_with_checkpoint(
+            search_path, SqliteSink(database), checkpoint, searching([], 3)
+        )
+
+    # as if part of a batch had been written before being interrupted
+    connection = sqlite3.connect(database)
+    with connection:
+        connection.execute(
+            "insert into usages (repo, component) values ('example-frontend-2', 'govukButton')"
+        )
+    connection.close()
+
+    await search_with_checkpoint(
+        search_path, SqliteSink(database), checkpoint, searching([])
+    )
+
+    connection = sqlite3.connect(database)
+    rows = sorted(connection.execute("select repo, component from usages"))
+    matches = connection.execute(
+        "select count(*) from usages_fts where usages_fts match 'Button'"
+    ).fetchone()
+    connection.close()
+
+    assert rows == sorted(
+        (f"example-frontend-{repo}", component)
+        for repo in [1, 2, 3]
+        for component in components
+    )
+    assert matches == (3,)
+
+
+@pytest.mark.asyncio
+async def test_units_are_searched_again_with_another_strategy(search_path, tmp_path):
+    output_file = str(tmp_path / "usages.ndjson")
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.db"))
+    checkpoint.record(
+        [("example-frontend-1", component) for component in components]
+        + [("example-frontend-2", "govukButton")],
+        strategy_of("python"),
+        FileSink(output_file).name,
+        0,
+    )
+
+    searched = []
+    try:
+        await output_with_checkpoint(
+            searching(searched),
+            FileSink(output_file),
+            checkpoint,
+            search_path,
+            components,
+            strategy_of("python"),
+        )
+        await output_with_checkpoint(
+            searching(searched),
+            FileSink(output_file),
+            checkpoint,
+            search_path,
+            components,
+            strategy_of("python", single_pass=True),
+        )
+    finally:
+        checkpoint.close()
+
+    assert searched == [
+        (["example-frontend-2"], ["govukInput"]),
+        (["example-frontend-3"], components),
+        (
+            ["example-frontend-1", "example-frontend-2", "example-frontend-3"],
+            components,
+        ),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_units_are_not_recorded_when_ripgrep_fails(
+    search_path, tmp_path, monkeypatch
+):
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    (bin / "rg").write_text("#!/bin/sh\necho 'rg: broken' >&2\nexit 2\n")
+    (bin / "rg").chmod(0o755)
+
+    async def search(in_search_path, of_components, in_repos):
+        async for usage in find_all_usages_for_all_components(
+            in_search_path, of_components, in_repos=in_repos
+        ):
+            yield usage
+
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.db"))
+    errors_before = len(search_errors)
+    try:
+        with monkeypatch.context() as patched:
+            patched.setenv("PATH", f"{bin}:{os.environ['PATH']}")
+            await output_with_checkpoint(
+                search,
+                FileSink(str(tmp_path / "usages.ndjson")),
+                checkpoint,
+                search_path,
+                components,
+                strategy_of(),
+            )
+        completed = checkpoint.completed(strategy_of())
+    finally:
+        checkpoint.close()
+        del search_errors[errors_before:]
+
+    assert completed == set()
+
+
+@pytest.mark.asyncio
+async def test_batch_with_errors_is_undone_and_written_once_when_resumed(
+    search_path, tmp_path
+):
+    output_file = str(tmp_path / "usages.ndjson")
+    checkpoint = str(tmp_path / "checkpoint.db")
+
+    failing = searching([])
+
+    async def failing_second_batch(in_search_path, of_components, in_repos):
+        async for usage in failing(in_search_path, of_components, in_repos):
+            yield usage
+        # as a failed search records its error once it's output what it found
+        if in_repos == ["example-frontend-2"]:
+            search_errors.append(Exception("search failed"))
+
+    errors_before = len(search_errors)
+    try:
+        await search_with_checkpoint(
+            search_path, FileSink(output_file), checkpoint, failing_second_batch
+        )
+    finally:
+        del search_errors[errors_before:]
+
+    assert read_lines(output_file) == sorted(
+        (f"example-frontend-{repo}", component)
+        for repo in [1, 3]
+        for component in components
+    )
+
+    searched = []
+    await search_with_checkpoint(
+        search_path, FileSink(output_file), checkpoint, searching(searched)
+    )
+
+    assert searched == [(["example-frontend-2"], components)]
+    assert read_lines(output_file) == sorted(
+        (f"example-frontend-{repo}", component)
+        for repo in [1, 2, 3]
+        for component in components
+    )
@@ -1,12 +1,16 @@
+import asyncio
 import json
 import os
 
 from find_usages.core import find_all_usages_for_all_components
 import pytest
 
-from find_usages.outputs import as_json_line
+from find_usages.outputs import as_json_line, output_to_file
+from find_usages.stats import stats
+from find_usages.usage import Usage
 from find_usages.utils import (
     get_default_list_of_all_components,
+    scheduler,
 )
 from tests.utils import (
     remove_commit_hash_from_github_url,
@@ -22,6 +26,7 @@ components = get_default_list_of_all_components()
 
 
 def normalized(usage):
+    usage = usage.to_dict()
     remove_commit_hash_from_github_url(usage)
     replace_newlines_and_tabs_with_spaces(usage)
     replace_digits_with_zeros_in_datetimes(usage)
@@ -30,14 +35,18 @@ def normalized(usage):
 
 @pytest.mark.asyncio
 @pytest.mark.parametrize("fixture", all_fixtures)
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("engine", ["ripgrep", "python"])
 async def test_all_fixtures_against_their_expected_output(
-    fixture, update_expected_output
+    fixture, single_pass, engine, update_expected_output
 ):
     actual_output = [
         normalized(usage)
         async for usage in find_all_usages_for_all_components(
             in_search_path=fixture,
             of_components=components,  # or use ["govukButton"] to run quickly!
+            single_pass=single_pass,
+            engine=engine,
         )
     ]
 
@@ -53,3 +62,153 @@ async def test_all_fixtures_against_their_expected_output(
         expected_output = [json.loads(json_line) for json_line in expected_stdout]
 
     assert actual_output == expected_output
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ["ripgrep", "python"])
+async def test_search_split_across_processes_matches_expected_output(engine):
+    fixture = os.path.join(fixtures_path, "via_all_methods")
+
+    actual_output = [
+        normalized(usage)
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=fixture,
+            of_components=components,
+            single_pass=True,
+            engine=engine,
+            processes=2,
+        )
+    ]
+
+    actual_output.sort(key=lambda d: json.dumps(d))
+
+    with open(f"{fixture}.out", "r") as expected_stdout:
+        expected_output = [json.loads(json_line) for json_line in expected_stdout]
+
+    assert actual_output == expected_output
+
+
+@pytest.mark.asyncio
+async def test_workers_run_without_taking_slots_in_the_scheduler():
+    fixture = os.path.join(fixtures_path, "via_all_methods")
+    jobs = scheduler.jobs
+    scheduler.jobs = 1
+
+    async def search():
+        return [
+            usage
+            async for usage in find_all_usages_for_all_components(
+                in_search_path=fixture,
+                of_components=components,
+                engine="python",
+                processes=3,
+            )
+        ]
+
+    try:
+        # with the only slot taken the workers could never start if they needed one
+        async with scheduler.slot():
+            usages = await asyncio.wait_for(search(), timeout=60)
+    finally:
+        scheduler.jobs = jobs
+
+    with open(f"{fixture}.out", "r") as expected_stdout:
+        assert len(usages) == len(expected_stdout.readlines())
+
+
+@pytest.mark.asyncio
+async def test_workers_output_passes_through_and_their_stats_are_merged(tmp_path):
+    fixture = os.path.join(fixtures_path, "via_all_methods")
+    stats.reset()
+
+    await output_to_file(
+        find_all_usages_for_all_components(
+            in_search_path=fixture,
+            of_components=components,
+            engine="python",
+            processes=2,
+        ),
+        tmp_path / "usages.ndjson",
+    )
+
+    with open(tmp_path / "usages.ndjson") as file:
+        lines = file.readlines()
+    # written exactly as they'd have been by this process
+    assert lines == [
+        f"{Usage.from_dict(json.loads(line)).to_json()}\n" for line in lines
+    ]
+
+    with open(f"{fixture}.out", "r") as expected_stdout:
+        expected_output = [json.loads(json_line) for json_line in expected_stdout]
+    actual_output = sorted(
+        (normalized(Usage.from_dict(json.loads(line))) for line in lines),
+        key=json.dumps,
+    )
+    assert actual_output == expected_output
+
+    # only the workers searched so these were all recorded by them
+    assert stats.strategies["python-engine"]["all"]["usages"] == len(lines)
+    assert stats.stages["read_template"]["count"] > 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("engine", ["ripgrep", "python"])
+async def test_aliases_used_within_each_other_are_all_found(
+    tmp_path, single_pass, engine
+):
+    repo = tmp_path / "example-frontend"
+    repo.mkdir()
+    (repo / "page.scala.html").write_text(
+        "@this(fieldset: GovukFieldset, input: GovukInput)\n"
+        "@button = @{ new GovukButton() }\n"
+        '@fieldset(Fieldset(html = input(Input(id = "name"))))\n'
+        '@button(Button(content = Text("submit")))\n'
+    )
+
+    usages = [
+        (usage.component, usage.line_number, usage.labels)
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=str(tmp_path),
+            of_components=["govukButton", "govukFieldset", "govukInput"],
+            single_pass=single_pass,
+            engine=engine,
+        )
+    ]
+
+    assert sorted(usages) == [
+        ("govukButton", 4, ("via-inline-instantiation", "used-as-variable")),
+        ("govukFieldset", 3, ("via-dependency-injection",)),
+        ("govukInput", 3, ("via-dependency-injection",)),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ["ripgrep", "python"])
+async def test_single_pass_excludes_static_helpers_like_searching_each_component(
+    tmp_path, engine
+):
+    repo = tmp_path / "example-frontend"
+    repo.mkdir()
+    # assigning hmrcheader is also an assignment of header to a search for header on its own
+    (repo / "page.scala.html").write_text(
+        "@hmrcheader = @{ new HmrcHeader() }\n"
+        '@header(Header(title = "page"))\n'
+        "@hmrcheader(Header())\n"
+    )
+
+    async def search(single_pass):
+        return sorted(
+            [
+                usage
+                async for usage in find_all_usages_for_all_components(
+                    in_search_path=str(tmp_path),
+                    of_components=["header", "hmrcheader"],
+                    single_pass=single_pass,
+                    engine=engine,
+                )
+            ],
+            key=Usage.to_json,
+        )
+
+    assert await search(single_pass=True) == await search(single_pass=False)
@@ -0,0 +1,75 @@
+import json
+import os
+import re
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.diff import diff_usages
+from tests.test_core import components, fixtures_path
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("run_size", [2, 1000])
+async def test_diff_finds_added_removed_and_changed_usages(tmp_path, run_size):
+    usages = sorted(
+        [
+            usage.to_dict()
+            async for usage in find_all_usages_for_all_components(
+                in_search_path=os.path.join(fixtures_path, "via_all_methods"),
+                of_components=components,
+                engine="python",
+            )
+        ],
+        key=json.dumps,
+    )
+
+    removed, moved, *unchanged = usages
+    added = {**unchanged[0], "path": "added.scala.html"}
+    moved_on = {
+        **moved,
+        "usage_example": {**moved["usage_example"], "line_number": 100},
+    }
+    # a new commit on its own isn't a change
+    recommitted = {
+        **unchanged[1],
+        "repo_last_updated": "2099-01-01",
+        "usage_example": {
+            **unchanged[1]["usage_example"],
+            "github_url": re.sub(
+                r"/blob/[^/]*/",
+                f"/blob/{'0' * 40}/",
+                unchanged[1]["usage_example"]["github_url"],
+            ),
+        },
+    }
+
+    def write(path, snapshot):
+        with open(path, "w") as file:
+            for usage in snapshot:
+                file.write(f"{json.dumps(usage)}\n")
+
+    write(tmp_path / "old.ndjson", usages)
+    write(
+        tmp_path / "new.ndjson",
+        [*unchanged[2:], recommitted, unchanged[0], added, moved_on][::-1],
+    )
+
+    changes = [
+        change
+        async for change in diff_usages(
+            tmp_path / "old.ndjson", tmp_path / "new.ndjson", run_size=run_size
+        )
+    ]
+
+    assert sorted(
+        [(change["change"], change["old"], change["new"]) for change in changes],
+        key=json.dumps,
+    ) == sorted(
+        [
+            ("removed", removed, None),
+            ("changed", moved, moved_on),
+            ("added", None, added),
+        ],
+        key=json.dumps,
+    )
@@ -0,0 +1,97 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from tests.test_core import components, fixtures_path, normalized
+
+fixture = os.path.join(fixtures_path, "via_all_methods")
+
+
+def git(*args, cwd):
+    subprocess.run(
+        ["git", *args],
+        check=True,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        env={
+            **os.environ,
+            "GIT_AUTHOR_NAME": "tests",
+            "GIT_AUTHOR_EMAIL": "tests@example.com",
+            "GIT_COMMITTER_NAME": "tests",
+            "GIT_COMMITTER_EMAIL": "tests@example.com",
+        },
+    )
+
+
+@pytest.fixture()
+def mirrors(tmp_path):
+    """
+    A bare mirror of each repository in the fixture, cloned into a folder ending with .git
+    """
+    for entry in os.scandir(fixture):
+        if not entry.is_dir():
+            continue
+        checkout = tmp_path / "checkouts" / entry.name
+        shutil.copytree(entry.path, checkout)
+        git("init", "--quiet", cwd=checkout)
+        git("add", ".", cwd=checkout)
+        git("commit", "--quiet", "--message", "Fixture", cwd=checkout)
+        git(
+            "clone",
+            "--quiet",
+            "--bare",
+            str(checkout),
+            str(tmp_path / "mirrors" / f"{entry.name}.git"),
+            cwd=tmp_path,
+        )
+    return tmp_path / "mirrors"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("single_pass", [False, True])
+async def test_searching_bare_mirrors_matches_expected_output(mirrors, single_pass):
+    actual_output = [
+        normalized(usage)
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=str(mirrors),
+            of_components=components,
+            single_pass=single_pass,
+            git_ref="HEAD",
+        )
+    ]
+
+    actual_output.sort(key=lambda d: json.dumps(d))
+
+    with open(f"{fixture}.out", "r") as expected_stdout:
+        expected_output = [json.loads(json_line) for json_line in expected_stdout]
+
+    assert actual_output == expected_output
+
+
+@pytest.mark.asyncio
+async def test_usages_are_reported_at_the_commit_the_ref_points_to(mirrors):
+    repo = sorted(os.listdir(mirrors))[0]
+    commit = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        check=True,
+        cwd=mirrors / repo,
+        stdout=subprocess.PIPE,
+    ).stdout.decode()
+
+    usages = [
+        usage
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=str(mirrors),
+            of_components=components,
+            in_repos=[repo],
+            git_ref="HEAD",
+        )
+    ]
+
+    assert usages
+    assert {usage.repo for usage in usages} == {repo[: -len(".git")]}
+    assert {usage.git_commit for usage in usages} == {commit.strip()}
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+import regex
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.guardrails import guardrails, skipped
+from find_usages.ripgrep import (
+    match_any_params,
+    match_usages_not_instantiations,
+    without_recursion,
+)
+from find_usages.utils import run
+
+# every usage recurses into every unclosed bracket that follows it
+pathological = ("@govukButton" + "(a" * 2000) * 50
+
+
+@pytest.fixture(autouse=True)
+def limits():
+    yield
+    guardrails.max_filesize = None
+    guardrails.file_timeout = None
+    guardrails.pipeline_timeout = None
+    skipped.clear()
+
+
+def test_fallback_matches_the_same_as_match_any_params_when_not_nested_too_deep():
+    code = 'govukButton(Button(content = Text("submit"), attributes = Map()))'
+
+    assert without_recursion(match_any_params()) != match_any_params()
+    assert (
+        regex.search(
+            without_recursion(match_usages_not_instantiations("govukButton")), code
+        ).group()
+        == regex.search(match_usages_not_instantiations("govukButton"), code).group()
+        == code
+    )
+
+
+@pytest.mark.asyncio
+async def test_templates_that_take_too_long_are_searched_again_with_the_fallback(
+    tmp_path,
+):
+    repo = tmp_path / "example-frontend"
+    repo.mkdir()
+    (repo / "pathological.scala.html").write_text(pathological)
+    (repo / "fine.scala.html").write_text('@govukButton(Button(label = "submit"))\n')
+    guardrails.file_timeout = 0.2
+
+    usages = [
+        usage
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=str(tmp_path),
+            of_components=["govukButton"],
+            engine="python",
+        )
+    ]
+
+    assert [usage.path for usage in usages] == ["fine.scala.html"]
+    assert skipped == [
+        {
+            "reason": "timeout",
+            "repo": "example-frontend",
+            "path": "pathological.scala.html",
+            "seconds": 0.2,
+            "fallback": "searched",
+        }
+    ]
+
+
+@pytest.mark.asyncio
+async def test_templates_that_are_too_big_are_skipped(tmp_path):
+    repo = tmp_path / "example-frontend"
+    repo.mkdir()
+    (repo / "big.scala.html").write_text("@govukButton(Button())\n" * 100)
+    guardrails.max_filesize = 1024
+
+    usages = [
+        usage
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=str(tmp_path),
+            of_components=["govukButton"],
+            engine="python",
+        )
+    ]
+
+    assert usages == []
+    assert [record["reason"] for record in skipped] == ["too_big"]
+
+
+@pytest.mark.asyncio
+async def test_pipelines_that_take_too_long_are_stopped_keeping_what_they_output():
+    output = [
+        line async for line in run("echo found; sleep 10; echo never", timeout=0.5)
+    ]
+
+    assert output == [b"found\n"]
+    assert [record["reason"] for record in skipped] == ["pipeline_timeout"]
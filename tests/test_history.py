@@ -0,0 +1,76 @@
+import datetime
+import os
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.history import dates_between, parse_every, parse_history
+from find_usages.stats import stats
+from tests.test_git_objects import git
+
+
+def commit(repo, date, templates):
+    for name, contents in templates.items():
+        (repo / name).write_text(contents)
+    git("add", ".", cwd=repo)
+    git(
+        "commit",
+        "--quiet",
+        "--message",
+        date,
+        "--date",
+        f"{date}T12:00:00Z",
+        cwd=repo,
+    )
+
+
+@pytest.fixture()
+def search_path(tmp_path, monkeypatch):
+    repo = tmp_path / "example-frontend"
+    repo.mkdir()
+    git("init", "--quiet", cwd=repo)
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "2024-01-02T12:00:00Z")
+    commit(repo, "2024-01-02", {"a.scala.html": "@govukButton(Button())\n"})
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "2024-01-10T12:00:00Z")
+    commit(repo, "2024-01-10", {"b.scala.html": "\n@govukButton(Button())\n"})
+    return tmp_path
+
+
+def test_dates_between_always_ends_with_until():
+    since, until = parse_history("2024-01-01..2024-01-20")
+
+    assert dates_between(since, until, parse_every("1w")) == [
+        "2024-01-01",
+        "2024-01-08",
+        "2024-01-15",
+        "2024-01-20",
+    ]
+    assert parse_every("3d") == datetime.timedelta(days=3)
+    with pytest.raises(ValueError):
+        parse_history("2024-01-20..2024-01-01")
+
+
+@pytest.mark.asyncio
+async def test_each_snapshot_has_the_usages_at_the_latest_commit_by_then(
+    search_path,
+):
+    stats.reset()
+
+    usages = [
+        usage
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=str(search_path),
+            of_components=["govukButton"],
+            snapshot_dates=["2024-01-01", "2024-01-08", "2024-01-15"],
+        )
+    ]
+
+    assert sorted(
+        (usage.snapshot_date, usage.path, usage.repo_last_updated) for usage in usages
+    ) == [
+        ("2024-01-08", "a.scala.html", "2024-01-02"),
+        ("2024-01-15", "a.scala.html", "2024-01-10"),
+        ("2024-01-15", "b.scala.html", "2024-01-10"),
+    ]
+    # a.scala.html didn't change between snapshots so was only searched once
+    assert stats.stages["history_blobs_reused"]["count"] == 1
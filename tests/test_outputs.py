@@ -0,0 +1,226 @@
+import asyncio
+import functools
+import json
+import os
+import sqlite3
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.outputs import (
+    BufferedLines,
+    as_json_line,
+    json_line_encoder,
+    output_to_file,
+    output_to_sqlite,
+    replace_usages_in_sqlite,
+    sqlite_columns,
+    sqlite_rendered_columns,
+    tee,
+)
+from find_usages.rendering import render_code_sample
+from find_usages.shards import format_of, read_usages, read_usages_from_sqlite
+from find_usages.usage import Usage
+from tests.test_core import components, fixtures_path
+
+
+async def search():
+    async for usage in find_all_usages_for_all_components(
+        in_search_path=os.path.join(fixtures_path, "via_all_methods"),
+        of_components=components,
+        engine="python",
+    ):
+        yield usage
+
+
+@pytest.mark.asyncio
+async def test_usages_output_to_sqlite_are_updated_in_place_when_upserted(tmp_path):
+    database = str(tmp_path / "usages.db")
+
+    for _ in range(2):
+        await output_to_sqlite(
+            search(), database=database, table="usages", batch_size=2, upsert=True
+        )
+
+    expected = sorted([usage.to_dict() async for usage in search()], key=json.dumps)
+    actual = sorted(read_usages_from_sqlite(database, "usages"), key=json.dumps)
+
+    assert actual == expected
+
+    with sqlite3.connect(database) as connection:
+        [(matches,)] = connection.execute(
+            "select count(*) from usages_fts where usages_fts match 'submit'"
+        )
+
+    assert matches == len(expected)
+
+
+@pytest.mark.asyncio
+async def test_usages_output_to_file_are_the_same_as_json_dumps(tmp_path):
+    usages = [usage async for usage in search()]
+    usages.append(
+        Usage.from_dict(
+            {
+                **usages[0].to_dict(),
+                "code": 'controls \x00\x1f\x7f, quotes "\\/ and unicode \u00e9\u2028',
+            }
+        )
+    )
+
+    async def all_usages():
+        for usage in usages:
+            yield usage
+
+    await output_to_file(all_usages(), tmp_path / "usages.ndjson")
+
+    with open(tmp_path / "usages.ndjson", "rb") as file:
+        output = file.read()
+
+    assert output == "".join(f"{usage.to_json()}\n" for usage in usages).encode()
+    assert (
+        json_line_encoder()(usages[-1].to_dict())
+        == as_json_line(usages[-1].to_dict()).encode()
+    )
+
+
+@pytest.mark.asyncio
+async def test_code_samples_can_be_rendered_as_usages_are_output_to_sqlite(tmp_path):
+    database = str(tmp_path / "usages.db")
+
+    await output_to_sqlite(
+        search(),
+        database=database,
+        table="usages",
+        batch_size=2,
+        columns={**sqlite_columns, **sqlite_rendered_columns},
+    )
+    usages = [usage async for usage in search()]
+    replace_usages_in_sqlite(database, "usages", usages[:1], repos=[usages[0].repo])
+
+    with sqlite3.connect(database) as connection:
+        rows = connection.execute(
+            "select usage_example, usage_example_html from usages"
+        ).fetchall()
+
+    assert len(rows) == len([u for u in usages if u.repo != usages[0].repo]) + 1
+    assert all(html == render_code_sample(example) for example, html in rows)
+    assert sorted(
+        read_usages_from_sqlite(database, "usages"), key=json.dumps
+    ) == sorted(
+        [
+            usage.to_dict()
+            for usage in usages
+            if usage.repo != usages[0].repo or usage is usages[0]
+        ],
+        key=json.dumps,
+    )
+
+
+def test_code_samples_are_escaped_with_a_line_for_each_line_of_code():
+    html = render_code_sample(
+        {
+            "github_url": "https://github.com/hmrc/example-frontend/blob/main/page.scala.html#L3-L4",
+            "line_number": 3,
+            "code": 'govukButton(Button(\n  content = HtmlContent("<b>submit</b>")))',
+            "path": "page.scala.html",
+        }
+    )
+
+    assert "counter-reset: line 2;" in html
+    assert (
+        "<code>govukButton(Button(</code>\n"
+        "<code>  content = HtmlContent(&quot;&lt;b&gt;submit&lt;/b&gt;&quot;)))</code>"
+    ) in html
+    assert "page.scala.html#L3" in html
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("format", ["ndjson", "ndjson.gz", "ndjson.zst", "parquet"])
+async def test_usages_output_in_each_format_can_be_read_back(tmp_path, format):
+    if format == "ndjson.zst":
+        pytest.importorskip("zstandard")
+    if format == "parquet":
+        pytest.importorskip("pyarrow")
+
+    output_file = str(tmp_path / f"usages.{format}")
+
+    await output_to_file(search(), output_file, format)
+
+    expected = [usage.to_dict() async for usage in search()]
+    assert format_of(output_file) == format
+    assert sorted(read_usages(output_file), key=json.dumps) == sorted(
+        expected, key=json.dumps
+    )
+
+
+@pytest.mark.asyncio
+async def test_one_search_is_output_to_every_sink_with_tee(tmp_path):
+    output_file = str(tmp_path / "usages.ndjson.gz")
+    database = str(tmp_path / "usages.db")
+
+    await tee(
+        search(),
+        functools.partial(output_to_file, output_file=output_file, format="ndjson.gz"),
+        functools.partial(
+            output_to_sqlite, database=database, table="usages", batch_size=2
+        ),
+        buffer_size=2,
+    )
+
+    expected = sorted([usage.to_dict() async for usage in search()], key=json.dumps)
+
+    assert sorted(read_usages(output_file), key=json.dumps) == expected
+    assert sorted(read_usages_from_sqlite(database, "usages"), key=json.dumps) == (
+        expected
+    )
+
+
+@pytest.mark.asyncio
+async def test_tee_raises_when_a_sink_fails_without_waiting_on_it(tmp_path):
+    output_file = str(tmp_path / "usages.ndjson")
+    found = 0
+
+    async def counted():
+        nonlocal found
+        async for usage in search():
+            found += 1
+            yield usage
+
+    async def failing(usages):
+        async for _ in usages:
+            raise RuntimeError("sink failed")
+
+    async def slow(usages):
+        async for usage in usages:
+            await asyncio.sleep(0)
+            yield usage
+
+    with pytest.raises(RuntimeError, match="sink failed"):
+        await tee(
+            counted(),
+            failing,
+            lambda usages: output_to_file(slow(usages), output_file),
+            buffer_size=1,
+        )
+
+    # the search stopped soon after the sink failed, and the other sink still got what was found
+    assert found < len([usage async for usage in search()])
+    assert 0 < len(list(read_usages(output_file))) <= found
+
+
+@pytest.mark.asyncio
+async def test_buffered_lines_being_flushed_when_closed_are_all_written():
+    written = []
+    writing = asyncio.Event()
+
+    async def slow_write(data):
+        writing.set()
+        await asyncio.sleep(0.05)
+        written.append(data)
+
+    async with BufferedLines(slow_write, flush_interval=0.01) as lines:
+        await lines.add(b"a\n")
+        await writing.wait()
+        await lines.add(b"b\n")
+
+    assert written == [b"a\n", b"b\n"]
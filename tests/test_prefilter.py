@@ -0,0 +1,104 @@
+import asyncio
+import json
+import os
+import subprocess
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.prefilter import find_candidates
+from find_usages.utils import search_errors
+from tests.test_core import all_fixtures, components, normalized
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fixture", all_fixtures)
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("engine", ["ripgrep", "python"])
+async def test_prefiltered_search_matches_expected_output(fixture, single_pass, engine):
+    actual_output = [
+        normalized(usage)
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=fixture,
+            of_components=components,
+            single_pass=single_pass,
+            engine=engine,
+            prefilter=True,
+        )
+    ]
+
+    actual_output.sort(key=lambda d: json.dumps(d))
+
+    with open(f"{fixture}.out", "r") as expected_stdout:
+        expected_output = [json.loads(json_line) for json_line in expected_stdout]
+
+    assert actual_output == expected_output
+
+
+@pytest.mark.asyncio
+async def test_candidates_are_reused_from_the_index(tmp_path):
+    fixture = [path for path in all_fixtures if path.endswith("via_all_methods")][0]
+    index = os.path.join(tmp_path, "index.db")
+
+    first = await find_candidates(fixture, components, engine="python", index=index)
+
+    # if the index is used then nothing is searched so the engine doesn't matter
+    second = await find_candidates(
+        fixture, components, engine="not-an-engine", index=index
+    )
+
+    assert first == second
+    assert first["govukButton"] == [
+        "example-frontend-1/multiline.scala.html",
+        "example-frontend-1/oneline.scala.html",
+        "example-frontend-2/multiline.scala.html",
+        "example-frontend-2/oneline.scala.html",
+        "example-frontend-3/multiline.scala.html",
+        "example-frontend-3/oneline.scala.html",
+    ]
+
+
+@pytest.fixture
+def failing_ripgrep(tmp_path, monkeypatch):
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    (bin / "rg").write_text("#!/bin/sh\necho 'rg: broken' >&2\nexit 2\n")
+    (bin / "rg").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin}:{os.environ['PATH']}")
+
+
+@pytest.mark.asyncio
+async def test_candidates_raise_without_leaving_searches_running_when_ripgrep_fails(
+    failing_ripgrep,
+):
+    fixture = [path for path in all_fixtures if path.endswith("via_all_methods")][0]
+
+    with pytest.raises(subprocess.CalledProcessError):
+        await asyncio.wait_for(find_candidates(fixture, components), timeout=30)
+
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+
+
+@pytest.mark.asyncio
+async def test_prefiltered_search_finishes_with_an_error_when_ripgrep_fails(
+    failing_ripgrep,
+):
+    errors_before = len(search_errors)
+
+    async def search():
+        return [
+            usage
+            async for usage in find_all_usages_for_all_components(
+                in_search_path=all_fixtures[0],
+                of_components=components,
+                prefilter=True,
+            )
+        ]
+
+    try:
+        assert await asyncio.wait_for(search(), timeout=30) == []
+        assert len(search_errors) > errors_before
+    finally:
+        del search_errors[errors_before:]
+
+    assert asyncio.all_tasks() == {asyncio.current_task()}
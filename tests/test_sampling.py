@@ -0,0 +1,90 @@
+import collections
+import time
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.utils import run, scheduler, stop_searches_in_queue
+
+
+@pytest.fixture
+def search_path(tmp_path):
+    for repo in ["example-frontend-1", "example-frontend-2", "example-frontend-3"]:
+        views = tmp_path / repo / "app" / "views"
+        views.mkdir(parents=True)
+        for template in range(5):
+            (views / f"page{template}.scala.html").write_text(
+                "@this(button: GovukButton, input: GovukInput)\n"
+                '@button(Button(content = Text("submit")))\n'
+                '@input(Input(id = "name"))\n'
+            )
+    return str(tmp_path)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("engine", ["ripgrep", "python"])
+async def test_only_max_examples_of_each_component_are_found(
+    search_path, single_pass, engine
+):
+    usages = [
+        usage
+        async for usage in find_all_usages_for_all_components(
+            search_path,
+            ["govukButton", "govukInput", "govukRadios"],
+            single_pass=single_pass,
+            engine=engine,
+            max_examples=2,
+        )
+    ]
+
+    assert collections.Counter(usage.component for usage in usages) == {
+        "govukButton": 2,
+        "govukInput": 2,
+    }
+    assert not scheduler.stopped
+
+
+@pytest.mark.asyncio
+async def test_max_examples_can_be_of_each_component_in_each_repo(search_path):
+    usages = [
+        usage
+        async for usage in find_all_usages_for_all_components(
+            search_path,
+            ["govukButton", "govukInput"],
+            max_examples=2,
+            examples_per_repo=True,
+        )
+    ]
+
+    counts = collections.Counter((usage.component, usage.repo) for usage in usages)
+    assert len(counts) == 6
+    assert set(counts.values()) == {2}
+
+
+@pytest.mark.asyncio
+async def test_searches_in_a_stopped_queue_are_not_started():
+    stop_searches_in_queue("govukButton")
+    try:
+        assert [line async for line in run("echo found", queue="govukButton")] == []
+    finally:
+        scheduler.resume("govukButton")
+
+    assert [line async for line in run("echo found", queue="govukButton")] == [
+        b"found\n"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_searches_running_in_a_stopped_queue_are_killed():
+    started_at = time.monotonic()
+    output = []
+    try:
+        async for line in run("echo found; sleep 10; echo never", queue="govukButton"):
+            output.append(line)
+            stop_searches_in_queue("govukButton")
+    finally:
+        scheduler.resume("govukButton")
+
+    assert output == [b"found\n"]
+    assert time.monotonic() - started_at < 5
@@ -0,0 +1,125 @@
+import json
+import os
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.outputs import output_to_file, output_to_sqlite
+from find_usages.shards import in_shard, list_repos_in_shard, merge_usages
+from find_usages.usage import Usage, github_url_commit
+from find_usages.utils import list_repos
+from tests.test_core import components, fixtures_path
+
+search_path = os.path.join(fixtures_path, "via_all_methods")
+
+
+def test_every_repo_is_in_exactly_one_shard():
+    for repo in list_repos(search_path):
+        assert len([index for index in range(1, 4) if in_shard(repo, index, 3)]) == 1
+
+
+@pytest.mark.asyncio
+async def test_merged_shards_match_searching_everything_at_once(tmp_path):
+    def search(in_repos=None):
+        return find_all_usages_for_all_components(
+            in_search_path=search_path,
+            of_components=components,
+            engine="python",
+            in_repos=in_repos,
+        )
+
+    await output_to_file(
+        search(list_repos_in_shard(search_path, 1, 2)), tmp_path / "1.ndjson"
+    )
+    await output_to_sqlite(
+        search(list_repos_in_shard(search_path, 2, 2)),
+        database=str(tmp_path / "2.db"),
+        table="usages",
+        batch_size=100,
+    )
+
+    # the first shard is passed twice to check duplicates are skipped
+    merged = [
+        usage
+        async for usage in merge_usages(
+            [tmp_path / "1.ndjson", tmp_path / "2.db", tmp_path / "1.ndjson"]
+        )
+    ]
+
+    everything = [usage async for usage in search()]
+
+    assert sorted(merged, key=Usage.to_json) == sorted(everything, key=Usage.to_json)
+
+
+@pytest.mark.asyncio
+async def test_merged_shards_prefer_known_git_metadata_to_none(tmp_path):
+    [usage, *_] = [
+        usage.to_dict()
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=search_path, of_components=components, engine="python"
+        )
+    ]
+    unknown = {**usage, "repo_last_updated": None}
+
+    for name, shard in [("1", unknown), ("2", usage), ("3", unknown)]:
+        with open(tmp_path / f"{name}.ndjson", "w") as file:
+            file.write(f"{json.dumps(shard)}\n")
+
+    merged = [
+        usage.to_dict()
+        async for usage in merge_usages(
+            [tmp_path / "1.ndjson", tmp_path / "2.ndjson", tmp_path / "3.ndjson"]
+        )
+    ]
+
+    assert merged == [usage]
+
+
+def at_commit(usage, commit, repo_last_updated):
+    usage_example = usage["usage_example"]
+    return {
+        **usage,
+        "repo_last_updated": repo_last_updated,
+        "usage_example": {
+            **usage_example,
+            "github_url": github_url_commit.sub(
+                f"/blob/{commit}/", usage_example["github_url"]
+            ),
+        },
+    }
+
+
+@pytest.mark.asyncio
+async def test_merged_shards_keep_only_the_usages_from_the_latest_commit(tmp_path):
+    multiline, oneline = [
+        usage.to_dict()
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=search_path,
+            of_components=components,
+            engine="python",
+            in_repos=["example-frontend-1"],
+        )
+    ]
+    latest = at_commit(multiline, "b" * 40, "2021-06-01")
+
+    # the repository was searched again by the second shard after oneline was removed from it
+    shards = [
+        (
+            "1",
+            [
+                at_commit(usage, "a" * 40, "2021-01-01")
+                for usage in [multiline, oneline]
+            ],
+        ),
+        ("2", [latest]),
+    ]
+    for name, usages in shards:
+        with open(tmp_path / f"{name}.ndjson", "w") as file:
+            file.writelines(f"{json.dumps(usage)}\n" for usage in usages)
+
+    merged = [
+        usage.to_dict()
+        async for usage in merge_usages([tmp_path / "1.ndjson", tmp_path / "2.ndjson"])
+    ]
+
+    assert merged == [latest]
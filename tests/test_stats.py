@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.stats import counting_usages, stats
+from tests.test_core import components, fixtures_path
+
+
+@pytest.mark.asyncio
+async def test_stats_count_usages_and_notify_listeners_when_finished():
+    snapshots = []
+    stats.listeners.append(snapshots.append)
+    stats.reset()
+
+    try:
+        usages = [
+            usage
+            async for usage in counting_usages(
+                find_all_usages_for_all_components(
+                    in_search_path=os.path.join(fixtures_path, "via_all_methods"),
+                    of_components=components,
+                    engine="python",
+                )
+            )
+        ]
+        stats.finish()
+    finally:
+        stats.listeners.remove(snapshots.append)
+
+    [snapshot] = snapshots
+    assert snapshot["usages"] == len(usages)
+    assert snapshot["strategies"]["python-engine"]["all"]["usages"] == len(usages)
+    assert snapshot["stages"]["create_usage"]["count"] == len(usages)
+
+
+@pytest.mark.asyncio
+async def test_searches_for_each_component_are_recorded_under_that_component():
+    stats.reset()
+
+    [
+        usage
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=os.path.join(fixtures_path, "via_all_methods"),
+            of_components=components,
+        )
+    ]
+
+    searched_for = set(stats.strategies["via-nunjucks"])
+    assert searched_for <= set(components)
+    assert set(stats.strategies["via-aliases"]) == searched_for
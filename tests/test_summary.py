@@ -0,0 +1,83 @@
+import collections
+import json
+import os
+import sqlite3
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.summary import output_summary_to_sqlite, summarise
+from find_usages.utils import get_default_list_of_all_components
+
+fixtures_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "fixtures")
+
+all_fixtures = [f.path for f in os.scandir(fixtures_path) if f.is_dir()]
+
+components = get_default_list_of_all_components()
+
+
+def key_of(each):
+    return (each["repo"], each["component"], each["library"], tuple(each["labels"]))
+
+
+async def counted(fixture, single_pass, count):
+    usages = collections.Counter()
+    templates = collections.defaultdict(set)
+    async for usage in find_all_usages_for_all_components(
+        in_search_path=fixture,
+        of_components=components,
+        single_pass=single_pass,
+        engine="python",
+    ):
+        usage = usage.to_dict()
+        usages[key_of(usage)] += 1
+        # labels that depend on the code aren't counted for templates
+        labels = [
+            label
+            for label in usage["labels"]
+            if label != "using-with-form-field-inline"
+        ]
+        templates[key_of({**usage, "labels": labels})].add(usage["path"])
+
+    if count == "usages":
+        return dict(usages)
+    return {key: len(paths) for key, paths in templates.items()}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fixture", all_fixtures)
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("count", ["usages", "templates"])
+async def test_summary_counts_the_same_as_every_usage_found(
+    fixture, single_pass, count
+):
+    summary = {
+        key_of(row): row[count]
+        async for row in summarise(
+            fixture, components, count=count, single_pass=single_pass
+        )
+    }
+
+    assert summary == await counted(fixture, single_pass, count)
+
+
+@pytest.mark.asyncio
+async def test_summary_replaces_the_table_in_sqlite(tmp_path):
+    database = str(tmp_path / "summary.db")
+    fixture = os.path.join(fixtures_path, "via_all_methods")
+
+    for _ in range(2):
+        await output_summary_to_sqlite(summarise(fixture, components), database)
+
+    connection = sqlite3.connect(database)
+    rows = connection.execute(
+        "select repo, component, labels, usages from summary order by repo"
+    ).fetchall()
+    connection.close()
+
+    assert [(repo, json.loads(labels)) for repo, _, labels, _ in rows] == [
+        ("example-frontend-1", ["via-dependency-injection"]),
+        ("example-frontend-2", ["via-inline-instantiation", "used-as-variable"]),
+        ("example-frontend-3", ["via-deprecated-static-helper"]),
+    ]
+    assert sum(usages for *_, usages in rows) == 6
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from find_usages.core import find_all_usages_for_all_components
+from find_usages.usage import Usage
+from tests.test_core import components, fixtures_path
+
+
+@pytest.mark.asyncio
+async def test_usages_are_the_same_after_being_output_and_read_back_in():
+    usages = [
+        usage
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=os.path.join(fixtures_path, "via_all_methods"),
+            of_components=components,
+            engine="python",
+        )
+    ]
+
+    assert usages
+    for usage in usages:
+        assert Usage.from_dict(usage.to_dict()) == usage
+        assert usage.to_dict()["line_count"] == 1 + usage.code.count("\n")
+
+
+@pytest.mark.asyncio
+async def test_usages_found_the_same_way_share_their_labels():
+    usages = [
+        usage
+        async for usage in find_all_usages_for_all_components(
+            in_search_path=os.path.join(fixtures_path, "via_all_methods"),
+            of_components=components,
+            engine="python",
+        )
+    ]
+
+    labels = {}
+    for usage in usages:
+        assert labels.setdefault(usage.labels, usage.labels) is usage.labels
@@ -0,0 +1,241 @@
+import asyncio
+import subprocess
+
+import pytest
+
+from find_usages.utils import (
+    QueueStopped,
+    Scheduler,
+    read_git_head_commit,
+    read_git_repo_metadata,
+    read_git_repo_metadata_from_git_dir,
+)
+from tests.test_git_objects import git
+
+
+def git_log(cwd):
+    commit, last_updated_at = (
+        subprocess.run(
+            ["git", "log", "-1", "--format=%H%n%cd", "--date=short"],
+            check=True,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+        )
+        .stdout.decode()
+        .strip()
+        .split("\n")
+    )
+    return commit, last_updated_at
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    # late in the evening behind UTC so the date is only right when read in the committer's timezone
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "2021-03-04T23:30:00-0500")
+    repo = tmp_path / "example-frontend"
+    repo.mkdir()
+    git("init", "--quiet", "--initial-branch", "main", cwd=repo)
+    (repo / "page.scala.html").write_text("@govukButton(Button())\n")
+    git("add", ".", cwd=repo)
+    git("commit", "--quiet", "--message", "First", cwd=repo)
+    (repo / "page.scala.html").write_text("@govukInput(Input())\n")
+    git("commit", "--quiet", "--all", "--message", "Second", cwd=repo)
+    return repo
+
+
+def test_git_metadata_is_read_from_a_loose_ref(repo):
+    assert read_git_repo_metadata_from_git_dir(repo) == git_log(repo)
+    assert git_log(repo)[1] == "2021-03-04"
+
+
+def test_git_metadata_is_read_from_a_packed_ref(repo):
+    git("pack-refs", "--all", cwd=repo)
+    assert not (repo / ".git" / "refs" / "heads" / "main").exists()
+
+    assert read_git_repo_metadata_from_git_dir(repo) == git_log(repo)
+
+
+def test_git_metadata_is_read_from_a_detached_head(repo):
+    git("checkout", "--quiet", "--detach", "HEAD~1", cwd=repo)
+
+    assert read_git_repo_metadata_from_git_dir(repo) == git_log(repo)
+    assert read_git_head_commit(repo) == git_log(repo)[0]
+
+
+def test_git_metadata_is_read_from_a_linked_worktree(repo, tmp_path):
+    worktree = tmp_path / "worktree"
+    git("worktree", "add", "--quiet", "-b", "other", str(worktree), "HEAD~1", cwd=repo)
+    git("pack-refs", "--all", cwd=repo)
+
+    assert read_git_repo_metadata_from_git_dir(worktree) == git_log(worktree)
+    assert read_git_repo_metadata_from_git_dir(worktree) != git_log(repo)
+
+
+@pytest.mark.asyncio
+async def test_git_metadata_falls_back_to_git_log_once_commits_are_packed(repo):
+    git("gc", "--quiet", cwd=repo)
+
+    assert read_git_repo_metadata_from_git_dir(repo) is None
+    assert await read_git_repo_metadata(repo) == git_log(repo)
+
+
+async def started(tasks):
+    # lets every task run until it's waiting for a slot or holding one
+    for _ in range(10):
+        await asyncio.sleep(0)
+    return tasks
+
+
+@pytest.mark.asyncio
+async def test_scheduler_never_runs_more_than_its_jobs_at_once():
+    scheduler = Scheduler(jobs=3)
+    running = 0
+    most_running = 0
+
+    async def task():
+        nonlocal running, most_running
+        async with scheduler.slot(queue=None):
+            running += 1
+            most_running = max(most_running, running)
+            await asyncio.sleep(0.001)
+            running -= 1
+
+    await asyncio.gather(*[task() for _ in range(20)])
+
+    assert most_running == 3
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_takes_turns_between_queues():
+    scheduler = Scheduler(jobs=1)
+    order = []
+    release = asyncio.Event()
+
+    async def task(queue, name):
+        async with scheduler.slot(queue):
+            order.append(name)
+            if name == "first":
+                await release.wait()
+
+    tasks = await started([asyncio.ensure_future(task(None, "first"))])
+    tasks += await started(
+        [
+            asyncio.ensure_future(task(queue, f"{queue}{index}"))
+            for queue in ["a", "b"]
+            for index in range(3)
+        ]
+    )
+    release.set()
+    await asyncio.gather(*tasks)
+
+    assert order == ["first", "a0", "b0", "a1", "b1", "a2", "b2"]
+
+
+@pytest.mark.asyncio
+async def test_scheduler_releases_the_slot_of_a_cancelled_task():
+    scheduler = Scheduler(jobs=1)
+    order = []
+
+    async def task(name):
+        async with scheduler.slot(name):
+            order.append(name)
+            await asyncio.sleep(60 if name == "holding" else 0)
+
+    holding, waiting, cancelled, last = await started(
+        [asyncio.ensure_future(task(name)) for name in ["holding", "waiting"]]
+        + [asyncio.ensure_future(task(name)) for name in ["cancelled", "last"]]
+    )
+
+    # cancelled both while it holds a slot and while it's waiting for one
+    holding.cancel()
+    cancelled.cancel()
+    await asyncio.wait_for(
+        asyncio.gather(holding, waiting, cancelled, last, return_exceptions=True),
+        timeout=5,
+    )
+
+    assert order == ["holding", "waiting", "last"]
+    assert scheduler.running == 0
+    assert not scheduler.queues
+
+
+@pytest.mark.asyncio
+async def test_stopped_queue_gives_its_waiting_tasks_queue_stopped():
+    scheduler = Scheduler(jobs=1)
+    release = asyncio.Event()
+
+    async def task(queue):
+        async with scheduler.slot(queue):
+            await release.wait()
+        return queue
+
+    tasks = await started(
+        [asyncio.ensure_future(task(queue)) for queue in ["a", "b", "c"]]
+    )
+    scheduler.stop("b")
+    release.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    assert results[0] == "a" and results[2] == "c"
+    assert isinstance(results[1], QueueStopped)
+    with pytest.raises(QueueStopped):
+        async with scheduler.slot("b"):
+            pass
+
+    scheduler.resume("b")
+    assert await task("b") == "b"
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_passes_on_a_slot_handed_to_a_task_as_it_was_cancelled():
+    scheduler = Scheduler(jobs=1)
+    order = []
+
+    async def task(name):
+        async with scheduler.slot(name):
+            order.append(name)
+
+    async with scheduler.slot():
+        handed, last = await started(
+            [asyncio.ensure_future(task(name)) for name in ["handed", "last"]]
+        )
+    # the slot has been handed over but the task hasn't woken up to take it yet
+    handed.cancel()
+    # last would never get the slot if it had been lost
+    await asyncio.wait_for(
+        asyncio.gather(handed, last, return_exceptions=True), timeout=5
+    )
+
+    assert order == ["last"]
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_keeps_count_when_a_queue_is_stopped_as_its_task_is_cancelled():
+    scheduler = Scheduler(jobs=1)
+    running = 0
+    most_running = 0
+
+    async def task(queue):
+        nonlocal running, most_running
+        async with scheduler.slot(queue):
+            running += 1
+            most_running = max(most_running, running)
+            await asyncio.sleep(0.001)
+            running -= 1
+
+    async with scheduler.slot():
+        [stopped] = await started([asyncio.ensure_future(task("stopped"))])
+        # the task is given QueueStopped but hasn't woken up to raise it yet
+        scheduler.stop("stopped")
+        stopped.cancel()
+        await asyncio.gather(stopped, return_exceptions=True)
+        assert scheduler.running == 1
+
+    assert scheduler.running == 0
+    await asyncio.gather(*[task(queue) for queue in ["a", "b", "a", "b"]])
+
+    assert most_running == 1
+    assert scheduler.running == 0
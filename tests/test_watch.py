@@ -0,0 +1,169 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from find_usages.utils import subprocesses
+from find_usages.watch import watch_search_path
+from tests.test_core import components, fixtures_path
+from tests.test_git_objects import git
+
+
+def count_usages(database, where="1"):
+    connection = sqlite3.connect(database)
+    try:
+        return connection.execute(
+            f"select count(*) from usages where {where}"
+        ).fetchone()[0]
+    finally:
+        connection.close()
+
+
+async def eventually(condition, timeout=10):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return True
+        await asyncio.sleep(0.05)
+    return condition()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("poll", [False, True])
+async def test_usages_are_kept_up_to_date_as_templates_change(tmp_path, poll):
+    search_path = tmp_path / "search_path"
+    shutil.copytree(os.path.join(fixtures_path, "via_all_methods"), search_path)
+    for repo in os.scandir(search_path):
+        git("init", "--quiet", cwd=repo.path)
+        git("add", ".", cwd=repo.path)
+        git("commit", "--quiet", "--message", "Fixture", cwd=repo.path)
+
+    database = str(tmp_path / "usages.db")
+    updates = []
+
+    watching = asyncio.ensure_future(
+        watch_search_path(
+            str(search_path),
+            components,
+            database,
+            interval=0.1,
+            poll=poll,
+            updated=lambda *update: updates.append(update),
+            engine="python",
+        )
+    )
+    try:
+        assert await eventually(
+            lambda: os.path.exists(database) and count_usages(database) == 6
+        )
+
+        template = search_path / "example-frontend-1" / "new" / "added.scala.html"
+        template.parent.mkdir()
+        template.write_text("@govukButton(Button())\n")
+        assert await eventually(lambda: count_usages(database) == 7)
+
+        template.unlink()
+        assert await eventually(lambda: count_usages(database) == 6)
+
+        repo = search_path / "example-frontend-2"
+        (repo / "README.md").write_text("Moved on\n")
+        git("add", ".", cwd=repo)
+        git("commit", "--quiet", "--message", "Moved on", cwd=repo)
+        assert await eventually(lambda: any(moved for _, moved, _ in updates))
+        assert count_usages(database) == 6
+    finally:
+        watching.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await watching
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("poll", [False, True])
+async def test_usages_are_removed_when_a_folder_is_moved_or_deleted(tmp_path, poll):
+    search_path = tmp_path / "search_path"
+    shutil.copytree(os.path.join(fixtures_path, "via_all_methods"), search_path)
+
+    database = str(tmp_path / "usages.db")
+
+    watching = asyncio.ensure_future(
+        watch_search_path(
+            str(search_path),
+            components,
+            database,
+            interval=0.1,
+            poll=poll,
+            engine="python",
+        )
+    )
+    try:
+        assert await eventually(
+            lambda: os.path.exists(database) and count_usages(database) == 6
+        )
+
+        views = search_path / "example-frontend-1" / "app" / "extra"
+        views.mkdir(parents=True)
+        for name in ["first", "second"]:
+            (views / f"{name}.scala.html").write_text("@govukButton(Button())\n")
+        assert await eventually(lambda: count_usages(database) == 8)
+
+        views.rename(views.parent / "moved")
+        assert await eventually(
+            lambda: count_usages(database, "path like 'app/moved/%'") == 2
+            and count_usages(database, "path like 'app/extra/%'") == 0
+        )
+        assert count_usages(database) == 8
+
+        shutil.move(str(views.parent / "moved"), str(tmp_path / "outside"))
+        assert await eventually(lambda: count_usages(database) == 6)
+
+        shutil.rmtree(search_path / "example-frontend-2")
+        assert await eventually(
+            lambda: count_usages(database, "repo = 'example-frontend-2'") == 0
+        )
+    finally:
+        watching.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await watching
+
+
+@pytest.mark.asyncio
+async def test_subprocesses_of_earlier_searches_are_not_kept(tmp_path):
+    search_path = tmp_path / "search_path"
+    shutil.copytree(os.path.join(fixtures_path, "via_all_methods"), search_path)
+    repo = search_path / "example-frontend-2"
+    git("init", "--quiet", cwd=repo)
+    git("add", ".", cwd=repo)
+    git("commit", "--quiet", "--message", "Fixture", cwd=repo)
+
+    database = str(tmp_path / "usages.db")
+    kept = []
+
+    watching = asyncio.ensure_future(
+        watch_search_path(
+            str(search_path),
+            components,
+            database,
+            interval=0.1,
+            updated=lambda *update: kept.append(len(subprocesses)),
+            engine="ripgrep",
+        )
+    )
+    try:
+        assert await eventually(
+            lambda: os.path.exists(database) and count_usages(database) == 6
+        )
+
+        # each time the repository moves on it's searched again with ripgrep
+        for commit in range(3):
+            git(
+                "commit", "--quiet", "--allow-empty", "--message", f"{commit}", cwd=repo
+            )
+            assert await eventually(lambda: len(kept) == commit + 1)
+    finally:
+        watching.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await watching
+
+    assert kept[0] > 0
+    assert kept == [kept[0]] * 3